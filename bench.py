@@ -0,0 +1,528 @@
+#! env python3
+'''
+Copyright (c) 2019, shimoda as kuri65536 _dot_ hot mail _dot_ com
+                    ( email address: convert _dot_ to . and joint string )
+
+This Source Code Form is subject to the terms of the Mozilla Public License,
+v.2.0. If a copy of the MPL was not distributed with this file,
+You can obtain one at https://mozilla.org/MPL/2.0/.
+'''
+from argparse import ArgumentParser
+import gc
+import io
+import json
+import logging
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import (Any, Callable, Dict, IO, List, Text, )
+
+import common as cmn
+import fmmulti
+import md2fm
+from common import NodeDmy, NodeNote
+
+log = logging.getLogger(__name__)  # the api leaves the root logger.
+debg = log.debug
+
+Results = Dict[Text, Dict[Text, float]]  # size -> stage -> seconds
+
+n_sizes = (1000, 10000, 100000, 1000000)
+fname_baseline = "bench_baseline.json"
+t_floor = 0.05  # stages faster than this are too noisy to compare.
+
+# a part of texts for non-ascii titles and notes.
+text_unicode = ("要件", "仕様", "試験",
+                "été", "Δι", "\U0001f4dd", )
+text_ascii = ("spec", "test", "sensor", "flash", "timer", "memory", )
+
+
+class options(object):  # {{{1
+    def __init__(self) -> None:  # {{{1
+        self.sizes = list(n_sizes)
+        self.repeat = 3
+        self.fname_baseline = fname_baseline
+        self.fname_out = ""
+        self.fname_generate = ""
+        self.f_classifier = False
+        self.f_memory = False
+        self.f_update = False
+        self.f_verbose = False
+        self.threshold = 0.5
+        self.slack = 0.5
+        self.gen = Generator()
+
+    @classmethod  # parser {{{1
+    def parser(cls) -> ArgumentParser:  # {{{1
+        arg = ArgumentParser()
+        arg.add_argument("-n", "--sizes", default="",
+                         help="node counts separated by ',', "
+                              "default: {}".format(
+                                  ",".join(Text(i) for i in n_sizes)))
+        arg.add_argument("-r", "--repeat", type=int, default=3,
+                         help="take the best of N runs at least, "
+                              "more for small maps and once for 1M")
+        arg.add_argument("-b", "--baseline", default=fname_baseline)
+        arg.add_argument("-u", "--update", action="store_true",
+                         help="save the results as the baseline "
+                              "instead of checking them")
+        arg.add_argument("-o", "--output", default="",
+                         help="save the results to this json")
+        arg.add_argument("-v", "--verbose", action="store_true")
+        arg.add_argument("-t", "--threshold", type=float, default=0.5,
+                         help="fail if a stage is slower than the "
+                              "baseline by this ratio")
+        arg.add_argument("-s", "--slack", type=float, default=0.5,
+                         help="fail if a stage grows faster than "
+                              "n log n by this ratio")
+        arg.add_argument("-c", "--classifier", action="store_true",
+                         help="compare the line classifier of md2fm "
+                              "with the former one, instead of stages")
+        arg.add_argument("-m", "--memory", action="store_true",
+                         help="show memory of parsed maps per node, "
+                              "instead of stages")
+        arg.add_argument("-g", "--generate", default="",
+                         help="only write a generated map to this file")
+        arg.add_argument("--depth", type=int, default=6)
+        arg.add_argument("--fanout", type=int, default=10)
+        arg.add_argument("--attrs", type=float, default=0.9,
+                         help="ratio of nodes with doc/test attributes")
+        arg.add_argument("--notes", type=float, default=0.2,
+                         help="ratio of nodes with a note")
+        arg.add_argument("--note-size", type=int, default=300,
+                         help="characters of a note")
+        arg.add_argument("--codes", type=float, default=0.2,
+                         help="ratio of notes with a fenced code")
+        arg.add_argument("--ascii", action="store_true",
+                         help="texts without non-ascii characters")
+        return arg
+
+    @classmethod  # parse {{{1
+    def parse(cls, args: List[Text]) -> 'options':
+        ret = options()
+        opts = ret.parser().parse_args(args)
+        if len(opts.sizes) > 0:
+            ret.sizes = [int(i) for i in opts.sizes.split(",")]
+        ret.repeat = max(opts.repeat, 1)
+        ret.fname_baseline = opts.baseline
+        ret.fname_out = opts.output
+        ret.fname_generate = opts.generate
+        ret.f_classifier = opts.classifier
+        ret.f_memory = opts.memory
+        ret.f_update = opts.update
+        ret.f_verbose = opts.verbose
+        ret.threshold = opts.threshold
+        ret.slack = opts.slack
+        ret.gen = Generator(depth=opts.depth, fanout=opts.fanout,
+                            attrs=opts.attrs, notes=opts.notes,
+                            note_size=opts.note_size, codes=opts.codes,
+                            f_unicode=not opts.ascii)
+        return ret
+
+
+class Generator(object):  # {{{1
+    """write synthetic FreeMind maps, same parameters give same maps.
+
+    - `depth` and `fanout` limit the shape of the tree,
+    - `attrs` is the ratio of nodes with `doc` and `test` attributes,
+      `notes` and `note_size` are for notes of nodes, `codes` is the
+      ratio of notes with a fenced code which has `#` lines,
+    - `f_unicode` mixes non-ascii characters into titles and notes.
+    """
+    def __init__(self, depth: int = 6, fanout: int = 10,  # {{{1
+                 attrs: float = 0.9, notes: float = 0.2,
+                 note_size: int = 300, codes: float = 0.2,
+                 f_unicode: bool = True, seed: int = 1) -> None:
+        self.depth = max(depth, 1)
+        self.fanout = max(fanout, 1)
+        self.attrs = attrs
+        self.notes = notes
+        self.note_size = note_size
+        self.codes = codes
+        self.f_unicode = f_unicode
+        self.seed = seed
+
+    def words(self, rnd: random.Random, n: int) -> Text:  # {{{1
+        seq = text_ascii + text_unicode if self.f_unicode else text_ascii
+        return " ".join(rnd.choice(seq) for i in range(n))
+
+    def note(self, rnd: random.Random) -> Text:  # {{{1
+        """a note as md2fm writes, it is a body of markdown."""
+        seq: List[Text] = []
+        while sum(len(i) + 1 for i in seq) < self.note_size:
+            seq.append(self.words(rnd, 8))
+        if rnd.random() < self.codes:
+            seq[1:1] = ["", "```sh", "# " + self.words(rnd, 3),
+                        "make tests", "```", ""]
+        # raw utf-8 in notes, character references in titles.
+        return NodeNote("\n".join(seq)).compose(NodeDmy())
+
+    def node(self, rnd: random.Random, i: int, stack: List[int]  # {{{1
+             ) -> Text:
+        sec = "-".join(Text(j) for j in stack) if i > 0 else "root"
+        pos = ' POSITION="right"' if len(stack) == 1 else ""
+        ret = ('<node CREATED="1572302616305" ID="ID_{}" '
+               'MODIFIED="1572305025151"{} TEXT="{} {}">\n'.format(
+                   i, pos, i, cmn.quote_attr(self.words(rnd, 2))))
+        if i % 50 == 7:
+            ret += '<icon BUILTIN="idea"/>\n'
+        if i == 0 or rnd.random() < self.attrs:
+            # tests are grouped in another order than documents.
+            tst = sec if i == 0 else "{}-{}".format(
+                    rnd.randint(1, self.fanout), sec)
+            if rnd.random() < 0.1 and i > 0:  # in 2 groups, not the root.
+                tst += "," + sec
+            ret += ('<attribute NAME="doc" VALUE="{}"/>\n'
+                    '<attribute NAME="test" VALUE="{}"/>\n'.format(sec, tst))
+        if self.note_size > 0 and rnd.random() < self.notes:
+            ret += self.note(rnd)
+        return ret
+
+    def write(self, fp: IO[Text], n: int) -> None:  # {{{1
+        """write a map with a root and `n - 1` nodes under it in depth
+        first order, the root takes more than `fanout` children if
+        the other nodes are full.
+        """
+        rnd = random.Random(self.seed)
+        fp.write('<map version="1.1.0">\n' + cmn.cmt_header + "\n")
+        fp.write(self.node(rnd, 0, []))
+        stack, i = [0], 1
+        while i < n:
+            if len(stack) > 1 and (stack[-1] >= self.fanout or
+                                   len(stack) > self.depth):
+                stack.pop()
+                fp.write('</node>\n')
+                continue
+            stack[-1] += 1
+            fp.write(self.node(rnd, i, stack))
+            stack.append(0)
+            i += 1
+        fp.write('</node>\n' * len(stack))
+        fp.write('</map>\n')
+
+
+def calibrate(repeat: int = 10) -> float:  # {{{1
+    """seconds of a fixed python workload, used to scale timings
+    between machines.
+    """
+    ret = float("inf")
+    for i in range(repeat):
+        t = time.perf_counter()
+        dct = {}
+        for j in range(200000):
+            dct["{}-{}".format(j % 97, j)] = j
+        sorted(dct, key=lambda x: tuple(int(k) for k in x.split("-")))
+        ret = min(ret, time.perf_counter() - t)
+    return ret
+
+
+class Runner(object):  # {{{1
+    """time stages of converters on a generated map."""
+    def __init__(self, fname: Text, dname: Text) -> None:  # {{{1
+        self.fname = fname
+        self.fname_md = os.path.join(dname, "bench.md")
+        self.cache = cmn.FileCache(os.path.join(dname, "cache"), 1 << 30)
+        self.times: Dict[Text, float] = {}
+        self.lines: List[Text] = []  # the markdown for run_classifier
+        self.n_diff = 0
+
+    def timed(self, stage: Text, fn: Callable[[], Any]) -> Any:  # {{{1
+        gc.collect()
+        t = time.perf_counter()
+        ret = fn()
+        t = time.perf_counter() - t
+        self.times[stage] = min(t, self.times.get(stage, t))
+        debg("bench:{}:{:.6f}s".format(stage, t))
+        return ret
+
+    def run(self) -> None:  # {{{1
+        """run each stage once, keeps the best times of stages."""
+        self.run_fmmulti()  # trees are released at returns.
+        self.run_md2fm()
+        self.timed("md2fm-stream", lambda: md2fm.FMStream.convert_file(
+                   self.fname_md, os.devnull))
+        self.timed("md2fm-levels", lambda: sum(
+                   1 for i in md2fm.LineTokenizer().levels(
+                       md2fm.FMXml.get_lines(self.fname_md))))
+
+    def run_fmmulti(self) -> None:  # {{{1
+        xml = self.timed("parse", lambda: fmmulti.FMXml.parse(self.fname))
+        xml.f_disable_script = True
+        for mode in (fmmulti.runmode.doc, fmmulti.runmode.test,
+                     fmmulti.runmode.backup):
+            self.run_output(xml, mode)
+        self.run_sort(xml)
+        seq = xml.output_tree(fmmulti.runmode.through)
+        with open(self.fname_md, "wt") as fp:
+            self.timed("output-markdown",
+                       lambda: xml.output_markdown(fp, seq, 1))
+        with open(os.devnull, "wt") as fp:
+            self.timed("output-through", lambda: xml.output_stream(fp, seq))
+
+    def run_output(self, xml: fmmulti.FMXml,  # {{{1
+                   mode: fmmulti.runmode) -> None:
+        seq = self.timed("restruct-" + mode.t(), lambda: xml.restruct(mode))
+        with open(os.devnull, "wt") as fp:
+            self.timed("output-" + mode.t(),
+                       lambda: xml.output_stream(fp, seq))
+
+    def run_md2fm(self) -> None:  # {{{1
+        md = self.timed("md2fm-parse",
+                        lambda: md2fm.FMXml.parse_markdown(self.fname_md))
+        self.timed("md2fm-output", lambda: md.output(os.devnull))
+
+    def run_sort(self, xml: fmmulti.FMXml) -> None:  # {{{1
+        """time the full sort and `--incremental` one of an unchanged
+        map, levels are parsed in each run.
+        """
+        mode = fmmulti.runmode.doc
+        ctx = xml.ctx.with_mode(mode)
+        seq: List[cmn.Node] = []
+        for nod in xml.root.children:
+            if isinstance(nod, fmmulti.FMNode):
+                seq.extend(nod.flattern(ctx, "", exclude_self=False))
+        for stage in ("sort-full", "sort-order", "sort-incremental"):
+            for i in seq:
+                i.level_cache.clear()
+            if stage == "sort-order":  # the 1st run saves the order.
+                xml.fname_order, xml.cache = self.fname, self.cache
+                xml.restruct_sort(seq, mode)
+                continue
+            self.timed(stage, lambda: xml.restruct_sort(seq, mode))
+        xml.fname_order, xml.cache = "", None
+
+    def run_classifier(self) -> None:  # {{{1
+        """time the line classifier of md2fm and the former one on the
+        markdown of the map, `n_diff` is the number of different lines.
+        """
+        if len(self.lines) < 1:
+            xml = fmmulti.FMXml.parse(self.fname)
+            seq = xml.output_tree(fmmulti.runmode.through)
+            fp = io.StringIO()
+            xml.output_markdown(fp, seq, 1)
+            self.lines = fp.getvalue().splitlines(True)
+            del xml, seq, fp
+        a = self.timed("classify-legacy",
+                       lambda: classify_legacy(self.lines))
+        b = self.timed("classify-tokenizer",
+                       lambda: classify_tokenizer(self.lines))
+        self.n_diff = sum(1 for i, j in zip(a, b) if i != j)
+
+
+def memory(gen: Generator, n: int) -> Text:  # {{{1
+    """parse a generated map and report traced memory per node."""
+    with tempfile.TemporaryDirectory() as dname:
+        fname = os.path.join(dname, "bench.mm")
+        with open(fname, "wt", encoding="utf-8") as fp:
+            gen.write(fp, n)
+        gc.collect()
+        tracemalloc.start()
+        try:
+            xml = fmmulti.FMXml.parse(fname)
+            cur = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+    nodes = 0
+    seq: List[cmn.Node] = [xml.root]
+    while len(seq) > 0:
+        nod = seq.pop()
+        nodes += 1
+        seq.extend(nod.children)
+    return ("{} FreeMind nodes, {} objects: {} bytes, {:.1f} bytes/object, "
+            "{:.1f} bytes/FreeMind node".format(
+                n, nodes, cur, cur / nodes, cur / n))
+
+
+def section_line_legacy(line: Text, lines: List[Text]) -> int:  # {{{1
+    """the former `md2fm.FMXml.is_section_line`, only to compare with
+    `md2fm.LineTokenizer`, it did not support '#' in code blocks.
+    """
+    if len(line) < 1:
+        return 0
+    if line.startswith(" ") or line.startswith("\t"):
+        return 0
+    if len(line.lstrip("=")) < 1:
+        if len(lines) < 1 or len(lines[-1].strip()) < 1:
+            return 0
+        return md2fm.n_level_1st  # 1st level
+    if len(line.lstrip("-")) < 1:
+        if len(lines) < 1 or len(lines[-1].strip()) < 1:
+            return 0
+        return md2fm.n_level_2nd  # 2nd level
+    if not line.startswith("#"):
+        return 0
+    src = line.lstrip("#")
+    n = len(line) - len(src)
+    if n == 1:
+        return md2fm.n_level_1st + 10  # 1st level + alpha
+    if n == 2:
+        return md2fm.n_level_2nd + 10  # 2nd level + alpha
+    return n * md2fm.n_level_unit
+
+
+def classify_legacy(lines: List[Text]) -> List[int]:  # {{{1
+    """levels of lines by `section_line_legacy`, headings were classified
+    2 times more to build sections.
+    """
+    ret: List[int] = []
+    prv: List[Text] = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        n = section_line_legacy(line, prv)
+        if n != 0:
+            section_line_legacy(line, prv)
+            section_line_legacy(line, [])
+        ret.append(n)
+        prv = [line]
+    return ret
+
+
+def classify_tokenizer(lines: List[Text]) -> List[int]:  # {{{1
+    return [n for n, line in md2fm.LineTokenizer().levels(lines)]
+
+
+def repeats(n: int, repeat: int) -> int:  # {{{1
+    """runs of a map with `n` nodes, small maps are repeated more
+    to hide noises, maps larger than 100k nodes run once.
+    """
+    if n > 100000:
+        return 1
+    return max(repeat, 30000 // n)
+
+
+def run(opts: options) -> Results:  # {{{1
+    ret: Results = {}
+    with tempfile.TemporaryDirectory() as dname:
+        for n in opts.sizes:
+            fname = os.path.join(dname, "bench.mm")
+            with open(fname, "wt", encoding="utf-8") as fp:
+                opts.gen.write(fp, n)
+            runner = Runner(fname, dname)
+            for i in range(repeats(n, opts.repeat)):
+                if opts.f_classifier:
+                    runner.run_classifier()
+                else:
+                    runner.run()
+            ret[Text(n)] = runner.times
+            sys.stderr.write("bench:{} nodes:{}\n".format(n, " ".join(
+                "{}={:.3f}s".format(k, v) for k, v in runner.times.items())))
+            if opts.f_classifier:
+                sys.stderr.write("bench:{} nodes:{} lines:{} lines are "
+                                 "classified differently\n".format(
+                                     n, len(runner.lines), runner.n_diff))
+    return ret
+
+
+def check_regression(cur: Results, calib: float, base: Dict[Text, Any],  # {{{1
+                     threshold: float) -> List[Text]:
+    """compare timings to the baseline, scaled by calibrations."""
+    ret = []
+    scale = calib / base["calibration"]
+    for size, stages in sorted(cur.items(), key=lambda x: int(x[0])):
+        for stage, t in stages.items():
+            t_base = base["results"].get(size, {}).get(stage, 0.0) * scale
+            if t_base < t_floor:
+                continue
+            if t > t_base * (1 + threshold):
+                ret.append("{} nodes: {}: {:.3f}s, baseline {:.3f}s "
+                           "(+{:.0%})".format(size, stage, t, t_base,
+                                              t / t_base - 1))
+    return ret
+
+
+def check_scaling(cur: Results, slack: float) -> List[Text]:  # {{{1
+    """check timings of each stage grow not faster than n log n."""
+    ret = []
+    sizes = sorted(int(i) for i in cur)
+    for n1, n2 in zip(sizes, sizes[1:]):
+        exp = n2 * math.log(n2) / (n1 * math.log(n1))
+        for stage, t1 in cur[Text(n1)].items():
+            t2 = cur[Text(n2)].get(stage, 0.0)
+            if t1 < t_floor or t2 <= t1 * exp * (1 + slack):
+                continue
+            ret.append("{}: {:.3f}s at {} nodes to {:.3f}s at {} nodes, "
+                       "x{:.1f} over n log n x{:.1f}".format(
+                           stage, t1, n1, t2, n2, t2 / t1, exp))
+    return ret
+
+
+def check_incremental(cur: Results) -> List[Text]:  # {{{1
+    """check the incremental sort of an unchanged map is faster than
+    the full sort.
+    """
+    ret = []
+    for size, stages in sorted(cur.items(), key=lambda x: int(x[0])):
+        t1 = stages.get("sort-full", 0.0)
+        t2 = stages.get("sort-incremental", 0.0)
+        if t1 < t_floor or t2 < t1:
+            continue
+        ret.append("{} nodes: sort-incremental {:.3f}s is not faster than "
+                   "sort-full {:.3f}s".format(size, t2, t1))
+    return ret
+
+
+def baseline_load(fname: Text) -> Dict[Text, Any]:  # {{{1
+    with open(fname) as fp:
+        ret: Dict[Text, Any] = json.load(fp)
+    return ret
+
+
+def baseline_save(fname: Text, cur: Results, calib: float) -> None:  # {{{1
+    dct = dict(calibration=calib, python=platform.python_version(),
+               results=cur)
+    with open(fname, "wt") as fp:
+        json.dump(dct, fp, indent=1, sort_keys=True)
+        fp.write("\n")
+
+
+def report(fp: IO[Text], cur: Results) -> None:  # {{{1
+    sizes = sorted(cur, key=int)
+    stages: List[Text] = []
+    for size in sizes:
+        stages.extend(i for i in cur[size] if i not in stages)
+    fp.write("{:16}".format("stage") +
+             "".join("{:>12}".format(i) for i in sizes) + "\n")
+    for stage in stages:
+        fp.write("{:16}".format(stage) + "".join(
+                 "{:11.4f}s".format(cur[i][stage]) if stage in cur[i] else
+                 "{:>12}".format("-") for i in sizes) + "\n")
+
+
+def main(args: List[Text]) -> int:  # {{{1
+    opts = options.parse(args)
+    cmn.logging_setup(opts.f_verbose)
+    if len(opts.fname_generate) > 0:
+        with open(opts.fname_generate, "wt", encoding="utf-8") as fp:
+            opts.gen.write(fp, opts.sizes[0])
+        return 0
+    if opts.f_memory:
+        for n in opts.sizes:
+            sys.stdout.write(memory(opts.gen, n) + "\n")
+        return 0
+    calib = calibrate()
+    cur = run(opts)
+    report(sys.stdout, cur)
+    if opts.f_classifier:
+        return 0
+    if len(opts.fname_out) > 0:
+        baseline_save(opts.fname_out, cur, calib)
+    if opts.f_update:
+        baseline_save(opts.fname_baseline, cur, calib)
+        return 0
+    errs = check_scaling(cur, opts.slack) + check_incremental(cur)
+    if os.path.exists(opts.fname_baseline):
+        base = baseline_load(opts.fname_baseline)
+        errs += check_regression(cur, calib, base, opts.threshold)
+    for msg in errs:
+        sys.stdout.write("NG: " + msg + "\n")
+    return 1 if len(errs) > 0 else 0
+
+
+if __name__ == "__main__":  # {{{1
+    sys.exit(main(sys.argv[1:]))
+# vi: ft=python:et:ts=4:sw=4:tw=80:fdm=marker
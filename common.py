@@ -7,12 +7,39 @@ This Source Code Form is subject to the terms of the Mozilla Public License,
 v.2.0. If a copy of the MPL was not distributed with this file,
 You can obtain one at https://mozilla.org/MPL/2.0/.
 '''
+from contextlib import contextmanager
+from functools import lru_cache
+import gc
+import hashlib
+import heapq
+import io
+import json
+import logging
+import marshal
+import mmap
+from operator import attrgetter, itemgetter, methodcaller, mul
 import os
-from logging import warning as warn, debug as debg
 import re
-from typing import (Dict, List, Optional, Text, )
+import stat
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import MappingProxyType, ModuleType
+from typing import (Any, Callable, Dict, IO, Iterable, Iterator, List,
+                    Optional, Sequence, Set, Text, Tuple, )
+from xml.parsers.expat import ParserCreate  # type: ignore
 from xml.sax.saxutils import escape as quote_xml
 
+np: Optional[ModuleType] = None
+try:
+    import numpy  # type: ignore
+    np = numpy
+except ImportError:  # sort levels in pure python, see argsort_levels()
+    pass
+
+log = logging.getLogger(__name__)  # the api leaves the root logger.
+debg, warn = log.debug, log.warning
 List, Optional
 warn
 quote_xml
@@ -28,8 +55,22 @@ lvl_max = 100000 - 1
 lvl_dgt = 1000
 lvl_root = ()
 
+f_debug = False  # per-node diagnostic logs, see logging_setup()
+
+
+def logging_setup(verbose: bool) -> None:  # {{{1
+    global f_debug
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.WARNING)
+    f_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
 
-def number_output(f_override: bool, src: Text, sfx: Text) -> Text:  # {{{1
+
+def number_output(f_override: bool, src: Text, sfx: Text,  # {{{1
+                  names: Optional[Set[Text]] = None) -> Text:
+    """make an output filename which is not exist.
+
+    - `names`: file names in the directory, scanned by the caller,
+      the result is added to it.
+    """
     p = os.path.dirname(src)
     src = os.path.basename(src)
     src, ext = os.path.splitext(src)
@@ -38,16 +79,253 @@ def number_output(f_override: bool, src: Text, sfx: Text) -> Text:  # {{{1
         s = (("-%d" % i) if i > 0 else "") + sfx
         return os.path.join(p, src + s)  # type: ignore
 
+    def exists(fname: Text) -> bool:
+        if names is None:
+            return os.path.lexists(fname)  # also dangling symlinks.
+        return os.path.basename(fname) in names
+
     n = 0
     ret = fn(n)
-    if f_override:
-        return ret
-    while os.path.exists(ret):
+    while not f_override and exists(ret):
         n += 1
         ret = fn(n)
+    if names is not None:
+        names.add(os.path.basename(ret))
     return ret
 
 
+@contextmanager  # open_output {{{1
+def open_output(fname: Text) -> Iterator[IO[Text]]:
+    """open an output file, `-` or `/dev/stdout` to write to stdout.
+    """
+    if fname in ("-", "/dev/stdout"):
+        yield sys.stdout
+        sys.stdout.flush()
+        return
+    with open(fname, "wt") as fp:
+        yield fp
+
+
+class Profiler(object):  # {{{1
+    """record wall time, node counts and peak memory of each phase.
+
+    - does nothing if not enabled, phase() yields a dummy record.
+    """
+    def __init__(self, enabled: bool) -> None:  # {{{1
+        self.f_enabled = enabled
+        self.phases: List[Dict[Text, Any]] = []
+        self.f_tracing = enabled and not tracemalloc.is_tracing()
+        if self.f_tracing:
+            tracemalloc.start()
+
+    def stop(self) -> None:  # {{{1
+        """stop tracing memory if this profiler started it."""
+        if self.f_tracing:
+            tracemalloc.stop()
+            self.f_tracing = False
+
+    @contextmanager  # phase {{{1
+    def phase(self, name: Text, mode: Text = "") -> Iterator[Dict[Text, Any]]:
+        rec: Dict[Text, Any] = dict(phase=name, mode=mode, nodes=0)
+        if not self.f_enabled:
+            yield rec
+            return
+        if hasattr(tracemalloc, "reset_peak"):  # python3.9 or later
+            tracemalloc.reset_peak()
+        t = time.perf_counter()
+        yield rec
+        rec["wall"] = time.perf_counter() - t
+        rec["peak"] = tracemalloc.get_traced_memory()[1]
+        self.phases.append(rec)
+
+    def report(self, fname: Text) -> None:  # {{{1
+        """write the records as json to `fname` or a table to stderr.
+        """
+        if not self.f_enabled:
+            return
+        if len(fname) > 0:
+            with open_output(fname) as fp:
+                json.dump(dict(phases=self.phases), fp, indent=1)
+                fp.write("\n")
+            return
+        for rec in self.phases:
+            sys.stderr.write("{:8} {:8} {:10.6f}s {:8d} nodes {:10d} bytes\n"
+                             .format(rec["phase"], rec["mode"], rec["wall"],
+                                     rec["nodes"], rec["peak"]))
+
+
+@contextmanager  # gc_paused {{{1
+def gc_paused() -> Iterator[None]:
+    """pause the garbage collector while making many objects,
+    which have no reference cycles to collect.
+    """
+    f = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if f:
+            gc.enable()
+
+
+class FileCache(object):  # {{{1
+    """cache data made from files into a directory by `marshal`.
+
+    - an entry is valid while the path, size, mtime and
+      the content hash of the source are the same, entries by
+      `store_entry` are kept for the path and `kind` of data.
+    - least recently used entries are removed if the total size of
+      the directory is over `limit` bytes.
+    """
+    version = 2
+
+    def __init__(self, dname: Text, limit: int) -> None:  # {{{1
+        self.dname = dname
+        self.limit = limit
+
+    def path(self, src: Text, kind: Text = "") -> Text:  # {{{1
+        name = os.path.abspath(src) + ("\0" + kind if kind else "")
+        digest = hashlib.sha1(name.encode("utf-8")).hexdigest()
+        return os.path.join(self.dname, digest + ".cache")
+
+    def key(self, src: Text, data: bytes) -> Tuple[Any, ...]:  # {{{1
+        st = os.stat(src)
+        return (self.version, tuple(sys.version_info[:2]),
+                os.path.abspath(src), st.st_size, st.st_mtime_ns,
+                hashlib.sha256(data).hexdigest())
+
+    def load(self, src: Text, data: bytes) -> Any:  # {{{1
+        """load a cached entry for `src` with its content `data`,
+        returns None if not found or out of date.
+        """
+        return self.read(self.path(src), self.key(src, data))
+
+    def store(self, src: Text, data: bytes, obj: Any) -> None:  # {{{1
+        self.write(self.path(src), self.key(src, data), obj)
+
+    def load_entry(self, src: Text, kind: Text) -> Any:  # {{{1
+        """load data of `src` stored by `store_entry`, which is kept
+        while `src` is changed, returns None if not found.
+        """
+        return self.read(self.path(src, kind), self.key_entry(src, kind))
+
+    def store_entry(self, src: Text, kind: Text, obj: Any) -> None:  # {{{1
+        self.write(self.path(src, kind), self.key_entry(src, kind), obj)
+
+    def key_entry(self, src: Text, kind: Text) -> Tuple[Any, ...]:  # {{{1
+        return (self.version, tuple(sys.version_info[:2]),
+                os.path.abspath(src), kind)
+
+    def read(self, fname: Text, key: Tuple[Any, ...]) -> Any:  # {{{1
+        try:
+            with open(fname, "rb") as fp:
+                buf = fp.read()
+            n = int.from_bytes(buf[:4], "little") + 4
+            if marshal.loads(buf[4:n]) != key:
+                return None
+            with gc_paused():
+                ret = marshal.loads(buf[n:])
+            os.utime(fname)  # mark as recently used.
+        except (OSError, EOFError, ValueError, TypeError) as ex:
+            debg("cache:load:{}:{}".format(fname, ex))
+            return None
+        return ret
+
+    def write(self, fname: Text, key: Tuple[Any, ...], obj: Any  # {{{1
+              ) -> None:
+        tmp = "{}.{}.tmp".format(fname, os.getpid())
+        try:
+            os.makedirs(self.dname, exist_ok=True)
+            head = marshal.dumps(key)
+            with open(tmp, "wb") as fp:
+                fp.write(len(head).to_bytes(4, "little"))
+                fp.write(head)
+                fp.write(marshal.dumps(obj))
+            os.replace(tmp, fname)
+        except (OSError, ValueError) as ex:
+            warn("cache:store:{}:{}".format(fname, ex))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self.evict()
+
+    def evict(self) -> None:  # {{{1
+        seq = []
+        for i in os.scandir(self.dname):
+            if not i.name.endswith(".cache"):
+                continue
+            st = i.stat()
+            seq.append((st.st_mtime, st.st_size, i.path))
+        seq.sort()
+        total = sum(i[1] for i in seq)
+        for mtime, size, fname in seq:
+            if total <= self.limit:
+                break
+            os.remove(fname)
+            total -= size
+
+
+class ExternalSort(object):  # {{{1
+    """sort records of (key, bytes) in a memory budget.
+
+    - records are sorted and written to temporary files (runs) when
+      their size exceeds `budget`, then `merged()` merges the runs,
+    - keys should be unique, their order is not stable.
+    """
+    n_merge = 64  # max number of runs before merging them into one.
+
+    def __init__(self, budget: int, dname: Optional[Text] = None) -> None:
+        self.budget = budget
+        self.dname = dname
+        self.buf: List[Tuple[Any, bytes]] = []
+        self.n_buf = 0
+        self.runs: List[IO[bytes]] = []
+
+    def add(self, key: Any, data: bytes) -> None:  # {{{1
+        self.buf.append((key, data))
+        self.n_buf += len(data) + 100  # rough size of a key and tuples.
+        if self.n_buf >= self.budget:
+            self.spill()
+
+    def spill(self) -> None:  # {{{1
+        if len(self.buf) < 1:
+            return
+        self.buf.sort(key=itemgetter(0))
+        self.runs.append(self.write_run(self.buf))
+        self.buf, self.n_buf = [], 0
+        if len(self.runs) >= self.n_merge:
+            seq = heapq.merge(*[self.read_run(i) for i in self.runs],
+                              key=itemgetter(0))
+            self.runs = [self.write_run(seq)]
+
+    def write_run(self, seq: Iterable[Tuple[Any, bytes]]) -> IO[bytes]:  # {{{1
+        fp = tempfile.TemporaryFile(dir=self.dname)
+        for ent in seq:
+            data = marshal.dumps(ent)
+            fp.write(len(data).to_bytes(4, "little"))
+            fp.write(data)
+        fp.seek(0)
+        return fp  # type: ignore
+
+    @classmethod  # read_run {{{1
+    def read_run(cls, fp: IO[bytes]) -> Iterator[Tuple[Any, bytes]]:
+        with fp:
+            while True:
+                head = fp.read(4)
+                if len(head) < 4:
+                    return
+                yield marshal.loads(fp.read(int.from_bytes(head, "little")))
+
+    def merged(self) -> Iterator[Tuple[Any, bytes]]:  # {{{1
+        """yield all records in the order of keys.
+        """
+        self.buf.sort(key=itemgetter(0))
+        seqs = [self.read_run(i) for i in self.runs]
+        seqs.append(iter(self.buf))
+        self.buf, self.n_buf, self.runs = [], 0, []
+        return heapq.merge(*seqs, key=itemgetter(0))
+
+
 def section_num_1st(num: Text) -> Text:
     num = num + ch_splitter + "0" + sub_digit[0]
     num = num.lstrip(ch_splitter)
@@ -103,7 +381,121 @@ def section_num_incr_desc(num: Text) -> Text:  # {{{1
     return ret
 
 
-def quote_attr(src: Text) -> Text:  # {{{1
+def section_next(secs: List[List[Any]]) -> Text:  # {{{1
+    """section of the next node in the tree order, see `mark_backup`.
+
+    - `secs`: [section, number of nodes] for each level,
+      a level for children of the node is pushed.
+    """
+    ent = secs[-1]
+    sec, n = ent[0], ent[1] + 1
+    ent[1] = n
+    if sec == "root":
+        if n == 1:
+            ret = "root"
+        else:  # ??? root node == 1.
+            ret = "0" + section_num_recv(n - 1)
+    else:
+        ret = (sec + "-" + Text(n)).lstrip("-")
+    secs.append([ret if ret != "root" else "", 0])
+    return ret
+
+
+def level_keys(levels: Sequence[Tuple[int, ...]]) -> List[Any]:  # {{{1
+    """sort keys of section levels, compared as padded with 0 to the
+    deepest one.
+
+    - packs levels into ints in base `lvl_max + 1` if they fit in
+      `lvl_cls` components, or returns padded tuples.
+    """
+    N = max(map(len, levels), default=0)
+    U = lvl_max + 1
+    seq = list(filter(None, levels))
+    if (N > lvl_cls or max(map(max, seq), default=0) >= U or
+            min(map(min, seq), default=0) < 0):
+        return [i + (0, ) * (N - len(i)) for i in levels]
+    weights = [U ** (lvl_cls - 1 - i) for i in range(lvl_cls)]
+    return [sum(map(mul, lv, weights)) for lv in levels]
+
+
+def argsort_levels(levels: Sequence[Tuple[int, ...]]) -> List[int]:  # {{{1
+    """stable order of section levels, see `level_keys()`.
+
+    - with numpy, levels are padded to a 2-D array and sorted by
+      `np.lexsort` at once.
+    """
+    n = len(levels)
+    if np is None or n < 256:
+        return sorted(range(n), key=level_keys(levels).__getitem__)
+    by_len: Dict[int, List[int]] = {}
+    for i, lv in enumerate(levels):
+        by_len.setdefault(len(lv), []).append(i)
+    N = max(by_len)
+    if N < 1:
+        return list(range(n))
+    try:
+        arr = np.zeros((n, N), dtype=np.int64)
+        for m, idx in by_len.items():
+            if m > 0:
+                arr[idx, :m] = [levels[i] for i in idx]
+    except OverflowError:  # too large numbers in sections.
+        return sorted(range(n), key=level_keys(levels).__getitem__)
+    return np.lexsort(arr.T[::-1]).tolist()  # type: ignore
+
+
+def level_trim(lv: Tuple[int, ...]) -> Tuple[int, ...]:  # {{{1
+    """sort key of a level without knowing the deepest one,
+    trailing 0 are removed, it orders as `level_keys()`.
+    """
+    n = len(lv)
+    while n > 0 and lv[n - 1] == 0:
+        n -= 1
+    return lv[:n]
+
+
+def quote_attr_char(ch: Text) -> Text:  # {{{1
+    """quote a character as FreeMind does, see quote_attr_charwise().
+    """
+    _v = ch.encode('ascii', 'xmlcharrefreplace')
+    v = Text(_v)
+    v = v[2:-1]  # remove "b'" and "'"
+    if v.startswith("&#") and v.endswith(";"):
+        v = v[2:-1]
+        n = int(v)
+        v = "&#x{:x};".format(n)
+    if ch == "\n":
+        v = "&#xa;"
+    if ch == '"':
+        v = "&quot;"
+    if ch == ">":
+        v = "&gt;"
+    if ch == "<":
+        v = "&lt;"
+    return v
+
+
+class QuoteTable(Dict[int, Text]):  # {{{1
+    """`str.translate` table, fills characters at the first use.
+    """
+    def __missing__(self, n: int) -> Text:  # {{{1
+        ret = self[n] = quote_attr_char(chr(n))
+        return ret
+
+
+quote_table = QuoteTable()
+
+
+@lru_cache(maxsize=4096)  # quote_attr {{{1
+def quote_attr(src: Text) -> Text:
+    ret = src.replace("\\n", "\x0b")  # pattern.A: already quoted
+    ret = ret.translate(quote_table)
+    ret = ret.replace("\\x0b", "\\n")  # pattern A: already quoted
+    return ret
+
+
+def quote_attr_charwise(src: Text) -> Text:  # {{{1
+    """the reference implementation of quote_attr(), slow.
+    """
     ret = ""
     src = src.replace("\\n", "\x0b")  # pattern.A: already quoted
     for ch in src:
@@ -156,57 +548,178 @@ def compose_script(mode_string: Text) -> Text:  # {{{1
     return ret
 
 
+serve_port = 8765  # default port of `fmmulti.py --serve`
+
+
+def compose_script_server(mode_string: Text, port: int) -> Text:  # {{{1
+    """node script to request a conversion to `fmmulti.py --serve`,
+    spawns fmmulti.py if the server is not running.
+
+    - the server writes `fname-mode.mm` as the spawned fmmulti.py, but
+      numbered if it exists, see `fmmulti.serve_outputs`.
+    """
+    fname = os.path.join(os.path.dirname(__file__), "fmmulti.py")
+    ret = """cur = c.getMap()
+           fname = cur.getFile().getPath()
+           fnout = fname + "-d.mm"
+           req = [fname, "-m", "doc", "--script-server", "PORT"]
+           try {
+           sock = new Socket("127.0.0.1", PORT)
+           sock.setSoTimeout(60000)
+           sock.withStreams { inp, out ->
+           out.write((req.join("\\n") + "\\n\\n").getBytes("UTF-8"))
+           out.flush()
+           rd = new BufferedReader(new InputStreamReader(inp, "UTF-8"))
+           print(rd.readLine() + "\\n")
+           }
+           } catch (IOException ex) {
+           cmd = ["python3", "SCRIPT"] + req + ["-f", "-o", fnout]
+           print(cmd.join(" ") + "\\n")
+           proc = cmd.execute()
+           proc.waitForOrKill(5000)
+           }"""
+    ret = re.sub("\n +", "\n", ret)  # strip indent
+    ret = ret.replace("SCRIPT", fname).replace("PORT", Text(port))
+    ret = ret.replace('"doc"', '"' + mode_string + '"')
+    ret = ret.replace("-d.mm", "-" + mode_string + ".mm")
+    return ret
+
+
+def serve_address(src: Text) -> Any:  # {{{1
+    """parse `--serve` address: `path/to/socket`, `host:port` or `port`.
+    """
+    if "/" in src:
+        return src
+    host, port = src.rpartition(":")[::2]
+    if not port:
+        return (host or "127.0.0.1", serve_port)
+    try:
+        return (host or "127.0.0.1", int(port))
+    except ValueError:
+        raise ValueError("not a port or a socket path: " + src)
+
+
+# shared read-only containers for leaf nodes: chars, comments, ...
+leaf_attr: Dict[Text, Text] = MappingProxyType({})  # type: ignore
+leaf_children: List['Node'] = ()  # type: ignore
+leaf_attr_index: Dict[Text, 'Node'] = MappingProxyType({})  # type: ignore
+leaf_level_cache: Dict[Text, Tuple[int, ...]] = MappingProxyType(
+        {})  # type: ignore
+
+
 class Node(object):  # {{{1
+    __slots__ = ("name", "attr", "children", "parent", "f_enter_only",
+                 "attr_index", "n_attr", "level_cache", )
+
     def __init__(self, name: Text, attr: Dict[Text, Text]) -> None:  # {{{1
         self.name = name
         self.attr = attr
         self.children: List['Node'] = []
         self.parent: Optional['Node'] = None
         self.f_enter_only = False
+        self.attr_index: Dict[Text, 'Node'] = {}  # NAME -> attribute node
+        self.n_attr = 0
+        # parsed section levels by attribute NAME, see fmmulti.Node.level
+        self.level_cache: Dict[Text, Tuple[int, ...]] = {}
+
+    @classmethod  # leaf {{{1
+    def leaf(cls, name: Text, attr: Dict[Text, Text]) -> 'Node':
+        """create a xml element node which will not have children.
+        """
+        ret = cls.__new__(cls)
+        ret.init_leaf(name, attr)
+        return ret
+
+    def init_leaf(self, name: Text, attr: Dict[Text, Text] = leaf_attr  # {{{1
+                  ) -> None:
+        """initialize the node without children, shares empty containers.
+        """
+        self.name = name
+        self.attr = attr
+        self.children = leaf_children
+        self.parent = None
+        self.f_enter_only = False
+        self.attr_index = leaf_attr_index
+        self.n_attr = 0
+        self.level_cache = leaf_level_cache
 
     def __repr__(self) -> Text:  # for debug {{{1
         par = self.parent.name if self.parent is not None else "None"
         return "{}-{}-{}".format(self.name, len(self.children), par)
 
+    def append_child(self, nod: 'Node') -> None:  # {{{1
+        self.children.append(nod)
+        self.attr_index_add(nod)
+
+    def insert_child(self, n: int, nod: 'Node') -> None:  # {{{1
+        self.children.insert(n, nod)
+        if nod.name != "attribute":
+            return
+        self.n_attr += 1
+        name = nod.attr.get("NAME", "")
+        self.level_cache.pop(name, None)
+        if name in self.attr_index:  # keep the first one in children.
+            self.attr_index_rebuild()
+        else:
+            self.attr_index[name] = nod
+
+    def attr_index_add(self, nod: 'Node') -> None:  # {{{1
+        """register an attribute node appended to the last of children.
+        """
+        if nod.name != "attribute":
+            return
+        self.n_attr += 1
+        name = nod.attr.get("NAME", "")
+        self.level_cache.pop(name, None)
+        self.attr_index.setdefault(name, nod)
+
+    def attr_index_rebuild(self) -> None:  # {{{1
+        self.attr_index, self.n_attr = {}, 0
+        for i in self.children:
+            self.attr_index_add(i)
+
+    def attr_node(self, name: Text) -> Optional['Node']:  # {{{1
+        return self.attr_index.get(name, None)
+
     def attr_replace(self, name: Text, val: Text) -> None:  # {{{1
-        n, elem = -1, "attribute"
-        for j, i in enumerate(self.children):
-            if i.name != elem:
-                continue
-            n = j
-            if i.attr["NAME"] != name:
-                continue
-            i.attr["VALUE"] = val
+        nod = self.attr_index.get(name, None)
+        if nod is not None:
+            nod.attr["VALUE"] = val
+            self.level_cache.pop(name, None)
             return
-        nod = Node(elem, dict(NAME=name, VALUE=val))
+        n, elem = -1, "attribute"
+        if self.n_attr > 0:
+            for j, i in enumerate(self.children):
+                if i.name == elem:
+                    n = j
+        nod = Node.leaf(elem, dict(NAME=name, VALUE=val))
         if n == -1:
             if len(self.children) < 1:
-                self.children.append(Chars("\n"))
-            self.children.append(nod)
-            self.children.append(Chars("\n"))
+                self.children.append(Chars.shared("\n"))
+            self.append_child(nod)
+            self.children.append(Chars.shared("\n"))
         else:
-            self.children.insert(n, Chars("\n"))
-            self.children.insert(n, nod)
+            self.children.insert(n, Chars.shared("\n"))
+            self.insert_child(n, nod)
 
     def attr_change_name(self, tgt: Text, name: Text) -> None:  # {{{1
-        elem = "attribute"
-        for i in self.children:
-            if i.name != elem:
-                continue
-            if i.attr["NAME"] != tgt:
-                continue
-            i.attr["NAME"] = name
+        nod = self.attr_index.get(tgt, None)
+        if nod is None:
+            return
+        nod.attr["NAME"] = name
+        self.level_cache.pop(tgt, None)
+        self.level_cache.pop(name, None)
+        if len(self.attr_index) != self.n_attr or name in self.attr_index:
+            self.attr_index_rebuild()  # duplicated names, order by children.
             return
+        del self.attr_index[tgt]
+        self.attr_index[name] = nod
 
     def attr_get(self, tgt: Text, fallback: Text) -> Text:  # {{{1
-        elem = "attribute"
-        for i in self.children:
-            if i.name != elem:
-                continue
-            if i.attr["NAME"] != tgt:
-                continue
-            return i.attr.get("VALUE", fallback)
-        return fallback
+        nod = self.attr_index.get(tgt, None)
+        if nod is None:
+            return fallback
+        return nod.attr.get("VALUE", fallback)
 
     def compos2(self) -> Text:  # {{{1
         ret = "<" + self.name
@@ -222,6 +735,39 @@ class Node(object):  # {{{1
         ret += "/>"
         return ret
 
+    def compose_buffered(self, prv: 'Node', ctx: Any = None  # {{{1
+                         ) -> Text:
+        """compose a whole subtree into a string by `write()`
+        """
+        fp = io.StringIO()
+        self.write(fp, prv, ctx)
+        return fp.getvalue()
+
+    def write(self, fp: IO[Text], prv: 'Node', ctx: Any = None  # {{{1
+              ) -> None:
+        """write the xml fragment of this subtree to the stream.
+
+        - see `write_nodes()`, children are written without recursion.
+        """
+        write_nodes(fp, [self], prv, ctx)
+
+    def write_enter(self, fp: IO[Text], prv: 'Node') -> None:  # {{{1
+        """write this node before children, leaf nodes write `compose()`.
+        """
+        fp.write(self.compose(prv))
+
+    def write_leave(self, fp: IO[Text]) -> None:  # {{{1
+        """write this node after children.
+        """
+
+    def write_children(self, ctx: Any = None) -> Sequence['Node']:  # {{{1
+        """children to be written between `write_enter` and `write_leave`,
+        nodes with children override this.
+
+        - `ctx` is the conversion context of the caller, see `HierBuilder`.
+        """
+        return leaf_children
+
     def enter_only(self, f: bool) -> 'Node':  # {{{1
         self.f_enter_only = f
         return self
@@ -229,15 +775,16 @@ class Node(object):  # {{{1
     def level_flat(self) -> bool:  # {{{1
         return True
 
-    def level_diff(self, b: 'Node') -> int:  # {{{1
+    def level_diff(self, b: 'Node', ctx: Any) -> int:  # {{{1
         assert False
 
-    def append(self, nod: 'Node') -> None:  # {{{1
+    def append(self, nod: 'Node', ctx: Any = None) -> None:  # {{{1
         if self.name == "root":  # root will not have level_diff()
             dif = 0
         else:
-            dif = self.level_diff(nod)
-        debg("append: {}".format(dif))
+            dif = self.level_diff(nod, ctx)
+        if f_debug:
+            debg("append: {}".format(dif))
         # nod_dummy, n = self, self.n_level
         nod_dummy = self
         for i in range(dif - 1):
@@ -256,42 +803,81 @@ class Node(object):  # {{{1
 
 
 class NodeDmy(Node):  # {{{1
+    __slots__ = ()
+
     def __init__(self) -> None:  # {{{1
-        Node.__init__(self, "### dummy ###", {})
+        self.init_leaf("### dummy ###")
 
     def compose(self, prv: 'Node') -> Text:  # {{{1
         return ""
 
 
 class Chars(Node):  # {{{1
+    __slots__ = ("data", )
+
     def __init__(self, data: Text) -> None:  # {{{1
-        Node.__init__(self, "__chars__", {})
+        self.init_leaf("__chars__")
         self.data = data
 
+    @classmethod  # shared {{{1
+    def shared(cls, data: Text) -> 'Chars':
+        """chars node, white-spaces between elements are shared in a tree.
+        """
+        if len(data.strip()) > 0:
+            return Chars(data)
+        ret = chars_shared.get(data, None)
+        if ret is None and len(chars_shared) < 256:
+            ret = chars_shared[data] = Chars(data)
+        return ret or Chars(data)
+
     def compose(self, prv: 'Node') -> Text:
         return self.data
 
 
+chars_shared: Dict[Text, Chars] = {}
+
+
 class NodeNote(Node):  # {{{1
+    __slots__ = ("note", "f_data", )
+
     def __init__(self, note: Text) -> None:  # {{{1
         Node.__init__(self, "richcontent", {})
         self.note = note
         self.f_data = False
 
+    note_head = ('<richcontent TYPE="NOTE"><html>\n  <head>\n  </head>\n'
+                 "  <body>\n"
+                 "    <p>\n"
+                 "      <pre>\n")
+    note_tail = ("      </pre>\n"
+                 "    </p>\n"
+                 "  </body>\n"
+                 "</html></richcontent>\n")
+
     def compose(self, prv: 'Node') -> Text:  # {{{1
-        rt1 = ('<richcontent TYPE="NOTE"><html>\n  <head>\n  </head>\n'
-               "  <body>\n"
-               "    <p>\n"
-               "      <pre>\n")
-        rt2 = ("      </pre>\n"
-               "    </p>\n"
-               "  </body>\n"
-               "</html></richcontent>\n")
-        ret = rt1 + quote_xml(self.note) + rt2
+        return self.compose_buffered(prv)
+
+    def write_enter(self, fp: IO[Text], prv: 'Node') -> None:  # {{{1
+        fp.write(self.note_head)
+        fp.write(quote_xml(self.note))
+        fp.write(self.note_tail)
+
+    @classmethod  # parse {{{1
+    def parse(cls, src: Text) -> 'NodeNote':
+        """rebuild a note from the xml of a richcontent element.
+        """
+        ret = cls("")
+        parser = ParserCreate()
+        parser.StartElementHandler = ret.enter_tag
+        parser.EndElementHandler = ret.leave_tag
+        parser.CharacterDataHandler = ret.chars
+        parser.CommentHandler = lambda x: ret.chars("<!--" + x + "-->")
+        parser.buffer_text = True
+        parser.Parse(src, True)
         return ret
 
     def enter_tag(self, name: Text, attr: Dict[Text, Text]) -> None:  # {{{1
-        if name in ("html", "head", "body", "p"):
+        if name in ("richcontent", "html", "head", "body", "p"):
             return
         if name == "pre":
             self.f_data = True  # TODO(shimoda): dirty...
@@ -300,7 +886,7 @@ class NodeNote(Node):  # {{{1
         self.note += nod.compos2() + ">"
 
     def leave_tag(self, name: Text) -> None:  # {{{1
-        if name in ("html", "head", "body", "p"):
+        if name in ("richcontent", "html", "head", "body", "p"):
             return
         if name == "pre":
             self.f_data = False  # TODO(shimdoa): dirty...
@@ -312,9 +898,186 @@ class NodeNote(Node):  # {{{1
             self.note += data
 
 
+class Source(object):  # {{{1
+    """bytes of an input xml, elements in it are copied by `Splice`.
+
+    - `data` is a read-only mmap of the file or bytes of the stream.
+    """
+    def __init__(self, data: Any, key: Tuple[int, ...] = (),
+                 encoding: Text = "utf-8") -> None:
+        self.data = data
+        self.key = key  # (st_dev, st_ino) of the mapped file
+        self.encoding = encoding
+
+    @classmethod  # map {{{1
+    def map(cls, fp: IO[bytes]) -> 'Source':
+        """map a regular file to memory, or read all of the stream.
+        """
+        try:
+            st = os.fstat(fp.fileno())
+            if stat.S_ISREG(st.st_mode) and st.st_size > 0 and \
+                    fp.tell() == 0:
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                return cls(data, (st.st_dev, st.st_ino))
+        except (OSError, ValueError) as ex:  # pipes, BytesIO, ...
+            debg("src:map:{}".format(ex))
+        return cls(fp.read())
+
+    def chunks(self, size: int = 1 << 16) -> Iterator[bytes]:  # {{{1
+        for i in range(0, len(self.data), size):
+            yield self.data[i:i + size]
+
+    def detach(self, fname: Text) -> None:  # {{{1
+        """copy the data into memory if `fname` is the mapped file,
+        before the file is overwritten.
+        """
+        if len(self.key) < 1:
+            return
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return
+        if (st.st_dev, st.st_ino) == self.key:
+            self.data, self.key = self.data[:], ()
+
+
+class Splice(Node):  # {{{1
+    """an element which is written verbatim from bytes of the input.
+
+    - `start` and `end` are byte offsets of the whole element in `src`,
+      children of the element are not parsed into nodes.
+    """
+    __slots__ = ("src", "start", "end", )
+
+    pat_tag_end = re.compile(rb"""(?:[^"'>]|"[^"]*"|'[^']*')*>""")
+
+    def __init__(self, name: Text, src: Source, start: int, end: int
+                 ) -> None:  # {{{1
+        self.init_leaf(name)
+        self.src = src
+        self.start = start
+        self.end = end
+
+    @classmethod  # tag_end {{{1
+    def tag_end(cls, data: Any, n: int) -> int:
+        """the offset after the end of a start tag at `n`."""
+        mat = cls.pat_tag_end.match(data, n)
+        if mat is None:
+            raise ValueError("splice: no end of the tag at {}".format(n))
+        return mat.end()
+
+    @classmethod  # closed {{{1
+    def closed(cls, name: Text, src: Source, start: int, n: int
+               ) -> 'Splice':
+        """make a node from offsets of the start tag and the end tag,
+        expat gives `n == start` for an empty-element tag if no handler
+        of start tags is set.
+        """
+        if n == start:  # '>' may be in attributes.
+            return cls(name, src, start, cls.tag_end(src.data, start))
+        return cls(name, src, start, src.data.find(b">", n) + 1)
+
+    def compose(self, prv: 'Node') -> Text:  # {{{1
+        return self.src.data[self.start:self.end].decode(self.src.encoding)
+
+
+class SpliceScanner(object):  # {{{1
+    """find byte ranges of `Splice` for parsers without byte offsets.
+
+    - start tags of `names` are taken in the document order, markups
+      which may contain them (comments, CDATA, ...) are skipped.
+    """
+    def __init__(self, data: Any, names: Iterable[Text]) -> None:  # {{{1
+        pat = b"|".join(re.escape(i.encode("ascii")) for i in names)
+        self.data = data
+        self.it = re.compile(
+            rb"<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>|"
+            rb"<!DOCTYPE(?:[^\[>]|\[.*?\])*>|"
+            rb"<(/?)(" + pat + rb")(?=[\s/>])", re.S).finditer(data)
+
+    def tag_end(self, n: int) -> Tuple[int, bool]:  # {{{1
+        """the end of a start tag at `n` and it is an empty-element."""
+        end = Splice.tag_end(self.data, n)
+        return end, self.data[end - 2:end] == b"/>"
+
+    def range(self, name: Text) -> Tuple[int, int]:  # {{{1
+        """the byte range of the next element, its contents are skipped.
+        """
+        tag = name.encode("ascii")
+        for mat in self.it:
+            if mat.group(2) is not None:
+                break
+        else:
+            raise ValueError("splice: no more <{}>".format(name))
+        if mat.group(1) or mat.group(2) != tag:
+            raise ValueError("splice: <{}> is not found at {}".format(
+                             name, mat.start()))
+        start = mat.start()
+        end, f_empty = self.tag_end(start)
+        if f_empty:
+            return start, end
+        n = 1
+        for mat in self.it:
+            if mat.group(2) != tag:
+                continue
+            if not mat.group(1):
+                n += 0 if self.tag_end(mat.start())[1] else 1
+                continue
+            n -= 1
+            if n < 1:
+                return start, self.data.find(b">", mat.end()) + 1
+        raise ValueError("splice: </{}> is not found".format(name))
+
+
+def walk(seq: Iterable[Node],  # {{{1
+         children: Callable[[Node], Sequence[Node]] = attrgetter("children")
+         ) -> Iterator[Tuple[bool, Node]]:
+    """walk trees in depth-first order by an explicit stack.
+
+    - yields `(True, node)` before and `(False, node)` after children,
+    - `children` of a node are taken after its enter event is handled,
+      so a visitor can modify them or return nothing to skip them.
+    """
+    stack: List[Tuple[Optional[Node], Iterator[Node]]] = [(None, iter(seq))]
+    while len(stack) > 0:
+        par, it = stack[-1]
+        for nod in it:
+            yield True, nod
+            kids = children(nod)
+            if len(kids) > 0:
+                stack.append((nod, iter(kids)))
+                break
+            yield False, nod
+        else:
+            stack.pop()
+            if par is not None:
+                yield False, par
+
+
+def write_nodes(fp: IO[Text], seq: Iterable[Node],  # {{{1
+                prv: Optional[Node] = None, ctx: Any = None) -> None:
+    """write trees of nodes to the stream, see `Node.write_enter()`.
+    """
+    dmy = NodeDmy()
+    prv = dmy if prv is None else prv  # previous sibling
+    for f, nod in walk(seq, methodcaller("write_children", ctx)):
+        if f:
+            nod.write_enter(fp, prv)
+            prv = dmy
+        else:
+            nod.write_leave(fp)
+            prv = nod
+
+
 class HierBuilder(object):  # {{{1
-    def __init__(self) -> None:  # {{{1
+    """build the hierarchy of nodes by `Node.level_diff`.
+
+    - `ctx` is the conversion context, passed to nodes as it is.
+    """
+    def __init__(self, ctx: Any = None) -> None:  # {{{1
         self.cur = self.root = Node("root", {})
+        self.path: List[Node] = []  # level-stack: ancestors of cur and cur.
+        self.ctx = ctx
 
     def restruct(self, seq: List[Node]) -> List[Node]:  # {{{1
         ret: List[Node] = []
@@ -328,46 +1091,101 @@ class HierBuilder(object):  # {{{1
 
     def insert_node(self, nod: Node) -> None:  # {{{1
         cur = self.cur
-        res = nod.level_diff(cur)
-        debg("{}-{}-{}".format(res, cur, nod))
+        res = nod.level_diff(cur, self.ctx)
+        if f_debug:
+            debg("{}-{}-{}".format(res, cur, nod))
         if res == 0:
+            if len(self.path) > 0:
+                self.path_pop()
             cur.append_to_parent(nod, self.root)
+            self.path.append(nod)
         elif res < 0:  # new < cur -> drill up
             self.hier_insert_and_up(cur, nod)
         else:          # new > cur -> drill down
-            cur.append(nod)
+            cur.append(nod, self.ctx)
+            self.path.append(nod)
         self.cur = nod
 
     def hier_insert_and_up(self, cur: Node, ins: Node  # {{{1
                            ) -> None:
-        par = cur
-        while True:
-            if par.name == "root":  # root will not have level_diff()
-                break
-            if par.level_diff(ins) < 0:
-                break
-            tmp = par.parent
-            if tmp is None:  # or par.n_level < n_level_unit:
-                par = self.root
+        """insert `ins` to the nearest upper node of `cur`.
+
+        - pops the level-stack instead of walking parents, each node is
+          pushed and popped once, then insertion is amortized O(1).
+        """
+        path = self.path
+        while len(path) > 0:  # root will not have level_diff()
+            if path[-1].level_diff(ins, self.ctx) < 0:
                 break
-            par = tmp
-        par.append(ins)
+            self.path_pop()
+        par = path[-1] if len(path) > 0 else self.root
+        par.append(ins, self.ctx)
+        path.append(ins)
+
+    def path_pop(self) -> Node:  # {{{1
+        """pop a node from the level-stack, it will not have children
+        after this.
+        """
+        return self.path.pop()
 
     def mark_backup(self, seq: List[Node], sec: Text) -> None:  # {{{1
-        n = 0
-        for nod in seq:
-            if nod.name != "node":
+        secs = [[sec, 0]]  # section and number of nodes for each level
+        for f, nod in walk([i for i in seq if i.name == "node"], lambda x: [
+                i for i in x.children if i.name == "node"]):
+            if not f:
+                secs.pop()
                 continue
-            n = n + 1
-            if sec == "root":
-                if n == 1:
-                    s = "root"
-                else:  # ??? root node == 1.
-                    s = "0" + section_num_recv(n - 1)
-            else:
-                s = (sec + "-" + Text(n)).lstrip("-")
+            s = section_next(secs)
             nod.attr_replace("backup", s)
-            self.mark_backup(nod.children, s if s != "root" else "")
+
+
+class HierWriter(HierBuilder):  # {{{1
+    """build the hierarchy as HierBuilder and write nodes to the stream
+    when they are finished, written subtrees are not kept.
+    """
+    def __init__(self, fp: IO[Text], ctx: Any = None) -> None:  # {{{1
+        HierBuilder.__init__(self, ctx)
+        self.fp = fp
+        self.pending: Optional[Node] = None  # inserted, but not written
+
+    def insert_node(self, nod: Node) -> None:  # {{{1
+        HierBuilder.insert_node(self, nod)
+        par = self.pending
+        self.pending = nod
+        if par is None:
+            return
+        # the pending node got a child, write it and its own children.
+        assert nod.parent is par
+        par.write_enter(self.fp, self.sibling(par))
+        seq = list(par.write_children(self.ctx))[:-1]
+        write_nodes(self.fp, seq, None, self.ctx)
+        par.children[:] = [nod]
+
+    def sibling(self, nod: Node) -> Node:  # {{{1
+        """the previous sibling of `nod`, it was kept by `path_pop` as
+        `prv` of `Node.write_enter()`.
+        """
+        par = nod.parent if nod.parent is not None else self.root
+        seq = par.children
+        if len(seq) > 1 and seq[-1] is nod:
+            return seq[-2]
+        return NodeDmy()
+
+    def path_pop(self) -> Node:  # {{{1
+        nod = HierBuilder.path_pop(self)
+        if nod is self.pending:
+            write_nodes(self.fp, [nod], self.sibling(nod), self.ctx)
+            self.pending = None
+        else:
+            nod.write_leave(self.fp)
+        par = nod.parent if nod.parent is not None else self.root
+        par.children[:] = par.children[-1:]  # release the subtree.
+        return nod
+
+    def finish(self) -> None:  # {{{1
+        while len(self.path) > 0:
+            self.path_pop()
+
 
 # end of file {{{1
 # vi: ft=python:et:ts=4:sw=4:tw=80:fdm=marker
@@ -8,18 +8,37 @@ v.2.0. If a copy of the MPL was not distributed with this file,
 You can obtain one at https://mozilla.org/MPL/2.0/.
 '''
 from argparse import ArgumentParser
+from array import array
+import codecs
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from enum import Enum
+import glob
+from gzip import GzipFile
+from functools import lru_cache, partial
+from itertools import islice
+from io import BufferedReader, BytesIO, StringIO
 import logging
-from logging import debug as debg, warning as warn
-import tempfile
+import marshal
+import operator
+import os
+import re
+from socketserver import (BaseServer, StreamRequestHandler, TCPServer,
+                          UnixStreamServer, )
+import stat
 import sys
-from typing import (Dict, List, Optional, Text, Tuple, )
+import time
+from typing import (Any, Callable, Dict, IO, Iterable, Iterator, List,
+                    Optional, Sequence, Set, Text, Tuple, cast, )
+from xml.etree.ElementTree import XMLPullParser
 from xml.parsers.expat import ParserCreate  # type: ignore
 from zipfile import ZipFile
 
 import common as cmn
-from common import Chars, HierBuilder, Node as Nod1, NodeDmy, NodeNote
+from common import Chars, HierBuilder, Node as Nod1, NodeNote, Splice
 
+log = logging.getLogger(__name__)  # the api leaves the root logger.
+debg, warn = log.debug, log.warning
 Optional
 
 
@@ -31,9 +50,7 @@ class runmode(Enum):  # {{{1
     backup = 3
 
     def t(self) -> Text:  # {{{1
-        t = Text(self)
-        t = t.replace("runmode.", "")
-        return t
+        return self.name
 
     @classmethod  # choices {{{1
     def choices(cls) -> List[Text]:
@@ -50,6 +67,32 @@ class runmode(Enum):  # {{{1
                 return i
         raise KeyError("'{}' is not a mode in {}".format(src, cls.choices()))
 
+    @classmethod  # parse_list {{{1
+    def parse_list(cls, src: Text) -> List['runmode']:
+        ret: List[runmode] = []
+        for i in src.split(","):
+            mode = cls.parse(i.strip())
+            if mode not in ret:
+                ret.append(mode)
+        return ret
+
+
+class Context(object):  # {{{1
+    """settings of a conversion, passed to nodes and builders instead of
+    class attributes, then conversions can run concurrently in a process.
+    """
+    def __init__(self, mode: runmode = runmode.through,  # {{{1
+                 convert_backup: Text = "", f_no_backup: bool = False,
+                 parser: Text = "expat") -> None:
+        self.mode = mode  # sort nodes by levels of this attribute.
+        self.convert_backup = convert_backup  # rename `backup`, see -c
+        self.f_no_backup = f_no_backup  # remove `backup`, see -B
+        self.parser = parser  # a name of parser_backends, see --parser
+
+    def with_mode(self, mode: runmode) -> 'Context':  # {{{1
+        return Context(mode, self.convert_backup, self.f_no_backup,
+                       self.parser)
+
 
 class options(object):  # {{{1
     def __init__(self) -> None:  # {{{1
@@ -57,8 +100,23 @@ class options(object):  # {{{1
         self.fname_zip = ""
         self.fname_out = ""
         self.mode = runmode.through
+        self.outputs: List[Tuple[runmode, Text]] = []
         self.n_output_markdown = False
         self.f_disable_script = False
+        self.f_profile = False
+        self.fname_profile = ""
+        self.f_override = False
+        self.modes: List[runmode] = []
+        self.batch: List[Text] = []
+        self.n_jobs = 0
+        self.serve = ""
+        self.n_script_server = 0
+        self.cache: Optional[cmn.FileCache] = None
+        self.f_incremental = False
+        self.n_memory_budget = 0
+        self.ctx = Context()
+        self.f_threads = False
+        self.f_verbose = False
 
     @classmethod  # parser {{{1
     def parser(cls) -> ArgumentParser:  # {{{1
@@ -69,101 +127,180 @@ class options(object):  # {{{1
         arg.add_argument("-S", "--disable-script", action="store_true")
         arg.add_argument("-M", "--output-markdown", type=int, default=-1)
         arg.add_argument("-f", "--override", action="store_true")
-        arg.add_argument("-m", "--mode", choices=runmode.choices(),
-                         default=runmode.through.t())
+        arg.add_argument("-m", "--mode", default=runmode.through.t(),
+                         help="{} or a comma separated list of them".format(
+                             ", ".join(runmode.choices())))
         arg.add_argument("-z", "--input-zip-name", default="")
+        arg.add_argument("-v", "--verbose", action="store_true")
+        arg.add_argument("--profile", action="store_true",
+                         help="report time and memory of each phase")
+        arg.add_argument("--profile-json", default="",
+                         help="write the --profile report to a json file")
+        arg.add_argument("--batch", action="append", default=[],
+                         help="convert .mm files in a directory tree or "
+                              "matched to a glob pattern")
+        arg.add_argument("-j", "--jobs", type=int, default=0,
+                         help="number of processes for --batch")
+        arg.add_argument("--threads", action="store_true",
+                         help="run --batch on threads of this process")
+        arg.add_argument("--serve", default="",
+                         help="run as a conversion server on "
+                              "[host:]port or a unix socket path")
+        arg.add_argument("--script-server", type=int, default=0,
+                         help="the node script requests to --serve "
+                              "on this port")
+        arg.add_argument("--cache-dir", default="",
+                         help="cache parsed trees in this directory")
+        arg.add_argument("--cache-size", type=int, default=256,
+                         help="size limit of --cache-dir in MB")
+        arg.add_argument("--incremental", action="store_true",
+                         help="keep the order of nodes in --cache-dir "
+                              "and sort only changed nodes at next time")
+        arg.add_argument("--memory-budget", type=int, default=0,
+                         help="restructure in this MB of memory with "
+                              "sorted runs in temporary files")
+        arg.add_argument("--parser", default="expat",
+                         choices=list(parser_backends) + ["auto"],
+                         help="xml parser, auto to pick the fastest one "
+                              "by a benchmark")
         arg.add_argument("input_xml", type=Text, nargs="?")
         return arg
 
     @classmethod  # parse {{{1
     def parse(cls, args: List[Text]) -> 'options':
-        logging.basicConfig(level=logging.DEBUG)
         ret = options()
-        opts = ret.parser().parse_args(args)
+        arg = ret.parser()
+        opts = arg.parse_args(args)
+        ret.f_verbose = opts.verbose
+        ret.f_profile = opts.profile or len(opts.profile_json) > 0
+        ret.fname_profile = opts.profile_json
         ret.fname_out = opts.output
-        ret.fname_xml = opts.input_xml
-        ret.mode = runmode.parse(opts.mode)
+        ret.fname_xml = opts.input_xml or ""
+        try:
+            modes = runmode.parse_list(opts.mode)
+        except KeyError as ex:
+            arg.error(Text(ex))
+        ret.mode, ret.modes = modes[0], modes
+        ret.f_override = opts.override
+        ret.batch = opts.batch
+        ret.n_jobs = opts.jobs
+        ret.f_threads = opts.threads
+        ret.serve = opts.serve
+        if len(ret.serve) > 0:
+            try:
+                cmn.serve_address(ret.serve)
+            except ValueError as ex:
+                arg.error("--serve: {}".format(ex))
+        ret.n_script_server = opts.script_server
+        ret.f_incremental = opts.incremental
+        if ret.f_incremental and len(opts.cache_dir) < 1:
+            arg.error("--incremental needs --cache-dir")
+        ret.n_memory_budget = opts.memory_budget * 1024 * 1024
+        if len(opts.cache_dir) > 0:
+            ret.cache = cmn.FileCache(opts.cache_dir,
+                                      opts.cache_size * 1024 * 1024)
         ret.n_output_markdown = opts.output_markdown
         ret.f_disable_script = opts.disable_script
-        FMNode.f_no_backup = opts.remove_backup
-        FMNode.convert_backup = opts.convert_backup
+        ret.ctx = Context(convert_backup=opts.convert_backup,
+                          f_no_backup=opts.remove_backup,
+                          parser=opts.parser)
         src = ret.fname_zip = opts.input_zip_name
         if not isinstance(src, Text):
             src = ""
         sfx = ".mm" if not (ret.n_output_markdown >= 0) else ".md"
         if len(ret.fname_out) > 0:
             src = ret.fname_out
-            ret.fname_out = cmn.number_output(opts.override, src, sfx)
-            return ret
-        if len(src) < 1:
+        elif len(src) < 1:
             src = ret.fname_xml
-        if len(src) < 1:
-            ret.fname_out = "/dev/stdout"
-        else:
-            ret.fname_out = cmn.number_output(opts.override, src, sfx)
+            src = src[:-3] if src.endswith(".gz") else src
+        if (len(modes) > 1 and len(ret.batch) < 1 and
+                (len(src) < 1 or src == "-")):  # maps are not one xml.
+            arg.error("several modes can not be written to stdout, "
+                      "use -o")
+        for mode in modes:
+            if len(src) < 1 or src == "-":
+                fname = "/dev/stdout"
+            elif len(modes) < 2:
+                fname = cmn.number_output(opts.override, src, sfx)
+            else:  # one file per mode: sample-doc.mm, sample-test.mm, ...
+                fname = cmn.number_output(opts.override, src,
+                                          "-" + mode.t() + sfx)
+            ret.outputs.append((mode, fname))
+        ret.fname_out = ret.outputs[0][1]
         return ret
 
 
 class Node(Nod1):  # {{{1
     # {{{1
-    convert_backup = ""
+    __slots__ = ()
 
     def copy(self, include_children: bool=False) -> Nod1:  # {{{1
-        ret = Node(self.name, self.attr)
+        if not include_children and len(self.children) < 1:
+            return Node.leaf(self.name, dict(self.attr))
+        ret = Node(self.name, dict(self.attr))
         if include_children:
             ret.children = self.children + []
         return ret
 
-    key_attr_mode = runmode.through
+    def flattern(self, ctx: Context, sec: Text, exclude_self: bool  # {{{1
+                 ) -> List[Nod1]:
+        """copy this node and descendant FreeMind nodes in pre-order,
+        with their sections in the tree as `backup` attribute.
+        """
+        ret: List[Nod1] = []
+        kids: List[Nod1] = []  # FreeMind nodes in children of the last node
+        secs = [[sec]]  # sections of the nodes for each level
+        for f, nod in cmn.walk([self], lambda x: kids):
+            if not f:
+                secs.pop()
+                continue
+            sec = secs[-1].pop()
+            dmy = cast(Node, nod).flatten_copy(ctx, sec)
+            if nod is not self or not exclude_self:
+                ret.append(dmy)
+            kids = [i for i in nod.children if isinstance(i, FMNode)]
+            subs = [(sec + "-" + Text(i)).lstrip("-")
+                    for i in range(len(kids), 0, -1)]
+            secs.append(subs)
+            if cmn.f_debug:
+                debg("flat:{}-{}".format(dmy, len(ret)))
+        return ret
 
-    def flattern(self, sec: Text, exclude_self: bool) -> List[Nod1]:  # {{{1
+    def flatten_copy(self, ctx: Context, sec: Text) -> Nod1:  # {{{1
+        """copy this node without child FreeMind nodes,
+        with its section `sec` in the tree as `backup` attribute.
+        """
         dmy = self.copy()
-        n, ret = 1, [dmy]
-        if exclude_self:
-            ret.clear()
         for i in self.children:
-            if not isinstance(i, FMNode):
-                dmy.children.append(i)
+            if isinstance(i, FMNode):
                 continue
-            n, sec0 = n + 1, (sec + "-" + Text(n)).lstrip("-")
-            ret.extend(i.flattern(sec0, exclude_self=False))
+            if isinstance(i, Node) and i.name == "attribute":
+                i = i.copy()  # per-mode view, do not touch the tree.
+            dmy.append_child(i)
         Node.rtrim_enter(dmy.children)
-        if self.key_attr_mode != runmode.backup:
+        if ctx.mode != runmode.backup:
             dmy.attr_replace("backup", sec if sec != "" else "root")
-        if Node.convert_backup:
-            dmy.attr_change_name(runmode.backup.t(), Node.convert_backup)
-        warn("flat:{}-{}".format(dmy, len(ret)))
-        return ret
-
-    @classmethod  # key_attr {{{1
-    def key_attr(cls, a: Nod1) -> int:
-        # TODO(kuriyama): from section_num_to_int
-        N, U = cmn.lvl_cls, cmn.lvl_max + 1
-        ret = 0
-        if False:  # special case...
-            pass
-        else:
-            lv = cls.level(a, cls.key_attr_mode) + (0, ) * N
-            ret = 0
-            for i in range(N):
-                ret = ret * U + lv[i]
-        warn("nod'{:20}'-lv{:42d}".format(Text(a), ret))
-        return ret
+        if ctx.convert_backup:
+            dmy.attr_change_name(runmode.backup.t(), ctx.convert_backup)
+        return dmy
 
     @classmethod  # level {{{1
     def level(cls, self: Nod1, mode: runmode) -> Tuple[int, ...]:
         t = mode.t()
-        src = ""
-        for node in self.children:
-            if node.name != "attribute":
-                continue
-            src = node.attr.get("NAME", "")
-            if src != t:
-                continue
-            src = node.attr.get("VALUE", "")
-            break
-        else:
+        ret = self.level_cache.get(t, None)
+        if ret is not None:
+            return ret
+        node = self.attr_node(t)
+        if node is None:  # no cache for leaf nodes.
+            return (cmn.lvl_max, )
+        ret = self.level_cache[t] = cls.level_parse(node)
+        return ret
+
+    @classmethod  # level_parse {{{1
+    def level_parse(cls, node: Optional[Nod1]) -> Tuple[int, ...]:
+        if node is None:
             return (cmn.lvl_max, )
+        src = node.attr.get("VALUE", "")
         if src == "root":
             return cmn.lvl_root
         src = src.replace(",", "-")  # allow ',' and '-' to splitter.
@@ -171,39 +308,49 @@ class Node(Nod1):  # {{{1
         ret = tuple(cmn.section_num_to_int(i) for i in seq)
         return ret
 
-    @classmethod  # is_enter {{{1
-    def is_enter(cls, self: Nod1) -> bool:
+    @classmethod  # n_enters {{{1
+    def n_enters(cls, self: Nod1) -> int:
+        """count trailing enters of coalesced chars, returns -1 if some
+        other characters are found before them.
+        """
         if not isinstance(self, Chars):
-            return False
-        if self.data != "\n":
-            return False
-        return True
+            return -1
+        src = self.data.rstrip("\n")
+        n = len(self.data) - len(src)
+        return n if len(src) < 1 else -1 - n
 
     @classmethod  # rtrim_enter {{{1
     def rtrim_enter(cls, seq: List[Nod1]) -> None:
+        """leave only one enter at the end of children.
+        """
         n = 0
-        rev = seq + []
-        rev.reverse()
-        for i in rev:
-            if not cls.is_enter(i):
+        for i in reversed(seq):
+            m = cls.n_enters(i)
+            if m < 0:
+                n += -1 - m
                 break
-            n += 1
+            n += m
         if n == 0:
-            seq.append(Chars('\n'))
-            return
-        if n == 1:
+            seq.append(cmn.Chars.shared("\n"))
             return
-        for j in range(n - 1):
-            del seq[-1]
+        n -= 1
+        while n > 0:
+            data = cast(Chars, seq[-1]).data
+            if len(data) <= n:
+                del seq[-1]
+                n -= len(data)
+                continue
+            seq[-1] = cmn.Chars.shared(data[:-n])
+            break
 
-    def level_diff(self, b: Nod1) -> int:  # {{{1
+    def level_diff(self, b: Nod1, ctx: Context) -> int:  # {{{1
         if b.name == "root":
             return 1
         if not isinstance(b, Node):
             return 0
 
         def lvl(a: 'Node') -> int:
-            ret = len(self.level(a, self.key_attr_mode))
+            ret = len(self.level(a, ctx.mode))
             ret += 1
             ret = 0 if ret < 0 else ret
             return 100 * ret
@@ -211,13 +358,16 @@ class Node(Nod1):  # {{{1
         lvl_a = lvl(self)
         lvl_b = lvl(b)
         ret = round((lvl_a - lvl_b) / 100)
-        warn("nod2:diff:{}-{}-{}".format(ret, self, b))
+        if cmn.f_debug:
+            debg("nod2:diff:{}-{}-{}".format(ret, self, b))
         return ret
 
 
 class Comment(Nod1):  # {{{1
+    __slots__ = ("data", )
+
     def __init__(self, data: Text) -> None:  # {{{1
-        Node.__init__(self, "__comment__", {})
+        self.init_leaf("__comment__")
         self.data = data
 
     def compose(self, prv: Nod1) -> Text:  # {{{1
@@ -225,8 +375,10 @@ class Comment(Nod1):  # {{{1
 
 
 class LNode(Node):  # {{{1
+    __slots__ = ()
+
     def __init__(self, name: Text) -> None:  # {{{1
-        Node.__init__(self, "leave - " + name, {})
+        self.init_leaf("leave - " + name)
 
     def compose(self, prv: Nod1) -> Text:  # {{{1
         return "</" + self.name.replace("leave - ", "") + ">"
@@ -234,14 +386,16 @@ class LNode(Node):  # {{{1
 
 class FMNode(Node):  # {{{1
     # {{{1
-    f_no_backup = False
+    __slots__ = ("text", "id_string", "position", "ts_create", "ts_modify", )
 
     def __init__(self, attrs: Dict[Text, Text]) -> None:  # {{{1
         Node.__init__(self, "node", attrs)
         self.parent: Optional[FMNode] = None
         self.text = attrs.get("TEXT", "")
         self.id_string = attrs.get("ID", "ID_0")
-        self.position = attrs.get("POSITION", "")
+        self.position = sys.intern(attrs.get("POSITION", ""))
+        if self.position:
+            attrs["POSITION"] = self.position
         self.ts_create = int(attrs.get("CREATED", "-1"))
         self.ts_modify = int(attrs.get("MODIFIED", "-1"))
 
@@ -257,51 +411,390 @@ class FMNode(Node):  # {{{1
         return ret
 
     def compose(self, prv: Nod1) -> Text:  # {{{1
-        debg("compose:node:" + self.id_string)
-        ret = '<node CREATED="{}" ID="{}" MODIFIED="{}"'.format(
-                self.ts_create, self.id_string, self.ts_modify)
+        return self.compose_buffered(prv)
+
+    def write_enter(self, fp: IO[Text], prv: Nod1) -> None:  # {{{1
+        if cmn.f_debug:
+            debg("compose:node:" + self.id_string)
+        fp.write('<node CREATED="{}" ID="{}" MODIFIED="{}"'.format(
+                 self.ts_create, self.id_string, self.ts_modify))
         if self.position:
-            ret += ' POSITION="{}"'.format(self.position)
-        ret += ' TEXT="{}"'.format(cmn.quote_attr(self.text))
+            fp.write(' POSITION="{}"'.format(self.position))
+        fp.write(' TEXT="{}"'.format(cmn.quote_attr(self.text)))
         if len(self.children) < 1:
-            ret += "/>\n"
-        else:
-            ret += ">"
-            prv_child: Nod1 = NodeDmy()
-            for nod in self.children:
-                if self.f_no_backup and (nod.name == "attribute" and
-                                         nod.attr["NAME"] == "backup"):
-                    continue
-                ret += nod.compose(prv_child)
-                prv_child = nod
-            ret += '</node>\n'
-        return ret
+            fp.write("/>\n")
+            return
+        fp.write(">")
+
+    def write_leave(self, fp: IO[Text]) -> None:  # {{{1
+        if len(self.children) > 0:
+            fp.write('</node>\n')
+
+    def write_children(self, ctx: Optional[Context] = None  # {{{1
+                       ) -> Sequence[Nod1]:
+        return self.filter_backup(self.children, ctx)
+
+    @classmethod  # filter_backup {{{1
+    def filter_backup(cls, seq: Sequence[Nod1], ctx: Optional[Context]
+                      ) -> Sequence[Nod1]:
+        """remove `backup` attributes from children to write, see `-B`.
+        """
+        if ctx is None or not ctx.f_no_backup:
+            return seq
+        return [nod for nod in seq
+                if not (nod.name == "attribute" and
+                        nod.attr["NAME"] == "backup")]
 
     def level_flat(self) -> bool:  # {{{1
         return False
 
 
+class ParserExpat(object):  # {{{1
+    """call handlers of `FMXml` from callbacks of expat, the default.
+
+    - a parser backend has `parse(src)` and `splice(name)`, which is
+      called at the start of an element to be copied as `Splice`.
+    """
+    def __init__(self, xml: 'FMXml') -> None:  # {{{1
+        self.xml = xml
+        self.parser = ParserCreate()
+        self.splice_name = ""  # the element in parsing, see handlers()
+        self.splice_start = 0
+
+    def parse(self, src: cmn.Source) -> None:  # {{{1
+        parser = self.parser
+        self.handlers(False)
+        parser.XmlDeclHandler = self.xml.enter_decl
+        parser.buffer_text = True  # coalesce chars between elements.
+        for data in src.chunks():
+            parser.Parse(data, False)
+        parser.Parse(b"", True)
+
+    def handlers(self, f_splice: bool) -> None:  # {{{1
+        """set handlers of the parser, only the end of a spliced element
+        is handled in it, FreeMind does not nest them in the same name.
+        """
+        parser, xml = self.parser, self.xml
+        if f_splice:
+            parser.StartElementHandler = None
+            parser.EndElementHandler = self.splice_leave
+            parser.CharacterDataHandler = None
+            parser.CommentHandler = None
+            return
+        parser.StartElementHandler = xml.enter_tag
+        parser.EndElementHandler = xml.leave_tag
+        parser.CharacterDataHandler = xml.enter_chars
+        parser.CommentHandler = xml.enter_comment
+
+    def splice(self, name: Text) -> None:  # {{{1
+        self.splice_name = name
+        self.splice_start = self.parser.CurrentByteIndex
+        self.handlers(True)
+
+    def splice_leave(self, name: Text) -> None:  # {{{1
+        if name != self.splice_name:
+            return
+        xml = self.xml
+        assert xml.src is not None
+        xml.cur.append_child(Splice.closed(
+                name, xml.src, self.splice_start,
+                self.parser.CurrentByteIndex))
+        self.handlers(False)
+
+
+class ParserPull(object):  # {{{1
+    """call handlers of `FMXml` from elements of ElementTree, which are
+    built in C and taken by a chunk of the input at once.
+
+    - a text or a tail of elements is passed before the next event,
+      the input is cut after comments to pass texts before them.
+    - children of an element are removed at its end.
+    - offsets of splices are found by `cmn.SpliceScanner`.
+    """
+    pat_decl = re.compile(rb"""<\?xml[^>]*?encoding=["']([^"']*)""")
+
+    def __init__(self, xml: 'FMXml') -> None:  # {{{1
+        self.xml = xml
+        self.elem: Any = None  # the element in `FMXml.enter_tag`
+        self.skip: Any = None  # the spliced element
+        self.scanner: Optional[cmn.SpliceScanner] = None
+
+    def parse(self, src: cmn.Source) -> None:  # {{{1
+        xml = self.xml
+        head = bytes(src.data[:256])
+        mat = self.pat_decl.search(head)
+        if head.startswith((b"\xff\xfe", b"\xfe\xff")):
+            xml.src = None  # not scanned in utf-16.
+        elif mat is not None:
+            xml.enter_decl("1.0", mat.group(1).decode("ascii"), -1)
+        if xml.src is not None:
+            self.scanner = cmn.SpliceScanner(src.data, xml.splice_tags)
+        parser: XMLPullParser[Any] = XMLPullParser(
+                events=("start", "end", "comment"))
+        stack: List[List[Any]] = []  # [element, the last child, used]
+        for data in self.chunks(src.data):
+            parser.feed(data)
+            self.events(parser.read_events(), stack)
+        parser.close()
+        self.events(parser.read_events(), stack)
+
+    @classmethod  # chunks {{{1
+    def chunks(cls, data: Any, size: int = 1 << 16) -> Iterator[bytes]:
+        """chunks of the input, cut after ends of comments."""
+        n, N = 0, len(data)
+        while n < N:
+            m = min(n + size, N)
+            i = data.find(b"-->", n, m + 2)
+            m = m if i < 0 else i + 3
+            yield data[n:m]
+            n = m
+
+    def events(self, seq: Iterable[Tuple[Any, ...]],  # {{{1
+               stack: List[List[Any]]) -> None:
+        xml = self.xml
+        for ev, elem in seq:
+            if self.skip is not None:
+                if ev == "end" and elem is self.skip:
+                    self.skip = None
+                    del elem[:]
+                continue
+            if len(stack) > 0:
+                self.chars(stack[-1])
+            if ev == "end":
+                stack.pop()
+                xml.leave_tag(elem.tag)
+                del elem[:]
+                continue
+            if ev == "comment":
+                xml.enter_comment(elem.text)
+                continue
+            if len(stack) > 0:
+                stack[-1][1:] = [elem, 0]
+            stack.append([elem, None, 0])
+            self.elem = elem
+            xml.enter_tag(elem.tag, elem.attrib)
+            if self.skip is elem:
+                stack.pop()
+
+    def chars(self, ent: List[Any]) -> None:  # {{{1
+        """pass the text of an element or the tail of the last child,
+        a part of it was passed before a comment.
+        """
+        text = ent[0].text if ent[1] is None else ent[1].tail
+        if text and len(text) > ent[2]:
+            self.xml.enter_chars(text[ent[2]:])
+            ent[2] = len(text)
+
+    def splice(self, name: Text) -> None:  # {{{1
+        xml = self.xml
+        assert xml.src is not None and self.scanner is not None
+        start, end = self.scanner.range(name)
+        xml.cur.append_child(Splice(name, xml.src, start, end))
+        self.skip = self.elem
+
+
+parser_backends: Dict[Text, Any] = OrderedDict(expat=ParserExpat)
+try:
+    XMLPullParser(events=("comment", ))  # python3.8 or later.
+    parser_backends["etree"] = ParserPull
+except ValueError:
+    pass
+
+
 class FMXml(object):  # {{{1
+    # elements not changed by restructuring, copied from the input.
+    splice_tags = ("arrowlink", "cloud", "edge", "font", "hook", "icon",
+                   "linktarget", "richcontent", )
+
     def __init__(self) -> None:  # {{{1
         self.cur = self.root = FMNode({})
         self.cur_rich: Optional[NodeNote] = None
+        self.src: Optional[cmn.Source] = None
+        self.parser: Any = None  # the backend in parsing.
         self.n_output_markdown = -1
         self.f_disable_script = False
+        self.n_nodes = 0
+        self.n_script_server = 0
+        self.fname_order = ""  # the input to reuse orders, restruct_sort
+        self.cache: Optional[cmn.FileCache] = None  # keeps the orders
+        self.prof = cmn.Profiler(False)
+        self.ctx = Context()
 
     @classmethod  # parse {{{1
-    def parse(cls, fname: Text) -> 'FMXml':
-        """parse Nodes from xml.
+    def parse(cls, fname: Text, cache: Optional[cmn.FileCache] = None,
+              ctx: Optional[Context] = None) -> 'FMXml':
+        """parse Nodes from xml, `-` to read from stdin.
+
+        - load the tree from `cache` if the file was not changed.
+        - `ctx` is set to the result, its parser is used.
         """
-        ret = FMXml()
-        parser = ParserCreate()
-        parser.StartElementHandler = ret.enter_tag
-        parser.EndElementHandler = ret.leave_tag
-        parser.CharacterDataHandler = ret.enter_chars
-        parser.CommentHandler = ret.enter_comment
+        if fname == "-":
+            return cls.parse_stream(sys.stdin.buffer, ctx)
+        if cache is None:
+            with open(fname, "rb") as fp:
+                return cls.parse_stream(fp, ctx)
         with open(fname, "rb") as fp:
-            parser.ParseFile(fp)
+            data = fp.read()
+        ent = cache.load(fname, data)
+        if ent is not None:
+            with cmn.gc_paused():
+                ret = cls.from_table(ent[1], cmn.Source(data, (), ent[0]))
+            if ctx is not None:
+                ret.ctx = ctx
+            return ret
+        ret = cls.parse_stream(BytesIO(data), ctx)
+        enc = "" if ret.src is None else ret.src.encoding
+        cache.store(fname, data, (enc, ret.to_table()))
+        return ret
+
+    def to_table(self) -> List[Tuple[Any, ...]]:  # {{{1
+        """flatten the parsed tree into a pre-order table of tuples.
+        """
+        return self.table_rows(self.root)
+
+    @classmethod  # table_rows {{{1
+    def table_rows(cls, root: Nod1) -> List[Tuple[Any, ...]]:
+        ret: List[Tuple[Any, ...]] = []
+        seq: List[Nod1] = [root]
+        while len(seq) > 0:
+            nod = seq.pop()
+            if isinstance(nod, FMNode):
+                ret.append(("n", nod.attr, len(nod.children)))
+                seq.extend(reversed(nod.children))
+                continue
+            assert len(nod.children) < 1
+            if isinstance(nod, Chars):
+                ret.append(("c", nod.data))
+            elif isinstance(nod, Comment):
+                ret.append(("m", nod.data))
+            elif isinstance(nod, NodeNote):
+                ret.append(("r", nod.note))
+            elif isinstance(nod, LNode):
+                ret.append(("l", nod.name))
+            elif isinstance(nod, Splice):
+                ret.append(("s", nod.name, nod.start, nod.end))
+            else:
+                ret.append(("e", nod.name, dict(nod.attr), nod.f_enter_only))
+        return ret
+
+    @classmethod  # from_table {{{1
+    def from_table(cls, seq: List[Tuple[Any, ...]], src: cmn.Source
+                   ) -> 'FMXml':
+        ret = FMXml()
+        ret.src = src
+        ret.cur = ret.root = cls.table_tree(seq, src)
+        ret.n_nodes = sum(1 for i in seq if i[0] == "n") - 1
+        return ret
+
+    @classmethod  # table_tree {{{1
+    def table_tree(cls, seq: List[Tuple[Any, ...]],
+                   src: Optional[cmn.Source]) -> 'FMNode':
+        """build a tree from rows of `table_rows`, returns the root.
+
+        - `src` is the input which spliced elements refer to.
+        """
+        ret: Optional[FMNode] = None
+        stack: List[List[Any]] = []  # [FMNode, number of left children]
+        for ent in seq:
+            kind = ent[0]
+            if kind == "n":
+                nod: Nod1 = FMNode(ent[1])
+            elif kind == "c":
+                nod = cmn.Chars.shared(ent[1])
+            elif kind == "m":
+                nod = Comment(ent[1])
+            elif kind == "r":
+                nod = NodeNote(ent[1])
+            elif kind == "l":
+                nod = LNode(ent[1].replace("leave - ", ""))
+            elif kind == "s":
+                assert src is not None
+                nod = Splice(ent[1], src, ent[2], ent[3])
+            elif ent[3]:  # map
+                nod = Node(ent[1], ent[2]).enter_only(True)
+            else:
+                if "NAME" in ent[2]:
+                    ent[2]["NAME"] = sys.intern(ent[2]["NAME"])
+                nod = Node.leaf(ent[1], ent[2])
+            if len(stack) < 1:
+                assert isinstance(nod, FMNode)
+                ret = nod
+                stack.append([nod, ent[2]])
+                continue
+            par = stack[-1]
+            par[0].children.append(nod)
+            par[1] -= 1
+            if kind == "n":
+                nod.parent = par[0]
+                stack.append([nod, ent[2]])
+            elif kind == "e":
+                par[0].attr_index_add(nod)
+            while len(stack) > 0 and stack[-1][1] < 1:
+                stack.pop()
+        assert ret is not None
         return ret
 
+    @classmethod  # parse_stream {{{1
+    def parse_stream(cls, fp: IO[bytes], ctx: Optional[Context] = None
+                     ) -> 'FMXml':
+        """parse Nodes from a binary stream of xml or gzipped xml.
+        """
+        ret = FMXml()
+        if ctx is not None:
+            ret.ctx = ctx
+        ret.feed_stream(fp)
+        return ret
+
+    def feed_stream(self, fp: IO[bytes]) -> None:  # {{{1
+        self.feed_source(self.source(fp))
+
+    @classmethod  # source {{{1
+    def source(cls, fp: IO[bytes]) -> cmn.Source:
+        """map the input to memory, or read a gzipped one.
+        """
+        if not hasattr(fp, "peek"):
+            fp = BufferedReader(fp)  # type: ignore
+        if fp.peek(2)[:2] == b"\x1f\x8b":  # type: ignore  # gzip magic
+            return cmn.Source(GzipFile(fileobj=fp, mode="rb").read())
+        return cmn.Source.map(fp)
+
+    def feed_source(self, src: cmn.Source) -> None:  # {{{1
+        self.src = src
+        self.parser = parser_backend(self.ctx.parser)(self)
+        self.parser.parse(src)
+        self.parser = None
+
+    def enter_decl(self, version: Text, encoding: Optional[Text],
+                   standalone: int) -> None:  # {{{1
+        if self.src is None or not encoding:
+            return
+        try:
+            self.src.encoding = codecs.lookup(encoding).name
+        except LookupError:
+            warn("parse:unknown encoding {}, no splices".format(encoding))
+            self.src = None
+
+    @classmethod  # parse_zip {{{1
+    def parse_zip(cls, fname: Text, ctx: Optional[Context] = None
+                  ) -> Optional['FMXml']:
+        """parse Nodes from the first file in a zip archive.
+        """
+        try:
+            debg("zip:" + fname)
+            zf = ZipFile(fname)
+        except Exception as ex:
+            debg("zip:" + fname + "->" + Text(ex))
+            return None
+
+        with zf:
+            for zi in zf.infolist():
+                debg("found entry {}".format(zi))
+                if zi.is_dir():  # type: ignore  # no `is_dir` in python2
+                    continue
+                with zf.open(zi) as fp:
+                    return cls.parse_stream(fp, ctx)
+        return None
+
     def enter_tag(self, name: Text, attrs: Dict[Text, Text]) -> None:  # {{{1
         if name == "node":
             self.f_header = False
@@ -309,19 +802,28 @@ class FMXml(object):  # {{{1
             node.parent = self.cur
             self.cur.children.append(node)
             self.cur = node
-            debg("new node:" + node.id_string)
+            self.n_nodes += 1
+            if cmn.f_debug:
+                debg("new node:" + node.id_string)
             return
         if self.cur_rich is not None:
             self.cur_rich.enter_tag(name, attrs)
             return
+        elif name in self.splice_tags and self.src is not None:
+            self.parser.splice(name)
+            return
         elif name == "map":  # TODO(shimoda): dirty, change parse procedures.
             nod: Nod1 = Node(name, attrs)
             nod.f_enter_only = True
+        elif name == "attribute":
+            if "NAME" in attrs:  # doc, test, backup, ... are shared.
+                attrs["NAME"] = sys.intern(attrs["NAME"])
+            nod = Node.leaf(name, attrs)
         elif name != "richcontent":
-            nod = Node(name, attrs)
+            nod = Node.leaf(name, attrs)
         else:
             nod = self.cur_rich = NodeNote("")
-        self.cur.children.append(nod)
+        self.cur.append_child(nod)
 
     def leave_tag(self, name: Text) -> None:  # {{{1
         if self.cur_rich is not None:
@@ -332,7 +834,8 @@ class FMXml(object):  # {{{1
             return
         if name == "node":
             assert self.cur.parent is not None
-            debg("cls node:" + self.cur.id_string)
+            if cmn.f_debug:
+                debg("cls node:" + self.cur.id_string)
             self.cur = self.cur.parent
             return
         nod = self.cur.children[-1]
@@ -347,10 +850,12 @@ class FMXml(object):  # {{{1
             return
         seq = self.cur.children
         if len(seq) > 0 and isinstance(seq[-1], FMNode):
-            if len(data.strip()) < 1:
+            src = data.lstrip()
+            if len(src) < 1:
                 return  # ignore white-spaces.
-        nod = Chars(data)
-        self.cur.children.append(nod)
+            # ignore white-space lines before texts.
+            data = data[data.rfind("\n", 0, len(data) - len(src)) + 1:]
+        seq.append(cmn.Chars.shared(data))
 
     def enter_comment(self, data: Text) -> None:  # {{{1
         if self.cur_rich is not None:
@@ -359,82 +864,135 @@ class FMXml(object):  # {{{1
         nod = Comment(data)
         self.cur.children.append(nod)
 
+    def output_modes(self, outputs: List[Tuple[runmode, Text]]  # {{{1
+                     ) -> int:
+        """output several modes from this parsed tree.
+
+        - restruct modes work on copies of the attributes,
+        - through mode stamps `backup` to the tree itself,
+          so it is processed at the last.
+        """
+        seq = [i for i in outputs if i[0] != runmode.through]
+        seq += [i for i in outputs if i[0] == runmode.through]
+        ret = 0
+        for mode, fname in seq:
+            ret = self.output(fname, mode) or ret
+        return ret
+
     def output(self, fname: Text, mode: runmode) -> int:  # {{{1
         debg("out:open:" + fname)
+        seq = self.output_tree(mode)
+        if self.src is not None:
+            self.src.detach(fname)
+        with self.prof.phase("write", mode.t()) as rec, \
+                cmn.open_output(fname) as fp:
+            rec["nodes"] = self.n_nodes
+            return self.output_fp(fp, seq)
+
+    def output_tree(self, mode: runmode) -> List[Nod1]:  # {{{1
+        """nodes to output in `mode`, through mode stamps `backup` to
+        the tree itself.
+        """
         if mode == runmode.through:
             seq = self.root.children
             HierBuilder().mark_backup(seq, "root")
-        else:
-            seq = self.restruct(mode)
+            return seq
+        return self.restruct(mode)
+
+    def output_fp(self, fp: IO[Text], seq: List[Nod1]) -> int:  # {{{1
+        """write nodes as xml or markdown by `n_output_markdown`."""
         if self.n_output_markdown >= 0:
-            with open(fname, "wt") as fp:
-                fp.write("")
-            return self.output_markdown(fname, seq, self.n_output_markdown)
-        with open(fname, "wt") as fp:
-            prv: Nod1 = NodeDmy()
-            for node in seq:
-                text = node.compose(prv)
-                debg("out:" + text)
-                fp.write(text)
-                prv = node
+            return self.output_markdown(fp, seq, self.n_output_markdown)
+        return self.output_stream(fp, seq)
+
+    def output_stream(self, fp: IO[Text], seq: List[Nod1]) -> int:  # {{{1
+        cmn.write_nodes(fp, seq, None, self.ctx)
         return 0
 
-    def output_markdown(self, fname: Text, seq: List[Nod1],  # {{{1
+    def output_markdown(self, fp: IO[Text], seq: List[Nod1],  # {{{1
                         depth: int) -> int:
-        def out_node(nod: Nod1, f: bool) -> bool:
-            with open(fname, "at") as fp:
-                if nod.name == "node":
-                    title = ("#" * depth) + " " + nod.attr.get("TEXT", "")
-                    fp.write("\n" + title + "\n")
-                elif nod.name == "__chars__":
-                    assert isinstance(nod, Chars)
-                    if not f:
-                        fp.write(nod.data)
-                    elif len(nod.data.strip()) > 0:
-                        fp.write(nod.data)
-                elif nod.name == "__comment__":
-                    assert isinstance(nod, Comment)
-                    fp.write("<!--" + nod.data + "-->")
-                elif nod.name == "richcontent":
-                    assert isinstance(nod, NodeNote)
-                    fp.write(cmn.unquote_note(nod.note))
-                elif nod.name == "attribute":
-                    fp.write("<!-- attr: {} = {} -->".format(
-                            nod.attr.get("NAME", "name?"),
-                            nod.attr.get("VALUE", "val?")))
-                elif nod.name in ("map", "leave - map", "font", ):
-                    return True
-                else:
-                    assert False
-            return False
-
-        f = True
-        for node in seq:
-            f = out_node(node, f)
-            self.output_markdown(fname, node.children, depth + 1)
-            if node.name == "node":
-                out_node(Chars("\n"), False)
+        for text in self.markdown_chunks(seq, depth):
+            fp.write(text)
         return 0
 
+    def markdown_chunks(self, seq: List[Nod1], depth: int  # {{{1
+                        ) -> Iterator[Text]:
+        """generate markdown texts of nodes in the order of the tree.
+
+        - walks the tree by `cmn.walk`, heading depth is taken from
+          the depth of the walk.
+        """
+        flags = [True]  # flag to skip spaces for each level
+        for f_enter, nod in cmn.walk(seq):
+            if not f_enter:
+                flags.pop()
+                if nod.name == "node":
+                    yield "\n"
+                continue
+            f, text = self.markdown_node(nod, flags[-1],
+                                         depth + len(flags) - 1)
+            flags[-1] = f
+            if len(text) > 0:
+                yield text
+            flags.append(True)
+
+    def markdown_node(self, nod: Nod1, f: bool, depth: int  # {{{1
+                      ) -> Tuple[bool, Text]:
+        if nod.name == "node":
+            title = ("#" * depth) + " " + nod.attr.get("TEXT", "")
+            return False, "\n" + title + "\n"
+        elif nod.name == "__chars__":
+            assert isinstance(nod, Chars)
+            if not f:
+                return False, nod.data
+            elif len(nod.data.strip()) > 0:
+                return False, nod.data
+            # skip the first line of coalesced white-spaces.
+            n = nod.data.find("\n")
+            n = len(nod.data) if n < 0 else max(n, 1)
+            return False, nod.data[n:]
+        elif nod.name == "__comment__":
+            assert isinstance(nod, Comment)
+            return False, "<!--" + nod.data + "-->"
+        elif nod.name == "richcontent":
+            if isinstance(nod, Splice):
+                nod = NodeNote.parse(nod.compose(nod))
+            assert isinstance(nod, NodeNote)
+            return False, cmn.unquote_note(nod.note)
+        elif nod.name == "attribute":
+            return False, "<!-- attr: {} = {} -->".format(
+                    nod.attr.get("NAME", "name?"),
+                    nod.attr.get("VALUE", "val?"))
+        elif nod.name in ("map", "leave - map", "font", ):
+            return True, ""
+        elif isinstance(nod, Splice):  # icons, edges, ... in markdown.
+            return True, ""
+        assert False
+
     def restruct(self, mode: runmode) -> List[Nod1]:  # {{{1
-        Node.key_attr_mode = mode
+        ctx = self.ctx.with_mode(mode)
         debg("rest:mode={}-{}".format(mode, len(self.root.children)))
         n = 0
         ret: List[Nod1] = []
-        for node in self.root.children:
-            if not isinstance(node, FMNode):
-                warn("rest:ignored-node={}".format(node.name))
-                # ret.append(node)
-                continue
-            n += 1
-            seq_flat = node.flattern("", exclude_self=False)
-            debg("rest:flat:{}".format(len(seq_flat)))
-            for i in seq_flat:
-                debg("rest:sort:{}".format(i.name))
-            ret.extend(seq_flat)
-        ret = self.restruct_dup_root(ret, mode)
-        ret.sort(key=Node.key_attr)
-        ret = HierBuilder().restruct(ret)
+        with self.prof.phase("flatten", mode.t()) as rec:
+            for node in self.root.children:
+                if not isinstance(node, FMNode):
+                    debg("rest:ignored-node={}".format(node.name))
+                    # ret.append(node)
+                    continue
+                n += 1
+                seq_flat = node.flattern(ctx, "", exclude_self=False)
+                if cmn.f_debug:
+                    debg("rest:flat:{}".format(len(seq_flat)))
+                ret.extend(seq_flat)
+            ret = self.restruct_dup_root(ret, mode)
+            rec["nodes"] = len(ret)
+        with self.prof.phase("sort", mode.t()) as rec:
+            ret = self.restruct_sort(ret, mode)
+            rec["nodes"] = len(ret)
+        with self.prof.phase("hier", mode.t()) as rec:
+            rec["nodes"] = len(ret)
+            ret = HierBuilder(ctx).restruct(ret)
 
         # insert header and footer
         if len(ret) < 1 or Node.level(ret[0], mode) != cmn.lvl_root:
@@ -449,12 +1007,106 @@ class FMXml(object):  # {{{1
         debg("rest:ret={}".format(len(ret)))
         return ret
 
+    def restruct_sort(self, seq: List[Nod1], mode: runmode  # {{{1
+                      ) -> List[Nod1]:
+        """sort flattened nodes by levels of `mode`.
+
+        - with `fname_order` and `cache`, the order of the previous run
+          is reused, see `restruct_sort_order`.
+        """
+        if len(self.fname_order) < 1 or self.cache is None:
+            levels = [Node.level(i, mode) for i in seq]
+            return [seq[i] for i in cmn.argsort_levels(levels)]
+        with cmn.gc_paused():
+            return self.restruct_sort_order(seq, mode)
+
+    def restruct_sort_order(self, seq: List[Nod1], mode: runmode  # {{{1
+                            ) -> List[Nod1]:
+        """sort nodes by the order of the previous run.
+
+        - nodes are marked by (ID, MODIFIED, attribute) in pre-order,
+          the previous order is used as is if the marks are same,
+        - or levels of changed nodes are parsed and inserted into it.
+        """
+        assert self.cache is not None
+        t = mode.t()
+        if not all(isinstance(i, FMNode) for i in seq):
+            levels = [Node.level(i, mode) for i in seq]
+            return [seq[i] for i in cmn.argsort_levels(levels)]
+        nods = cast(List[FMNode], seq)
+        marks = [(i.id_string, i.ts_modify, i.attr_get(t, "\0"))
+                 for i in nods]  # \0: no attribute
+        ent = self.cache.load_entry(self.fname_order, t + ".order")
+        if ent is not None and ent[0] == marks:
+            debg("rest:sort:no changes in {}".format(len(seq)))
+            return [seq[i] for i in ent[1]]
+        order = self.order_merge(nods, mode, marks, *(ent or ([], [])))
+        self.cache.store_entry(self.fname_order, t + ".order",
+                               (marks, order))
+        return [seq[i] for i in order]
+
+    def order_merge(self, nods: List['FMNode'], mode: runmode,  # {{{1
+                    marks: List[Tuple[Text, int, Text]],
+                    prev: List[Tuple[Text, int, Text]], order: List[int]
+                    ) -> List[int]:
+        """insert changed nodes into the previous `order` of `prev`
+        marks, returns indices of `nods` in the order of levels.
+
+        - unchanged nodes keep their order, only levels of changed
+          nodes and of nodes compared to them are parsed,
+        - sort all if some nodes are moved across same levels.
+        """
+        def key(i: int) -> Tuple[Tuple[int, ...], int]:
+            return cmn.level_trim(Node.level(nods[i], mode)), i
+
+        n = len(nods)
+        if [i[0] for i in prev] == [i[0] for i in marks]:
+            olds = [j if a == b else -1
+                    for j, (a, b) in enumerate(zip(prev, marks))]
+        else:  # nodes are added, removed or moved.
+            pos: Dict[Text, int] = {}
+            for i, mark in enumerate(marks):
+                pos[mark[0]] = -1 if mark[0] in pos else i
+            olds = [pos.get(mark[0], -1) for mark in prev]
+            olds = [i if i >= 0 and marks[i] == mark else -1
+                    for i, mark in zip(olds, prev)]
+        cur = [olds[j] for j in order if olds[j] >= 0]
+        if len(cur) < 1 or len(set(cur)) < len(cur) or any(
+                key(a) > key(b) for a, b in zip(cur, islice(cur, 1, None))
+                if a > b):
+            levels = [Node.level(i, mode) for i in nods]
+            return cmn.argsort_levels(levels)
+        flags = bytearray(n)
+        for i in cur:
+            flags[i] = 1
+        ins = sorted(key(i) for i in range(n) if not flags[i])
+        debg("rest:sort:{} changed in {}".format(len(ins), n))
+
+        ret: List[int] = []
+        lo = 0
+        for k in ins:  # binary search from the last position.
+            start, hi = lo, len(cur)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if key(cur[mid]) < k:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            ret.extend(cur[start:lo])
+            ret.append(k[1])
+        ret.extend(cur[lo:])
+        return ret
+
     def restruct_dup_root(self, seq: List[Nod1], mode: runmode  # {{{1
                           ) -> List[Nod1]:
         def append_script(nod: Nod1) -> None:
             if self.f_disable_script:
                 return
-            cmds = cmn.compose_script(mode.t())
+            if self.n_script_server > 0:
+                cmds = cmn.compose_script_server(mode.t(),
+                                                 self.n_script_server)
+            else:
+                cmds = cmn.compose_script(mode.t())
             nod.attr_replace("script1", cmds)
 
         seq_root: List[Nod1] = []
@@ -488,39 +1140,652 @@ class FMXml(object):  # {{{1
         return seq
 
 
-def zip_extract(fname: Text) -> Text:  # {{{1
-    ret = tempfile.mktemp(".xml", "fmmulti", dir=".")
+class FMSpill(FMXml):  # {{{1
+    """restructure a map in a memory budget.
+
+    - copies of nodes are made while parsing as `Node.flattern`,
+      sorted on disk by `cmn.ExternalSort`, then written by
+      `cmn.HierWriter`, the parsed tree and the result are not kept.
+    - see `FMXml.restruct` for the same steps in memory.
+    """
+    def __init__(self, mode: runmode, budget: int) -> None:  # {{{1
+        FMXml.__init__(self)
+        self.mode = mode
+        self.runs = cmn.ExternalSort(budget)
+        self.secs: List[List[Any]] = []  # [section, n of children, index]
+        self.roots: List[Tuple[int, Nod1]] = []
+        self.spacer = FMNode({})  # in place of closed nodes in children.
+
+    def enter_tag(self, name: Text, attrs: Dict[Text, Text]) -> None:  # {{{1
+        if name == "node" and self.cur_rich is None:
+            if len(self.secs) < 1:
+                sec = ""  # see FMXml.restruct
+            else:
+                par = self.secs[-1]
+                par[1] += 1
+                sec = (par[0] + "-" + Text(par[1])).lstrip("-")
+            self.secs.append([sec, 0, self.n_nodes])
+        FMXml.enter_tag(self, name, attrs)
+
+    def leave_tag(self, name: Text) -> None:  # {{{1
+        nod = self.cur
+        FMXml.leave_tag(self, name)
+        if nod is self.cur:
+            return
+        sec, _, n = self.secs.pop()
+        dmy = nod.flatten_copy(self.ctx, sec)
+        if Node.level(dmy, self.mode) == cmn.lvl_root:
+            self.roots.append((n, dmy))  # for restruct_dup_root()
+        else:
+            self.spill(n, dmy)
+        self.cur.children[-1] = self.spacer
+
+    def spill(self, n: int, nod: Nod1) -> None:  # {{{1
+        key = (cmn.level_trim(Node.level(nod, self.mode)), n)
+        self.runs.add(key, marshal.dumps(self.table_rows(nod)))
+
+    def restruct_file(self, fname: Text) -> None:  # {{{1
+        """parse and flatten nodes of the file into sorted runs.
+        """
+        self.ctx = self.ctx.with_mode(self.mode)
+        with self.prof.phase("flatten", self.mode.t()) as rec, \
+                open(fname, "rb") as fp:
+            self.feed_stream(fp)
+            if cmn.f_debug:
+                debg("rest:ignored-nodes={}".format(sum(
+                     not isinstance(i, FMNode) for i in self.root.children)))
+            # roots are closed in post-order, walk them in pre-order.
+            self.roots.sort(key=operator.itemgetter(0))
+            seq = [i[1] for i in self.roots]
+            self.restruct_dup_root(seq, self.mode)
+            for n, nod in self.roots:
+                self.spill(n, nod)
+            self.roots.clear()
+            rec["nodes"] = self.n_nodes
+
+    def output(self, fname: Text, mode: runmode) -> int:  # {{{1
+        assert mode == self.mode
+        src = self.src
+        seq = (cast(FMNode, self.table_tree(marshal.loads(i[1]), src))
+               for i in self.runs.merged())
+        nod = next(seq, None)
+        f_root = nod is not None and Node.level(nod, mode) == cmn.lvl_root
+        head: List[Nod1] = [
+                Nod1("map", {"version": "1.1.0"}).enter_only(True),
+                Chars("\n" + cmn.cmt_header + "\n")]
+        tail: List[Nod1] = [Chars("\n"), LNode("map")]
+        if not f_root:
+            head += [Nod1("node", {"TEXT": mode.t()}).enter_only(True),
+                     Chars("\n")]
+            tail.insert(0, LNode("node"))
+        if src is not None:
+            src.detach(fname)
+        with self.prof.phase("write", mode.t()) as rec, \
+                cmn.open_output(fname) as fp:
+            rec["nodes"] = self.n_nodes
+            cmn.write_nodes(fp, head)
+            hier = cmn.HierWriter(fp, self.ctx)
+            while nod is not None:
+                hier.insert_node(nod)
+                nod = next(seq, None)
+            hier.finish()
+            cmn.write_nodes(fp, tail)
+        return 0
+
+
+class FMThrough(FMXml):  # {{{1
+    """write a map in through mode while parsing it.
+
+    - the first pass `count_attrs()` counts attributes of each node,
+      then `backup` is stamped as `HierBuilder.mark_backup` does,
+      the input is parsed twice and malformed input is rejected
+      before the output is opened.
+    - nodes are written when they are closed and replaced by `spacer`,
+      written children are trimmed, open nodes and `n_attrs`,
+      4 bytes per node, are kept in memory: O(n), not O(depth).
+    - see `FMXml.output` for the same output from the tree.
+    """
+    def __init__(self, fp: IO[Text]) -> None:  # {{{1
+        FMXml.__init__(self)
+        self.fp = fp
+        self.n_attrs = array("i")  # attributes of nodes in pre-order
+        self.it_attrs: Iterator[int] = iter(())
+        self.spacer = FMNode({})
+        self.secs: List[List[Any]] = [["root", 0]]  # see cmn.section_next
+        self.marks: List[List[Any]] = []  # [section, n_attrs] of the path
+        self.outs = [[True, 0]]  # [start tag written, written children]
+
+    def count_attrs(self, src: cmn.Source) -> bool:  # {{{1
+        """count attributes of each node into `n_attrs`, -1 for nodes
+        with `backup`, returns False for unknown encodings.
+        """
+        path: List[int] = []
+        skip = [""]  # the spliced element, see FMXml.handlers()
+        n_attrs = self.n_attrs
+        parser = ParserCreate()
+
+        def enter_tag(name: Text, attrs: Dict[Text, Text]) -> None:
+            if name == "node":
+                path.append(len(n_attrs))
+                n_attrs.append(0)
+            elif name == "attribute":
+                if len(path) < 1 or n_attrs[path[-1]] < 0:
+                    pass
+                elif attrs.get("NAME", "") == "backup":
+                    n_attrs[path[-1]] = -1
+                else:
+                    n_attrs[path[-1]] += 1
+            elif name in self.splice_tags:
+                skip[0] = name
+                parser.StartElementHandler = None
+
+        def leave_tag(name: Text) -> None:
+            if not skip[0]:
+                if name == "node":
+                    path.pop()
+            elif name == skip[0]:
+                skip[0] = ""
+                parser.StartElementHandler = enter_tag
+
+        self.src = src
+        parser.StartElementHandler = enter_tag
+        parser.EndElementHandler = leave_tag
+        parser.XmlDeclHandler = self.enter_decl
+        for data in src.chunks():
+            parser.Parse(data, False)
+        parser.Parse(b"", True)
+        self.it_attrs = iter(self.n_attrs)
+        return self.src is not None
+
+    def enter_tag(self, name: Text, attrs: Dict[Text, Text]) -> None:  # {{{1
+        par = self.cur
+        FMXml.enter_tag(self, name, attrs)
+        if self.cur is not par:  # a new node
+            self.flush(par, 1)
+            self.marks.append([cmn.section_next(self.secs),
+                               next(self.it_attrs)])
+            self.outs.append([False, 0])
+        elif name == "attribute" and par is not self.root:
+            self.stamp(par)
+
+    def stamp(self, nod: Nod1) -> None:  # {{{1
+        """stamp `backup` as `Node.attr_replace` at the last attribute.
+        """
+        mark = self.marks[-1]
+        if mark[1] > 1:
+            mark[1] -= 1
+        elif mark[1] == 1:  # insert before the last attribute.
+            nod.children[-1:-1] = [
+                    Nod1.leaf("attribute", dict(NAME="backup",
+                                                VALUE=mark[0])),
+                    Chars.shared("\n")]
+            mark[1] = -2
+        elif mark[1] == -1:  # replace the first `backup`.
+            attr = nod.children[-1].attr
+            if attr.get("NAME", "") == "backup":
+                attr["VALUE"] = mark[0]
+                mark[1] = -2
+
+    def leave_tag(self, name: Text) -> None:  # {{{1
+        nod = self.cur
+        FMXml.leave_tag(self, name)
+        if nod is self.cur:
+            return
+        sec, n = self.marks.pop()
+        self.secs.pop()
+        if n == 0:  # no attributes, append to the last.
+            if len(nod.children) < 1:
+                nod.children.append(Chars.shared("\n"))
+            nod.children.append(Nod1.leaf("attribute", dict(NAME="backup",
+                                                            VALUE=sec)))
+            nod.children.append(Chars.shared("\n"))
+        self.flush(nod, 0)
+        nod.write_leave(self.fp)
+        self.outs.pop()
+        par = self.cur
+        par.children[-1] = self.spacer
+        self.outs[-1][1] = len(par.children)
+
+    def flush(self, nod: Nod1, keep: int) -> None:  # {{{1
+        """write the start tag and children of an open node
+        except the last `keep` children.
+        """
+        out = self.outs[-1]
+        if not out[0]:
+            nod.write_enter(self.fp, nod)
+            out[0] = True
+        seq = nod.children
+        n = len(seq) - keep
+        kids: Sequence[Nod1] = seq[out[1]:n]  # leaves, closed were written.
+        if nod is not self.root:  # the root is not written.
+            kids = FMNode.filter_backup(kids, self.ctx)
+        for i in kids:
+            i.write_enter(self.fp, i)
+        if n > 1:
+            del seq[:n - 1]  # leave the last one for FMXml.leave_tag
+        out[1] = min(n, 1)
+
+    def through_file(self, fname: Text, fname_out: Text) -> bool:  # {{{1
+        """convert the file, returns False if it can not be streamed.
+        """
+        with self.prof.phase("parse") as rec:
+            if fname == "-":
+                src = self.source(sys.stdin.buffer)
+            else:
+                with open(fname, "rb") as fp:
+                    src = self.source(fp)
+            if not self.count_attrs(src):
+                return False
+            rec["nodes"] = len(self.n_attrs)
+        src.detach(fname_out)
+        with self.prof.phase("write", runmode.through.t()) as rec, \
+                cmn.open_output(fname_out) as fp:
+            self.fp = fp
+            self.feed_source(src)
+            self.flush(self.root, 0)
+            rec["nodes"] = self.n_nodes
+        return True
+
+
+def convert(data: Any, mode: Any = runmode.through,  # {{{1
+            markdown_depth: int = -1, ctx: Optional[Context] = None,
+            f_disable_script: bool = False) -> bytes:
+    """convert a map in memory, returns the output in utf-8.
+
+    - `data`: xml in bytes, gzipped bytes, a text or a binary stream.
+    - `mode`: a runmode or its name, `markdown_depth` is same as `-M`.
+    - no files are read or written, and logging is not configured.
+    """
+    if isinstance(data, Text):
+        data = data.encode("utf-8")
+    if isinstance(data, bytes) and data[:2] != b"\x1f\x8b":
+        src = cmn.Source(data)
+    else:  # gzipped or a stream.
+        src = FMXml.source(BytesIO(data) if isinstance(data, bytes) else
+                           data)
+    xml = FMXml()
+    xml.ctx = Context() if ctx is None else ctx
+    xml.n_output_markdown = markdown_depth
+    xml.f_disable_script = f_disable_script
+    xml.feed_source(src)
+    mode = mode if isinstance(mode, runmode) else runmode.parse(mode)
+    fp = StringIO()
+    xml.output_fp(fp, xml.output_tree(mode))
+    return fp.getvalue().encode("utf-8")
+
+
+def parser_bench(src: cmn.Source, repeat: int = 3  # {{{1
+                 ) -> List[Tuple[float, Text]]:
+    """time parsing `src` by each parser backend, the fastest first."""
+    ret = []
+    for name, cls in parser_backends.items():
+        t = float("inf")
+        for i in range(repeat):
+            xml = FMXml()
+            xml.ctx = Context(parser=name)
+            t0 = time.perf_counter()
+            xml.feed_source(src)
+            t = min(t, time.perf_counter() - t0)
+        debg("parser:{}:{:.6f}s".format(name, t))
+        ret.append((t, name))
+    return sorted(ret)
+
+
+@lru_cache(maxsize=None)  # parser_pick {{{1
+def parser_pick(n_nodes: int = 2000) -> Any:
+    """pick the fastest parser backend on a generated map,
+    once in a process.
+    """
+    fmt = ('<node ID="ID_{0}" TEXT="node{0}">\n<font SIZE="12"/>\n'
+           '<attribute NAME="backup" VALUE="1-{0}"/>\n</node>\n')
+    data = ('<map version="1.1.0">\n<node TEXT="root">\n' +
+            "".join(fmt.format(i) for i in range(n_nodes)) +
+            '<richcontent TYPE="NOTE"><html><body><p>note</p></body>'
+            '</html></richcontent>\n</node>\n</map>\n')
+    seq = parser_bench(cmn.Source(data.encode("utf-8")))
+    return parser_backends[seq[0][1]]
+
+
+def parser_backend(name: Text) -> Any:  # {{{1
+    """the class of a parser backend by its name, `auto` is picked
+    at the first map to parse.
+    """
+    if name == "auto":
+        return parser_pick()
+    return parser_backends[name]
+
+
+def batch_inputs(patterns: List[Text], modes: List[runmode],  # {{{1
+                 sfx: Text = ".mm",
+                 skipped: Optional[List[Tuple[Text, Text]]] = None
+                 ) -> List[Text]:
+    """list .mm files from directories or glob patterns.
+
+    - skip outputs of the batch for other inputs: `name-doc.mm`,
+      `name-1-test.mm`, ... of `name.mm`.
+    - `skipped`: (file, input) of the skipped files are added to it.
+    """
+    ret: List[Text] = []
+    for pat in patterns:
+        if os.path.isdir(pat):
+            for dname, dirs, files in os.walk(pat):
+                dirs.sort()
+                ret.extend(os.path.join(dname, i) for i in sorted(files)
+                           if i.endswith(".mm"))
+        else:
+            ret.extend(sorted(glob.glob(pat, recursive=True)))
+    stems = dict((os.path.splitext(i)[0], i) for i in ret)
+
+    def input_of(fname: Text) -> Text:
+        for mode in modes:
+            end = "-" + mode.t() + sfx
+            if not fname.endswith(end):
+                continue
+            stem = fname[:-len(end)]
+            src = stems.get(stem, stems.get(re.sub(r"-[0-9]+$", "", stem)))
+            if src is not None:
+                return src
+        return ""
+
+    seq: List[Text] = []
+    for fname in ret:
+        src = input_of(fname)
+        if len(src) < 1:
+            seq.append(fname)
+        elif skipped is not None:
+            skipped.append((fname, src))
+    return sorted(set(seq), key=seq.index)
+
+
+BatchJob = Tuple[Text, List[Tuple[runmode, Text]], int, bool, Context]
+
+
+def batch_convert(job: BatchJob) -> Tuple[Text, Text, float]:  # {{{1
+    """convert a file in batch workers, returns (filename, error, time).
+
+    - `job` is (filename, [(mode, output)], -M, -S, context).
+    """
+    fname, outputs, n_output_markdown, f_disable_script, ctx = job
+    t = time.perf_counter()
     try:
-        debg("zip:" + fname)
-        zf = ZipFile(fname)
+        xml = FMXml.parse(fname, ctx=ctx)
+        xml.n_output_markdown = n_output_markdown
+        xml.f_disable_script = f_disable_script
+        xml.output_modes(outputs)
     except Exception as ex:
-        debg("zip:" + fname + "->" + Text(ex))
-        return ""
+        return fname, "{}: {}".format(type(ex).__name__, ex), \
+            time.perf_counter() - t
+    return fname, "", time.perf_counter() - t
+
+
+def main_batch(opts: options) -> int:  # {{{1
+    sfx = ".mm" if not (opts.n_output_markdown >= 0) else ".md"
+    scanned: Dict[Text, Set[Text]] = {}
+    jobs = []
+    skipped: List[Tuple[Text, Text]] = []
+    for fname in batch_inputs(opts.batch, opts.modes, sfx, skipped):
+        dname = os.path.dirname(fname)
+        names = scanned.get(dname, None)
+        if names is None:  # scan a directory only once.
+            names = scanned[dname] = set(os.listdir(dname or "."))
+        outputs = [(mode, cmn.number_output(opts.f_override, fname,
+                                            "-" + mode.t() + sfx, names))
+                   for mode in opts.modes]
+        jobs.append((fname, outputs, opts.n_output_markdown,
+                     opts.f_disable_script, opts.ctx))
+
+    for fname, src in sorted(set(skipped), key=skipped.index):
+        print("-- {:8.3f}s {} skipped as an output of {}".format(
+              0.0, fname, src))
+    ret = 0
+    for fname, err, t in convert_many(jobs, opts.n_jobs, opts.f_threads):
+        print("{:2} {:8.3f}s {}{}".format(
+              "NG" if err else "ok", t, fname, " " + err if err else ""))
+        ret = 1 if err else ret
+    return ret
+
+
+def convert_many(jobs: Iterable[BatchJob], n_jobs: int = 0,  # {{{1
+                 f_threads: bool = True
+                 ) -> Iterator[Tuple[Text, Text, float]]:
+    """convert maps concurrently on threads of this process or
+    on processes, yields results of `batch_convert` in order of `jobs`.
+    """
+    pool = ThreadPoolExecutor if f_threads else ProcessPoolExecutor
+    with pool(max_workers=n_jobs if n_jobs > 0 else None) as exe:
+        for ret in exe.map(batch_convert, jobs):
+            yield ret
+
+
+serve_cache: Dict[Text, Tuple[int, int, FMXml]] = OrderedDict()
+serve_cache_max = 8
+serve_options = ("input_xml", "input_zip_name", "output", "mode",
+                 "remove_backup", "convert_backup", "disable_script",
+                 "output_markdown", "override", "profile", "parser",
+                 "script_server")  # options that requests may change.
+serve_options_tcp = tuple(i for i in serve_options  # not authenticated.
+                          if i not in ("output", "override", "profile"))
+
+
+def serve_parse(fname: Text, ctx: Optional[Context] = None  # {{{1
+                ) -> FMXml:
+    """parse or reuse a tree parsed in previous requests.
+    """
+    if fname == "-":
+        return FMXml.parse(fname, ctx=ctx)
+    st = os.stat(fname)
+    key = os.path.abspath(fname)
+    ent = serve_cache.pop(key, None)
+    if ent is not None and ent[:2] == (st.st_mtime_ns, st.st_size):
+        xml = ent[2]
+    else:
+        xml = FMXml.parse(fname, ctx=ctx)
+    serve_cache[key] = (st.st_mtime_ns, st.st_size, xml)
+    while len(serve_cache) > serve_cache_max:
+        serve_cache.popitem(last=False)  # type: ignore
+    return xml
+
+
+def serve_check(args: List[Text], opts: options,  # {{{1
+                names: Tuple[Text, ...] = serve_options) -> Text:
+    """check options of a request, returns an error or an empty string.
+
+    - requests may only change the options in `names`.
+    - outputs must be written next to the input file.
+    """
+    arg = options.parser()
+    ns = arg.parse_args(args)
+    for k, v in sorted(vars(ns).items()):
+        if k not in names and v != arg.get_default(k):
+            return "--{} is not allowed in requests".format(
+                k.replace("_", "-"))
+    src = ns.input_zip_name or ns.input_xml or ""
+    if src in ("", "-"):
+        return "requests need an input file"
+    dname = os.path.dirname(os.path.abspath(src))
+    for _, fname in opts.outputs:
+        if os.path.dirname(os.path.abspath(fname)) != dname:
+            return "output is not next to the input: " + fname
+    return ""
+
+
+def serve_outputs(opts: options) -> None:  # {{{1
+    """name outputs as the node script does without the server,
+    `fname-mode.mm`, numbered not to overwrite files.
+    """
+    src = opts.fname_zip or opts.fname_xml
+    sfx = ".mm" if not (opts.n_output_markdown >= 0) else ".md"
+    opts.outputs = [(mode, cmn.number_output(
+                     False, src + "-" + mode.t() + sfx, sfx))
+                    for mode, _ in opts.outputs]
+    opts.fname_out = opts.outputs[0][1]
 
+
+def serve_request(args: List[Text],  # {{{1
+                  names: Tuple[Text, ...] = serve_options
+                  ) -> Tuple[int, Text]:
     try:
-        for zi in zf.infolist():
-            debg("found entry {}".format(zi))
-            if zi.is_dir():  # type: ignore  # no `is_dir` in python2
+        opts = options.parse(args)
+        msg = serve_check(args, opts, names)
+        if len(msg) > 0:
+            return 2, msg
+        if "output" not in names:
+            serve_outputs(opts)
+        ret = main_convert(opts, serve_parse)
+    except SystemExit:  # argparse errors
+        return 2, "bad arguments: {}".format(" ".join(args))
+    except Exception as ex:
+        return 1, "{}: {}".format(type(ex).__name__, ex)
+    if runmode.through in opts.modes:  # the tree was stamped `backup`.
+        serve_cache.pop(os.path.abspath(opts.fname_xml), None)
+    return ret, " ".join(i[1] for i in opts.outputs)
+
+
+class ServeHandler(StreamRequestHandler):  # {{{1
+    """requests are arguments of fmmulti.py, one per line and
+    an empty line, replies `status message` in a line.
+
+    - requests on tcp can not choose outputs, anyone on the host
+      can connect to it, see `serve_outputs`.
+    """
+    def handle(self) -> None:  # {{{1
+        names = (serve_options_tcp if isinstance(self.server, ServeTCP)
+                 else serve_options)
+        args: List[Text] = []
+        for line in self.rfile:
+            src = line.decode("utf-8").rstrip("\r\n")
+            if len(src) > 0:
+                args.append(src)
                 continue
-            with open(ret, "w") as fp:
-                fp.write(zf.extract(zi))
-            return ret
-    finally:
-        zf.close()
-    return ""
+            ret, msg = serve_request(args, names)
+            self.wfile.write("{} {}\n".format(ret, msg).encode("utf-8"))
+            self.wfile.flush()
+            args = []
 
 
-def main(args: List[Text]) -> int:  # {{{1
-    opts = options.parse(args)
-    if opts.fname_zip:
-        opts.fname_xml = zip_extract(opts.fname_zip)
-    if len(opts.fname_xml) < 1:
+class ServeTCP(TCPServer):  # {{{1
+    allow_reuse_address = True
+
+
+def serve_create(src: Text) -> BaseServer:  # {{{1
+    addr = cmn.serve_address(src)
+    if isinstance(addr, Text):
+        if os.path.exists(addr):
+            if not stat.S_ISSOCK(os.stat(addr).st_mode):
+                raise FileExistsError("not a socket: " + addr)
+            os.remove(addr)  # left by a previous server.
+        srv = UnixStreamServer(addr, ServeHandler)
+        os.chmod(addr, 0o600)  # requests only from this user.
+        return srv
+    return ServeTCP(addr, ServeHandler)
+
+
+def main_serve(opts: options) -> int:  # {{{1
+    try:
+        srv = serve_create(opts.serve)
+    except FileExistsError as ex:
+        warn("serve: {}".format(ex))
+        return 1
+    with srv:
+        warn("serve: {}".format(srv.server_address))
+        try:
+            srv.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+def main_spill(opts: options, prof: cmn.Profiler  # {{{1
+               ) -> List[Tuple[runmode, Text]]:
+    """convert restructure modes of a file by `FMSpill`,
+    returns outputs left for the in-memory tree.
+    """
+    ret: List[Tuple[runmode, Text]] = []
+    for mode, fname in opts.outputs:
+        if mode == runmode.through:  # needs the whole tree.
+            ret.append((mode, fname))
+            continue
+        spill = FMSpill(mode, opts.n_memory_budget)
+        spill.prof = prof
+        spill.ctx = opts.ctx
+        spill.f_disable_script = opts.f_disable_script
+        spill.n_script_server = opts.n_script_server
+        spill.restruct_file(opts.fname_xml)
+        spill.output(fname, mode)
+    return ret
+
+
+def main_through(opts: options, prof: cmn.Profiler,  # {{{1
+                 outputs: List[Tuple[runmode, Text]]
+                 ) -> List[Tuple[runmode, Text]]:
+    """stream through mode by `FMThrough` if the tree is not needed
+    by other modes, returns outputs left for the in-memory tree.
+    """
+    if (opts.n_output_markdown >= 0 or opts.fname_zip or
+            opts.fname_xml in ("", "-") or
+            any(mode != runmode.through for mode, _ in outputs)):
+        return outputs
+    ret: List[Tuple[runmode, Text]] = []
+    for mode, fname in outputs:
+        xml = FMThrough(sys.stdout)
+        xml.prof = prof
+        xml.ctx = opts.ctx
+        if not xml.through_file(opts.fname_xml, fname):
+            ret.append((mode, fname))
+    return ret
+
+
+def main_convert(opts: options,  # {{{1
+                 parse: Callable[..., FMXml]) -> int:
+    prof = cmn.Profiler(opts.f_profile)
+    try:
+        return main_output(opts, parse, prof)
+    finally:  # do not trace the memory of following requests in --serve
+        prof.stop()
+
+
+def main_output(opts: options, parse: Callable[..., FMXml],  # {{{1
+                prof: cmn.Profiler) -> int:
+    outputs = opts.outputs
+    if (opts.n_memory_budget > 0 and opts.n_output_markdown < 0 and
+            not opts.fname_zip and opts.fname_xml not in ("", "-")):
+        outputs = main_spill(opts, prof)
+    outputs = main_through(opts, prof, outputs)
+    if len(outputs) < 1:
+        prof.report(opts.fname_profile)
+        return 0
+    with prof.phase("parse") as rec:
+        if opts.fname_zip:
+            xml: Optional[FMXml] = FMXml.parse_zip(opts.fname_zip, opts.ctx)
+        elif len(opts.fname_xml) > 0:
+            xml = parse(opts.fname_xml, ctx=opts.ctx)
+        else:
+            xml = None
+        rec["nodes"] = 0 if xml is None else xml.n_nodes
+    if xml is None:
         options.parser().print_help()
         return 1
-    xml = FMXml.parse(opts.fname_xml)
+    xml.prof = prof
+    xml.ctx = opts.ctx
     xml.n_output_markdown = opts.n_output_markdown
     xml.f_disable_script = opts.f_disable_script
-    return xml.output(opts.fname_out, opts.mode)
+    xml.n_script_server = opts.n_script_server
+    if opts.f_incremental and opts.fname_xml not in ("", "-"):
+        xml.fname_order = opts.fname_xml
+        xml.cache = opts.cache
+    ret = xml.output_modes(outputs)
+    prof.report(opts.fname_profile)
+    return ret
+
+
+def main(args: List[Text]) -> int:  # {{{1
+    opts = options.parse(args)
+    cmn.logging_setup(opts.f_verbose)
+    if len(opts.batch) > 0:
+        return main_batch(opts)
+    if len(opts.serve) > 0:
+        return main_serve(opts)
+    return main_convert(opts, partial(FMXml.parse, cache=opts.cache))
 
 
 if __name__ == "__main__":  # {{{1
@@ -8,16 +8,20 @@ v.2.0. If a copy of the MPL was not distributed with this file,
 You can obtain one at https://mozilla.org/MPL/2.0/.
 '''
 from argparse import ArgumentParser
+import io
+import itertools
 import logging
-from logging import (debug as debg, )  # , warning as warn
 import re
 import sys
 import time
-from typing import (Dict, Iterable, List, Optional, Text, )
+from typing import (Any, Dict, IO, Iterable, Iterator, List, Match,
+                    Optional, Pattern, Text, Tuple, )
 
 import common as cmn
-from common import HierBuilder, Node, NodeDmy, NodeNote
+from common import HierBuilder, HierWriter, Node, NodeNote
 
+log = logging.getLogger(__name__)  # the api leaves the root logger.
+debg, warn = log.debug, log.warning
 Dict, Optional
 
 
@@ -30,20 +34,22 @@ class options(object):  # {{{1
     def __init__(self) -> None:  # {{{1
         self.fname_mdn = ""
         self.fname_out = ""
+        self.f_verbose = False
 
     @classmethod  # parser {{{1
     def parser(cls) -> ArgumentParser:  # {{{1
         arg = ArgumentParser()
         arg.add_argument("-o", "--output", default="")
         arg.add_argument("-f", "--override", action="store_true")
+        arg.add_argument("-v", "--verbose", action="store_true")
         arg.add_argument("input_markdown", type=Text)
         return arg
 
     @classmethod  # parse {{{1
     def parse(cls, args: List[Text]) -> 'options':
-        logging.basicConfig(level=logging.DEBUG)
         ret = options()
         opts = ret.parser().parse_args(args)
+        ret.f_verbose = opts.verbose
         ret.fname_out = opts.output
         src = ret.fname_mdn = opts.input_markdown
         if not isinstance(src, Text):
@@ -58,6 +64,8 @@ class options(object):  # {{{1
 
 
 class MDNode(Node):  # {{{1
+    __slots__ = ("title", "note", "n_level", "section", )
+
     def __init__(self, title: Text, buf: List[Text], n: int) -> None:  # {{{1
         Node.__init__(self, "section", {})
 
@@ -70,27 +78,32 @@ class MDNode(Node):  # {{{1
         self.section = ""
 
     def compose(self, prv: Node) -> Text:  # {{{1
-        debg("compose:node:" + Text(self.n_level))
-        ret = '<node CREATED="{}" ID="{}" MODIFIED="{}"'.format(
-                -1, int(time.time() * 1000), -1)
-        ret += ' TEXT="{}"'.format(cmn.quote_attr(self.title))
+        return self.compose_buffered(prv)
+
+    def write_enter(self, fp: IO[Text], prv: Node) -> None:  # {{{1
+        if cmn.f_debug:
+            debg("compose:node:" + Text(self.n_level))
+        fp.write('<node CREATED="{}" ID="{}" MODIFIED="{}"'.format(
+                 -1, int(time.time() * 1000), -1))
+        fp.write(' TEXT="{}"'.format(cmn.quote_attr(self.title)))
         if len(self.note) > 0:
             node = NodeNote(self.note)
             self.children.insert(0, node)
-        self.children.insert(0, cmn.Chars("\n"))
-        self.children.insert(0, self.attr_section_number(prv))
-        self.children.insert(0, cmn.Chars("\n"))
-        self.children.insert(0, self.attr_level_score())
+        self.children.insert(0, cmn.Chars.shared("\n"))
+        self.insert_child(0, self.attr_section_number(prv))
+        self.children.insert(0, cmn.Chars.shared("\n"))
+        self.insert_child(0, self.attr_level_score())
         if len(self.children) < 1:
-            ret += "/>\n"
-        else:
-            ret += ">\n"
-            prv_child: Node = NodeDmy()
-            for nod in self.children:
-                ret += nod.compose(prv_child)
-                prv_child = nod
-            ret += '</node>\n'
-        return ret
+            fp.write("/>\n")
+            return
+        fp.write(">\n")
+
+    def write_leave(self, fp: IO[Text]) -> None:  # {{{1
+        if len(self.children) > 0:
+            fp.write('</node>\n')
+
+    def write_children(self, ctx: Any = None) -> List[Node]:  # {{{1
+        return self.children
 
     def attr_section_number_text(self, prv: Node) -> Text:  # {{{1
         if len(self.section) > 0:
@@ -138,7 +151,7 @@ class MDNode(Node):  # {{{1
         num = cmn.section_num_1st(num)
         return num
 
-    def level_diff(self, nod: 'Node') -> int:  # {{{1
+    def level_diff(self, nod: 'Node', ctx: Any) -> int:  # {{{1
         if isinstance(nod, MDNode):
             n = nod.n_level
         elif nod.name == "root":
@@ -152,105 +165,275 @@ class MDNode(Node):  # {{{1
         return "{}-{}".format(self.n_level, self.title)
 
 
+class LineTokenizer(object):  # {{{1
+    """classify lines of markdown in one pass by a precompiled pattern.
+
+    - lines of fenced codes, html blocks and a front matter are bodies,
+      `#`, `===` and `---` in them are not headings.
+    - a front matter starts with `---` at the 1st line, and continues
+      to `---` or `...` in `n_front_max` lines of `key: value`, lists,
+      indented or empty lines, others are not a front matter.
+    """
+    html_blocks = ("address|article|aside|base|basefont|blockquote|body|"
+                   "caption|center|col|colgroup|dd|details|dialog|dir|div|"
+                   "dl|dt|fieldset|figcaption|figure|footer|form|frame|"
+                   "frameset|h[1-6]|head|header|hr|html|iframe|legend|li|"
+                   "link|main|menu|menuitem|nav|noframes|ol|optgroup|"
+                   "option|p|param|search|section|summary|table|tbody|td|"
+                   "tfoot|th|thead|title|tr|track|ul")
+    html_attr = (r"""(?:[ \t]+[A-Za-z_:][\w.:-]*"""
+                 r"""(?:[ \t]*=[ \t]*(?:[^ \t"'=<>`]+|'[^']*'|"[^"]*"))?)""")
+
+    # lines not matched are body texts, the group tells the kind of
+    # others, html groups are the start conditions of commonmark.
+    pat_line = re.compile(
+        r"(?P<atx>#+)|(?P<h1>=+$)|(?P<h2>-+$)| {0,3}(?:"
+        r"(?P<fence>`{3,}(?!.*`)|~{3,})|<(?:"
+        r"(?P<raw>(?i:script|pre|style|textarea))(?:[ \t>]|$)|"
+        r"(?P<cmt>!--)|(?P<pi>\?)|"
+        r"(?P<cdata>!\[CDATA\[)|(?P<decl>![A-Za-z])|"
+        r"/?(?P<blk>(?i:" + html_blocks + r"))(?:[ \t]|/?>|$)|"
+        r"(?P<tag>/?[A-Za-z][A-Za-z0-9-]*" + html_attr +
+        r"*[ \t]*/?>[ \t]*$)))")
+    # patterns of the last line of blocks, by the group of `pat_line`.
+    pat_ends = dict(
+        raw=re.compile(r".*?</(?:script|pre|style|textarea)>", re.I),
+        cmt=re.compile(r".*?-->"), pi=re.compile(r".*?\?>"),
+        cdata=re.compile(r".*?\]\]>"), decl=re.compile(r".*?>"),
+        blk=re.compile(r"[ \t]*$"), tag=re.compile(r"[ \t]*$"),
+        front=re.compile(r"(?:---|\.\.\.)[ \t]*$"), )
+    pat_front = re.compile(r"---[ \t]*$")
+    # lines of a front matter: empty, indented, a list or `key: value`.
+    pat_front_line = re.compile(
+        r"""[ \t]*$|[ \t]+\S|- |[\w"'][^:]*:(?:[ \t]|$)""")
+    n_front_max = 200
+
+    def levels(self, lines: Iterable[Text]  # {{{1
+               ) -> Iterator[Tuple[int, Text]]:
+        """yield the heading level and the line without the line end,
+        the level is 0 for other lines.
+        """
+        match = self.pat_line.match
+        end: Optional[Pattern[Text]] = None  # ends the current block
+        f_para = False  # the previous line is a text, for === and ---
+        it = iter(lines)
+        for line in it:  # the 1st line
+            line = line.rstrip("\r\n")
+            if self.pat_front.match(line) is None:
+                it = itertools.chain([line], it)
+                break
+            front, f_closed = self.front_matter(it)
+            if not f_closed:  # not a front matter, read them again.
+                it = itertools.chain([line], front, it)
+                break
+            yield 0, line
+            for i in front:
+                yield 0, i
+            break
+        for line in it:
+            line = line.rstrip("\r\n")
+            if end is not None:
+                if end.match(line) is not None:
+                    end = None
+                f_para = False
+                yield 0, line
+                continue
+            mo = match(line)
+            if mo is None:
+                f_para = len(line) > 0 and not line.isspace()
+                yield 0, line
+                continue
+            if mo.lastgroup == "cmt" and line.find("-->", mo.end()) >= 0:
+                f_para = False  # a comment in the line, so many in maps.
+                yield 0, line
+                continue
+            n, end = self.level_special(mo, f_para)
+            f_para = n >= 0
+            yield max(n, 0), line
+
+    def front_matter(self, it: Iterator[Text]  # {{{1
+                     ) -> Tuple[List[Text], bool]:
+        """read lines of a front matter to the closing `---` or `...`,
+        returns the lines and whether the closing line was found.
+
+        - stops at a line which is not in a front matter, then the lines
+          are read again, the read-ahead is limited to `n_front_max`.
+        """
+        ret: List[Text] = []
+        end = self.pat_ends["front"]
+        for line in itertools.islice(it, self.n_front_max + 1):
+            line = line.rstrip("\r\n")
+            ret.append(line)
+            if end.match(line) is not None:
+                return ret, True
+            if self.pat_front_line.match(line) is None:
+                break
+        return ret, False
+
+    def level_special(self, mo: Match[Text], f_para: bool  # {{{1
+                      ) -> Tuple[int, Optional[Pattern[Text]]]:
+        """level of a line matched to `pat_line` and the end of a block
+        if it begins, -1 for lines of blocks.
+        """
+        kind = mo.lastgroup
+        if kind == "atx":
+            n = mo.end()
+            if n == 1:
+                return n_level_1st + 10, None  # 1st level + alpha
+            if n == 2:
+                return n_level_2nd + 10, None  # 2nd level + alpha
+            return n * n_level_unit, None
+        if kind == "h1":
+            return (n_level_1st if f_para else 0), None  # 1st level
+        if kind == "h2":
+            return (n_level_2nd if f_para else 0), None  # 2nd level
+        if kind == "fence":
+            fence = mo.group(kind)
+            return -1, re.compile(r" {0,3}%s{%d,}[ \t]*$" % (
+                                  re.escape(fence[0]), len(fence)))
+        if kind == "tag" and f_para:  # can not interrupt a paragraph.
+            return 0, None
+        end = self.pat_ends[kind or ""]
+        if kind in ("blk", "tag") or end.match(mo.string, mo.end()) is None:
+            return -1, end
+        return -1, None
+
+
 class FMXml(HierBuilder):  # {{{1
     @classmethod  # parse {{{1
     def parse_markdown(cls, fname: Text) -> 'FMXml':
         """parse Nodes from markdown
         """
+        return cls.parse_lines(cls.get_lines(fname))
+
+    @classmethod  # parse_lines {{{1
+    def parse_lines(cls, lines: Iterable[Text]) -> 'FMXml':
+        """parse Nodes from lines of markdown, without files.
+        """
         ret = FMXml()
+        ret.feed_lines(lines)
+        return ret
+
+    def feed_lines(self, lines: Iterable[Text]) -> None:  # {{{1
+        """insert sections of lines to the hierarchy, lines are read
+        one by one and a section is inserted at the next heading.
+        """
         buf: List[Text] = []
-        for line in cls.get_lines(fname):
-            line = line.rstrip("\r\n")
-            n = cls.is_section_line(line, buf)
+        n_buf = 0  # level of the section in buf
+        n_head = 0  # level of buf[0] by itself, the title without ===
+        n_last = 0  # level of buf[-1]
+        for n, line in LineTokenizer().levels(lines):
             if n == 0:
                 buf.append(line)
+                n_last = 0
                 continue
-            debg("found {}-{}".format(n, line.strip()))
+            if cmn.f_debug:
+                debg("found {}-{}".format(n, line.strip()))
             if len(buf) < 1:
-                buf = [line]
+                buf, n_buf, n_head, n_last = [line], n, n, n
                 continue
             if n in (n_level_1st, n_level_2nd):  # === or ---
                 # exclude the last line.
                 bf2 = buf[:-1]
                 buf = [buf[-1], line]
+                n_hd2 = n_last if n_last not in (n_level_1st,
+                                                 n_level_2nd) else 0
             else:
                 bf2 = buf
                 buf = [line]
-            ret.parse_markdown_build_hier(bf2)
-        if len(ret.root.children) < 1:
-            return ret
-        ret.parse_markdown_build_hier(buf)  # parse left data...
-        return ret
+                n_hd2 = n
+            if len(bf2) > 0:  # empty if the 1st line is a title of ===
+                self.parse_markdown_build_hier(
+                        bf2, n_head if len(bf2) == 1 else n_buf)
+            n_buf, n_head, n_last = n, n_hd2, n
+        if len(self.root.children) < 1:
+            return
+        self.parse_markdown_build_hier(  # parse left data...
+                buf, n_head if len(buf) == 1 else n_buf)
 
     @classmethod  # get_lines {{{1
     def get_lines(cls, fname: Text) -> Iterable[Text]:
+        """lines of the file, an unreadable file is same as an empty one.
+        """
         try:
             with open(fname, "rt") as fp:
-                for i in fp.readlines():
-                    yield i
-        except:
-            pass
-
-    @classmethod  # is_section_line {{{1
-    def is_section_line(cls, line: Text, lines: List[Text]) -> int:
-        """- did not support '#' in \`\`\`
-        """
-        if len(line) < 1:
-            return 0
-        if line.startswith(" ") or line.startswith("\t"):
-            return 0
-        if len(line.lstrip("=")) < 1:
-            if len(lines) < 1 or len(lines[-1].strip()) < 1:
-                return 0
-            return n_level_1st  # 1st level
-        if len(line.lstrip("-")) < 1:
-            if len(lines) < 1 or len(lines[-1].strip()) < 1:
-                return 0
-            return n_level_2nd  # 2nd level
-        if not line.startswith("#"):
-            return 0
-        src = line.lstrip("#")
-        n = len(line) - len(src)
-        if n == 1:
-            return n_level_1st + 10  # 1st level + alpha
-        if n == 2:
-            return n_level_2nd + 10  # 2nd level + alpha
-        return n * n_level_unit
-
-    def parse_markdown_build_hier(self, buf: List[Text]) -> None:  # {{{1
-        line_2nd, buf2 = (buf[1], [buf[0]]) if len(buf) > 1 else ("", [])
-        n = self.is_section_line(line_2nd, buf2)
-        if n == n_level_1st:
-            title, buf = buf[0], [] if len(buf) < 3 else buf[2:]
-        elif n == n_level_2nd:
+                yield from fp
+        except OSError as ex:
+            warn("md:{}:{}".format(fname, ex))
+
+    def parse_markdown_build_hier(self, buf: List[Text], n: int  # {{{1
+                                  ) -> None:
+        """insert a section from lines, `n` is the level of it."""
+        if n in (n_level_1st, n_level_2nd):
             title, buf = buf[0], [] if len(buf) < 3 else buf[2:]
         else:
-            n = self.is_section_line(buf[0], [])
             title, buf = buf[0].lstrip("#"), buf[1:]
         nod = MDNode(title, buf, n)
         self.insert_node(nod)
 
     def output(self, fname: Text) -> int:  # {{{1
         debg("out:open:" + fname)
-        seq = self.root.children
         with open(fname, "wt") as fp:
-            fp.write('<map version="1.1.0">\n')
-            fp.write(cmn.cmt_header + '\n')
-            fp.write('<node TEXT="document">\n')
-            prv: Node = NodeDmy()
-            for node in seq:
-                text = node.compose(prv)
-                # debg("out:" + text)
-                fp.write(text)
-                prv = node
-            fp.write('</node>\n</map>\n')
+            return self.output_stream(fp)
+
+    def output_stream(self, fp: IO[Text]) -> int:  # {{{1
+        seq = self.root.children
+        self.write_header(fp)
+        cmn.write_nodes(fp, seq)
+        self.write_footer(fp)
+        return 0
+
+    @classmethod  # write_header {{{1
+    def write_header(cls, fp: IO[Text]) -> None:
+        fp.write('<map version="1.1.0">\n')
+        fp.write(cmn.cmt_header + '\n')
+        fp.write('<node TEXT="document">\n')
+
+    @classmethod  # write_footer {{{1
+    def write_footer(cls, fp: IO[Text]) -> None:
+        fp.write('</node>\n</map>\n')
+
+
+class FMStream(FMXml, HierWriter):  # {{{1
+    """convert markdown while reading lines, a node is written when
+    the next section closes it.
+
+    - only the sections of the ancestors and the current one are kept,
+      memory grows with the depth of headings, not with the document.
+    """
+    def __init__(self, fp: IO[Text]) -> None:  # {{{1
+        HierWriter.__init__(self, fp)
+
+    @classmethod  # convert_file {{{1
+    def convert_file(cls, fname: Text, fname_out: Text) -> int:
+        debg("out:open:" + fname_out)
+        with open(fname_out, "wt") as fp:
+            return cls(fp).convert_lines(cls.get_lines(fname))
+
+    def convert_lines(self, lines: Iterable[Text]) -> int:  # {{{1
+        self.write_header(self.fp)
+        self.feed_lines(lines)
+        self.finish()
+        self.write_footer(self.fp)
         return 0
 
 
+def convert(text: Any) -> bytes:  # {{{1
+    """convert markdown in memory, returns the map in utf-8.
+
+    - `text` is a text or lines of it, no files are read or written,
+      and logging is not configured.
+    """
+    lines = text.splitlines(True) if isinstance(text, Text) else text
+    fp = io.StringIO()
+    FMStream(fp).convert_lines(lines)
+    return fp.getvalue().encode("utf-8")
+
+
 def main(args: List[Text]) -> int:  # {{{1
     opts = options.parse(args)
-    xml = FMXml.parse_markdown(opts.fname_mdn)
-    return xml.output(opts.fname_out)
+    cmn.logging_setup(opts.f_verbose)
+    return FMStream.convert_file(opts.fname_mdn, opts.fname_out)
 
 
 if __name__ == "__main__":  # {{{1
@@ -8,6 +8,9 @@ v.2.0. If a copy of the MPL was not distributed with this file,
 You can obtain one at https://mozilla.org/MPL/2.0/.
 '''
 import logging
+import os
+import tempfile
+from typing import Any, Dict, Iterator, List, Optional, Text, Tuple
 from unittest import TestCase
 
 
@@ -15,42 +18,756 @@ logging.basicConfig(level=logging.INFO)
 
 
 class TestCommand(TestCase):  # {{{1
+    def setUp(self) -> None:  # {{{1
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:  # {{{1
+        self.tmp.cleanup()
+
+    def out(self, fname: Text) -> Text:  # {{{1
+        """path of an output in the temporary directory of a test."""
+        return os.path.join(self.tmp.name, fname)
+
     def test_fmmulti_through(self) -> None:  # {{{1
         import fmmulti as dut
-        dut.main(["-f", "-o", "sample-0.mm", "sample.mm",
+        dut.main(["-f", "-o", self.out("sample-0.mm"), "sample.mm",
                   ])
 
     def test_fmmulti_doc(self) -> None:  # {{{1
         import fmmulti as dut
-        dut.main(["-f", "-o", "sample-d.mm", "sample.mm",
+        dut.main(["-f", "-o", self.out("sample-d.mm"), "sample.mm",
                   "-m", "doc"])
 
     def test_fmmulti_test(self) -> None:  # {{{1
         import fmmulti as dut
-        dut.main(["-f", "-o", "sample-t.mm", "sample.mm",
+        dut.main(["-f", "-o", self.out("sample-t.mm"), "sample.mm",
                   "-S", "-m", "test"])
 
     def test_fmmulti_backup(self) -> None:  # {{{1
         import fmmulti as dut
-        dut.main(["-f", "-o", "sample-b.mm", "sample.mm",
+        dut.main(["-f", "-o", self.out("sample-b.mm"), "sample.mm",
                   "-m", "backup"])
 
     def test_fmmulti_remove_backup(self) -> None:  # {{{1
         import fmmulti as dut
-        dut.main(["-f", "-B", "-o", "sample-B.mm", "sample.mm",
-                  "-m", "backup"])
+        dut.main(["-f", "-B", "-o", self.out("sample-B.mm"),
+                  "sample.mm", "-m", "backup"])
 
     def test_fmmulti_convert_backup(self) -> None:  # {{{1
         import fmmulti as dut
-        dut.main(["-f", "-o", "sample-c.mm", "sample.mm", "-c", "bck1",
-                  "-m", "backup"])
+        dut.main(["-f", "-o", self.out("sample-c.mm"), "sample.mm",
+                  "-c", "bck1", "-m", "backup"])
+
+    def test_fmmulti_multi_mode(self) -> None:  # {{{1
+        import fmmulti as dut
+        dut.main(["-f", "-o", self.out("sample-x.mm"), "sample.mm",
+                  "-S", "-m", "test,through"])
+        dut.main(["-f", "-o", self.out("sample-x1.mm"), "sample.mm",
+                  "-S", "-m", "test"])
+        dut.main(["-f", "-o", self.out("sample-x2.mm"), "sample.mm",
+                  "-S", "-m", "through"])
+        for a, b in (("sample-x-test.mm", "sample-x1.mm"),
+                     ("sample-x-through.mm", "sample-x2.mm")):
+            with open(self.out(a)) as fp:
+                src = fp.read()
+            with open(self.out(b)) as fp:
+                self.assertEqual(fp.read(), src)
+        for args in (["sample.mm", "-o", "-"], ["-"]):  # maps to stdout
+            with self.assertRaises(SystemExit):
+                dut.options.parse(args + ["-m", "doc,test"])
+        opts = dut.options.parse(["sample.mm", "-m", "doc", "-o", "-"])
+        self.assertEqual([(dut.runmode.doc, "/dev/stdout")], opts.outputs)
+
+    def test_fmmulti_profile(self) -> None:  # {{{1
+        import json
+        import fmmulti as dut
+        dut.main(["-f", "-o", self.out("sample-p.mm"), "sample.mm", "-S",
+                  "-m", "doc", "--profile-json",
+                  self.out("sample-p.json")])
+        with open(self.out("sample-p.json")) as fp:
+            rec = json.load(fp)
+        names = [i["phase"] for i in rec["phases"]]
+        self.assertEqual(["parse", "flatten", "sort", "hier", "write"], names)
+        self.assertEqual(43, rec["phases"][0]["nodes"])
+
+    def test_fmmulti_archives(self) -> None:  # {{{1
+        import gzip
+        import io
+        from zipfile import ZipFile
+        import fmmulti as dut
+
+        def compose(xml: dut.FMXml) -> Text:
+            xml.f_disable_script = True
+            fp = io.StringIO()
+            xml.output_stream(fp, xml.restruct(dut.runmode.doc))
+            return fp.getvalue()
+
+        exp = compose(dut.FMXml.parse("sample.mm"))
+        with open("sample.mm", "rb") as fp:
+            src = fp.read()
+        xml = dut.FMXml.parse_stream(io.BytesIO(gzip.compress(src)))
+        self.assertEqual(exp, compose(xml))
+        with ZipFile(self.out("sample-z.zip"), "w") as zf:
+            zf.writestr("sample.mm", src)
+        xml2 = dut.FMXml.parse_zip(self.out("sample-z.zip"))
+        assert xml2 is not None
+        self.assertEqual(exp, compose(xml2))
+
+    def test_fmmulti_batch(self) -> None:  # {{{1
+        import io
+        import shutil
+        from contextlib import redirect_stdout
+        import fmmulti as dut
+        with tempfile.TemporaryDirectory() as dname:
+            os.mkdir(os.path.join(dname, "sub"))
+            for i in ("a.mm", "sub/b.mm", "sub/b-doc.mm",
+                      "sub/unit-test.mm", "sub/design-doc.mm"):
+                shutil.copy("sample.mm", os.path.join(dname, i))
+            log = io.StringIO()
+            with redirect_stdout(log):
+                ret = dut.main(["-S", "-m", "doc,test", "--batch", dname,
+                                "-j", "2"])
+            self.assertEqual(0, ret)
+            self.assertIn("-- {:8.3f}s {} skipped as an output of {}".format(
+                          0.0, os.path.join(dname, "sub", "b-doc.mm"),
+                          os.path.join(dname, "sub", "b.mm")),
+                          log.getvalue().splitlines())
+            names = sorted(os.listdir(os.path.join(dname, "sub")))
+            self.assertEqual(["b-1-doc.mm", "b-doc.mm", "b-test.mm",
+                              "b.mm", "design-doc-doc.mm",
+                              "design-doc-test.mm", "design-doc.mm",
+                              "unit-test-doc.mm", "unit-test-test.mm",
+                              "unit-test.mm"], names)
+            modes = [dut.runmode.doc, dut.runmode.test]
+            skipped: List[Tuple[Text, Text]] = []
+            names = dut.batch_inputs([os.path.join(dname, "sub")], modes,
+                                     skipped=skipped)
+            self.assertEqual(["b.mm", "design-doc.mm", "unit-test.mm"],
+                             [os.path.basename(i) for i in names])
+            self.assertEqual([("b-1-doc.mm", "b.mm"), ("b-doc.mm", "b.mm"),
+                              ("b-test.mm", "b.mm"),
+                              ("design-doc-doc.mm", "design-doc.mm"),
+                              ("design-doc-test.mm", "design-doc.mm"),
+                              ("unit-test-doc.mm", "unit-test.mm"),
+                              ("unit-test-test.mm", "unit-test.mm")],
+                             [tuple(os.path.basename(j) for j in i)
+                              for i in skipped])
+
+            with open(os.path.join(dname, "c.mm"), "w") as fp:
+                fp.write("<map")
+            ret = dut.main(["-S", "-m", "doc", "--batch",
+                            os.path.join(dname, "*.mm")])
+            self.assertEqual(1, ret)
+
+    def test_fmmulti_threads(self) -> None:  # {{{1
+        import fmmulti as dut
+        opts = (["-m", "doc"], ["-m", "backup", "-B"],
+                ["-m", "test", "-c", "bck1"], ["-m", "through", "-B"])
+        with tempfile.TemporaryDirectory() as dname:
+            jobs, exps = [], []
+            for i, opt in enumerate(opts * 3):
+                fname = os.path.join(dname, "e{}.mm".format(i))
+                if i < len(opts):
+                    dut.main(["-f", "-S", "-o", fname, "sample.mm"] + opt)
+                    with open(fname) as fp:
+                        exps.append(fp.read())
+                o = dut.options.parse(["-f", "-S", "-o", fname,
+                                       "sample.mm"] + opt)
+                jobs.append(("sample.mm", o.outputs, -1, True, o.ctx))
+            seq = list(dut.convert_many(jobs, 4))
+            self.assertEqual(["sample.mm"] * len(jobs), [i[0] for i in seq])
+            self.assertEqual([""] * len(jobs), [i[1] for i in seq])
+            for i, (_, outputs, _, _, _) in enumerate(jobs):
+                with open(outputs[0][1]) as fp:
+                    self.assertEqual(exps[i % len(opts)], fp.read())
+
+    def test_fmmulti_serve(self) -> None:  # {{{1
+        import shutil
+        import socket
+        import threading
+        import tracemalloc
+        import fmmulti as dut
+        shutil.copy("sample.mm", self.out("sample.mm"))
+        src = self.out("sample.mm").encode("utf-8")
+        fname = self.out("sample-s.mm").encode("utf-8")
+
+        def request(addr: Text, reqs: List[bytes]) -> List[bytes]:
+            srv = dut.serve_create(addr)
+            th = threading.Thread(target=srv.serve_forever)
+            th.start()
+            ret = []
+            try:
+                family = (socket.AF_UNIX if isinstance(srv.server_address,
+                                                       str) else
+                          socket.AF_INET)
+                with socket.socket(family) as sock:
+                    sock.connect(srv.server_address)
+                    with sock.makefile("rwb") as fp:
+                        for req in reqs:
+                            fp.write(src + b"\n" + req + b"\n\n")
+                            fp.flush()
+                            ret.append(fp.readline())
+                            self.assertFalse(tracemalloc.is_tracing())
+            finally:
+                srv.shutdown()
+                srv.server_close()
+                th.join()
+            return ret
+
+        # 2nd time from the cache, tcp requests do not choose outputs,
+        # they do not overwrite files nor follow a dangling symlink.
+        with open(self.out("sample.mm-test.mm"), "w") as fp:
+            fp.write("keep")
+        os.symlink(self.out("victim.mm"), self.out("sample.mm-test-1.mm"))
+        req = b"-S\n-m\ntest"
+        ret = request("127.0.0.1:0", [req, req, b"-m\nfoo", b"-f",
+                                      b"-o\n" + fname, b"--cache-dir\n.",
+                                      b"--profile-json\na.json",
+                                      req + b"\n--profile"])
+        self.assertEqual([b"0 " + src + b"-test-2.mm\n",
+                          b"0 " + src + b"-test-3.mm\n"], ret[:2])
+        self.assertEqual([b"2 "] * 6, [i[:2] for i in ret[2:]])
+        with open(self.out("sample.mm-test.mm")) as fp:
+            self.assertEqual("keep", fp.read())
+        self.assertFalse(os.path.exists(self.out("victim.mm")))
+
+        req = b"-S\n-f\n-m\ntest\n--profile\n-o\n" + fname
+        ret = request(self.out("sample.sock"), [
+                req, req, b"-o\n-", b"-o\nsample-s.mm"])
+        self.assertEqual([b"0 " + fname + b"\n"] * 2, ret[:2])
+        self.assertEqual([b"2 "] * 2, [i[:2] for i in ret[2:]])
+
+        dut.main(["-f", "-o", self.out("sample-s1.mm"), "sample.mm",
+                  "-S", "-m", "test"])
+        for i in ("sample-s.mm", "sample.mm-test-2.mm"):
+            with open(self.out(i)) as f1, \
+                    open(self.out("sample-s1.mm")) as f2:
+                self.assertEqual(f2.read(), f1.read())
+
+        # a same size edit in the resolution of float mtime.
+        t = os.stat(self.out("sample.mm")).st_mtime_ns
+        xml = dut.serve_parse(self.out("sample.mm"))
+        with open(self.out("sample.mm"), "r+b") as fb:
+            data = fb.read()
+            fb.seek(0)
+            fb.write(data.replace(b'TEXT="', b'TEXT="X', 1)[:len(data)])
+        os.utime(self.out("sample.mm"), ns=(t + 1, t + 1))
+        self.assertIsNot(xml, dut.serve_parse(self.out("sample.mm")))
+
+    def test_fmmulti_serve_socket(self) -> None:  # {{{1
+        import fmmulti as dut
+        fname = self.out("sample.sock")
+        with open(fname, "w") as fp:
+            fp.write("not a socket")
+        with self.assertRaises(FileExistsError):
+            dut.serve_create(fname)
+        with open(fname) as fp:
+            self.assertEqual("not a socket", fp.read())
+        dut.serve_create(self.out("sample2.sock")).server_close()
+        with dut.serve_create(self.out("sample2.sock")):  # reuse a socket
+            st = os.stat(self.out("sample2.sock"))
+            self.assertEqual(0o600, st.st_mode & 0o777)
+
+    def test_fmmulti_cache(self) -> None:  # {{{1
+        import io
+        import common as cmn
+        import fmmulti as dut
+
+        def compose(xml: dut.FMXml, mode: dut.runmode) -> Text:
+            xml.f_disable_script = True
+            fp = io.StringIO()
+            xml.output_stream(fp, xml.restruct(mode))
+            return fp.getvalue()
+
+        with tempfile.TemporaryDirectory() as dname:
+            cache = cmn.FileCache(dname, 1 << 20)
+            xml1 = dut.FMXml.parse("sample.mm", cache)
+            self.assertEqual(1, len(os.listdir(dname)))
+            xml2 = dut.FMXml.parse("sample.mm", cache)
+            self.assertEqual(xml1.n_nodes, xml2.n_nodes)
+            for mode in dut.runmode:
+                if mode != dut.runmode.through:
+                    self.assertEqual(compose(xml1, mode), compose(xml2, mode))
+
+            cache.limit = 0  # evict all.
+            cache.evict()
+            self.assertEqual([], os.listdir(dname))
+
+    def test_fmmulti_output_stream(self) -> None:  # {{{1
+        import io
+        import fmmulti as dut
+        xml = dut.FMXml.parse("sample.mm")
+        xml.f_disable_script = True
+        fp = io.StringIO()
+        xml.output_stream(fp, xml.restruct(dut.runmode.test))
+        dut.main(["-f", "-o", self.out("sample-t1.mm"), "sample.mm",
+                  "-S", "-m", "test"])
+        with open(self.out("sample-t1.mm")) as f:
+            self.assertEqual(f.read(), fp.getvalue())
+
+    def test_fmmulti_through_stream(self) -> None:  # {{{1
+        import io
+        import fmmulti as dut
+        src = ('<map version="1.1.0">\n'
+               '<node CREATED="1" ID="ID_1" MODIFIED="2" TEXT="r">\n'
+               '<attribute NAME="doc" VALUE="root"/>\n'
+               '<node CREATED="1" ID="ID_2" MODIFIED="2" TEXT="a"/>\n'
+               '<node CREATED="1" ID="ID_3" MODIFIED="2" TEXT="b">\n'
+               '<node CREATED="1" ID="ID_4" MODIFIED="2" TEXT="c">'
+               '<font SIZE="1"/></node>\n'
+               '<attribute NAME="doc" VALUE="1"/>\n'
+               '<attribute NAME="backup" VALUE="9"/>\n'
+               "</node>\n"
+               '<node CREATED="1" ID="ID_5" MODIFIED="2" TEXT="d">\n'
+               '<attribute NAME="doc" VALUE="2"/>\n'
+               '<node CREATED="1" ID="ID_6" MODIFIED="2" TEXT="e"/>\n'
+               '<attribute NAME="test" VALUE="2"/>\n'
+               "</node>\n</node>\n"
+               '<node CREATED="1" ID="ID_7" MODIFIED="2" TEXT="f"/>\n'
+               "</map>\n")
+        with tempfile.TemporaryDirectory() as dname:
+            fname = os.path.join(dname, "a.mm")
+            with open(fname, "w") as fp:
+                fp.write(src)
+            for fn in ("sample.mm", fname):
+                for opt in ([], ["-B"]):
+                    dut.main(["-f", "-o", self.out("sample-t1.mm"), fn,
+                              "-S", "-m", "through"] + opt)
+                    xml = dut.FMXml.parse(fn)
+                    xml.ctx = dut.Context(f_no_backup=len(opt) > 0)
+                    dut.HierBuilder().mark_backup(xml.root.children, "root")
+                    exp = io.StringIO()
+                    xml.output_stream(exp, xml.root.children)
+                    with open(self.out("sample-t1.mm")) as f:
+                        self.assertEqual(exp.getvalue(), f.read())
+
+    def test_fmmulti_splice(self) -> None:  # {{{1
+        import io
+        import fmmulti as dut
+        note = ('<richcontent TYPE="NOTE"><html>\n<head/>\n<body>\n'
+                "<p>a <b>bold</b> &amp; <i>note</i></p>\n"
+                "<pre>\n1 &lt; 2\n</pre>\n</body>\n</html></richcontent>")
+        hook = ("<hook NAME='x'><text>a &gt; b</text></hook>")
+        font = '<font NAME="a&#x30b4;" SIZE="12"/>'
+        src = ('<map version="1.1.0">\n'
+               '<node CREATED="1" ID="ID_1" MODIFIED="2" TEXT="r">\n'
+               '<attribute NAME="doc" VALUE="root"/>\n'
+               '<node CREATED="1" ID="ID_2" MODIFIED="2" TEXT="a">\n'
+               + font + "\n" + note + "\n" + hook + "\n"
+               '<attribute NAME="doc" VALUE="1"/>\n'
+               "</node>\n</node>\n</map>\n")
+        with tempfile.TemporaryDirectory() as dname:
+            fname = os.path.join(dname, "a.mm")
+            with open(fname, "w") as fp:
+                fp.write(src)
+            xml = dut.FMXml.parse(fname)
+            xml.f_disable_script = True
+            out = io.StringIO()
+            xml.output_stream(out, xml.restruct(dut.runmode.doc))
+            for frag in (font, note, hook):
+                self.assertIn(frag, out.getvalue())
+
+            out = io.StringIO()
+            xml.output_markdown(out, xml.restruct(dut.runmode.doc), 0)
+            self.assertIn("\n1 < 2\n", out.getvalue())
+
+            # the mapped input is detached before overwritten.
+            dut.main(["-f", "-o", fname, fname, "-S", "-m", "through"])
+            with open(fname) as fp:
+                src = fp.read()
+            for frag in (font, note, hook):
+                self.assertIn(frag, src)
+
+    def test_fmmulti_parser_backends(self) -> None:  # {{{1
+        import common as cmn
+        import fmmulti as dut
+        src = ('<?xml version="1.0" encoding="utf-8"?>\n'
+               '<map version="1.1.0">\n<!-- <font/> -->\n'
+               '<node CREATED="1" ID="ID_1" MODIFIED="2" TEXT="r">\n'
+               '<attribute NAME="doc" VALUE="1"/><icon BUILTIN="a"/>\n'
+               'a<!-- c -->b<![CDATA[<font/>]]>\n'
+               '<font NAME="a>b" SIZE="12"/><hook NAME="x">'
+               '<font/><!-- </hook> --></hook>\n'
+               "</node>\n</map>\n")
+        with tempfile.TemporaryDirectory() as dname:
+            fname = os.path.join(dname, "a.mm")
+            with open(fname, "w") as fp:
+                fp.write(src)
+            ctx = dut.options.parse(["--parser", "auto", fname]).ctx
+            self.assertEqual("auto", ctx.parser)  # picked at parsing.
+            for fn in ("sample.mm", fname):
+                tables = []
+                for name in list(dut.parser_backends) + ["auto"]:
+                    xml = dut.FMXml.parse(fn, ctx=dut.Context(parser=name))
+                    tables.append(xml.to_table())
+                for table in tables[1:]:
+                    self.assertEqual(tables[0], table)
+            xml = dut.FMXml.parse(fname)
+            seq = [i.compose(i) for f, i in cmn.walk(xml.root.children)
+                   if f and isinstance(i, dut.Splice)]
+        self.assertEqual(seq, [
+            '<icon BUILTIN="a"/>', '<font NAME="a>b" SIZE="12"/>',
+            '<hook NAME="x"><font/><!-- </hook> --></hook>'])
+
+        # a comment across chunks is cut at its end.
+        self.assertEqual([b"a<!--b-->", b"c"],
+                         list(dut.ParserPull.chunks(b"a<!--b-->c", 7)))
+
+        with open("sample.mm", "rb") as fp:
+            times = dut.parser_bench(dut.FMXml.source(fp), 1)
+        self.assertEqual(sorted(i for _, i in times),
+                         sorted(dut.parser_backends))
+        self.assertIn(dut.parser_pick(100), dut.parser_backends.values())
+
+    def test_fmmulti_incremental(self) -> None:  # {{{1
+        import io
+        import bench
+        import common as cmn
+        import fmmulti as dut
+
+        def convert(fname: Text, cache: Optional[cmn.FileCache]) -> Text:
+            xml = dut.FMXml.parse(fname)
+            xml.f_disable_script = True
+            xml.fname_order = fname
+            xml.cache = cache
+            fp = io.StringIO()
+            xml.output_stream(fp, xml.restruct(dut.runmode.doc))
+            return fp.getvalue()
+
+        with tempfile.TemporaryDirectory() as dname:
+            fname = os.path.join(dname, "a.mm")
+            fp = io.StringIO()
+            bench.Generator(notes=0).write(fp, 300)
+            src = fp.getvalue()
+            cache = cmn.FileCache(os.path.join(dname, "cache"), 1 << 20)
+            # change some nodes, add a node with the same ID and
+            # move a node to another position of the same level.
+            for old, new in (('ID_5" MODIFIED="1', 'ID_5" MODIFIED="2'),
+                             ('VALUE="1-1-1-1-2"/>', 'VALUE="9-9"/>'),
+                             ('ID_7"', 'ID_200"'),
+                             ('ID_9"', 'ID_8"'),
+                             ('VALUE="1-1-1-2"/>', 'VALUE="1-1-1-1"/>'),
+                             ):
+                self.assertIn(old, src)
+                src = src.replace(old, new, 1)
+                with open(fname, "w") as f:
+                    f.write(src)
+                exp = convert(fname, None)
+                self.assertEqual(exp, convert(fname, cache))
+                self.assertEqual(exp, convert(fname, cache))
+            self.assertEqual(["a.mm", "cache"], sorted(os.listdir(dname)))
+            self.assertEqual(1, len(os.listdir(os.path.join(dname, "cache"))))
+
+    def test_fmmulti_memory_budget(self) -> None:  # {{{1
+        import io
+        import fmmulti as dut
+        for mode in (dut.runmode.doc, dut.runmode.test, dut.runmode.backup):
+            xml = dut.FMXml.parse("sample.mm")
+            fp = io.StringIO()
+            xml.output_stream(fp, xml.restruct(mode))
+            spill = dut.FMSpill(mode, 1000)  # spill each 2-3 nodes.
+            spill.restruct_file("sample.mm")
+            self.assertGreater(len(spill.runs.runs), 1)
+            spill.output(self.out("sample-e.mm"), mode)
+            with open(self.out("sample-e.mm")) as f:
+                self.assertEqual(fp.getvalue(), f.read())
+
+        dut.main(["-f", "-o", self.out("sample-e1.mm"), "sample.mm", "-S",
+                  "-m", "test,through"])
+        dut.main(["-f", "-o", self.out("sample-e2.mm"), "sample.mm", "-S",
+                  "-m", "test,through", "--memory-budget", "1"])
+        for name in ("test", "through"):
+            with open(self.out("sample-e1-{}.mm".format(name))) as f1, \
+                    open(self.out("sample-e2-{}.mm".format(name))) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_fmmulti_memory_budget_roots(self) -> None:  # {{{1
+        import io
+        import fmmulti as dut
+        src = ('<map version="1.1.0">\n'
+               '<node CREATED="1" ID="ID_1" MODIFIED="2" TEXT="r">\n'
+               '<attribute NAME="doc" VALUE="root"/>\n'
+               '<attribute NAME="test" VALUE="root"/>\n'
+               '<node CREATED="1" ID="ID_2" MODIFIED="2" TEXT="a">\n'
+               '<attribute NAME="doc" VALUE="root"/>\n'
+               '<attribute NAME="backup" VALUE="root"/>\n'
+               '<node CREATED="1" ID="ID_3" MODIFIED="2" TEXT="b">\n'
+               '<attribute NAME="doc" VALUE="1"/>\n'
+               '<attribute NAME="test" VALUE="root"/>\n'
+               "</node>\n</node>\n"
+               '<node CREATED="1" ID="ID_4" MODIFIED="2" TEXT="c">\n'
+               '<attribute NAME="doc" VALUE="root"/>\n'
+               '<attribute NAME="test" VALUE="1"/>\n'
+               "</node>\n</node>\n</map>\n")
+        with tempfile.TemporaryDirectory() as dname:
+            fname = os.path.join(dname, "a.mm")
+            with open(fname, "w") as f:
+                f.write(src)
+            for mode in (dut.runmode.doc, dut.runmode.test,
+                         dut.runmode.backup):
+                xml = dut.FMXml.parse(fname)
+                fp = io.StringIO()
+                xml.output_stream(fp, xml.restruct(mode))
+                spill = dut.FMSpill(mode, 1000)
+                spill.restruct_file(fname)
+                spill.output(os.path.join(dname, "b.mm"), mode)
+                with open(os.path.join(dname, "b.mm")) as f:
+                    self.assertEqual(fp.getvalue(), f.read())
 
     def test_md2fm(self) -> None:  # {{{1
         import md2fm as dut
-        dut.main(["-f", "-o", "sample-m.mm", "sample.md"])
+        dut.main(["-f", "-o", self.out("sample-m.mm"), "sample.md"])
+        self.assertFalse(dut.options.parse(["sample.md"]).f_verbose)
+        self.assertTrue(dut.options.parse(["-v", "sample.md"]).f_verbose)
 
         import fmmulti as dut2
-        dut2.main(["-f", "-M", "0", "-o", "sample-m.md", "sample-m.mm"])
+        dut2.main(["-f", "-M", "0", "-o", self.out("sample-m.md"),
+                   self.out("sample-m.mm")])
+
+    def test_convert_in_memory(self) -> None:  # {{{1
+        import gzip
+        import io
+        import re
+        import fmmulti as dut
+        import md2fm as dut2
+        with open("sample.mm", "rb") as fp:
+            src = fp.read()
+        cases: List[Tuple[List[Text], Dict[Text, Any]]] = [
+                (["-m", "doc", "-S"], dict(mode="doc")),
+                (["-m", "through"], {}),
+                (["-m", "doc", "-S", "-M", "1"],
+                 dict(mode=dut.runmode.doc, markdown_depth=1))]
+        for opt, kw in cases:
+            dut.main(["-f", "-o", self.out("sample-i.mm"), "sample.mm"] + opt)
+            fname = "sample-i.md" if "-M" in opt else "sample-i.mm"
+            with open(self.out(fname), "rb") as fp:
+                exp = fp.read()
+            kw["f_disable_script"] = "-S" in opt
+            for data in (src, src.decode("utf-8"), gzip.compress(src),
+                         io.BytesIO(src)):
+                self.assertEqual(exp, dut.convert(data, **kw))
+
+        def no_id(src: bytes) -> bytes:
+            return re.sub(rb'ID="[0-9]+"', b'ID="X"', src)
+
+        dut2.main(["-f", "-o", self.out("sample-i.mm"), "sample.md"])
+        with open(self.out("sample-i.mm"), "rb") as fp:
+            exp = no_id(fp.read())
+        with open("sample.md") as f:
+            text = f.read()
+        self.assertEqual(exp, no_id(dut2.convert(text)))
+        self.assertEqual(exp, no_id(dut2.convert(io.StringIO(text))))
+
+    def test_convert_no_logging(self) -> None:  # {{{1
+        import contextlib
+        import io
+        import fmmulti as dut
+        import md2fm as dut2
+        root = logging.getLogger()
+        handlers, root.handlers = root.handlers, []
+        try:
+            with open("sample.mm", "rb") as fp:
+                src = fp.read()
+            err = io.StringIO()
+            with contextlib.redirect_stderr(err):
+                dut.convert(src, mode="doc")
+                dut2.convert("# a\ntext\n")
+            self.assertEqual([], root.handlers)
+            self.assertEqual("", err.getvalue())
+        finally:
+            root.handlers = handlers
+
+    def test_md2fm_stream(self) -> None:  # {{{1
+        import io
+        import re
+        import md2fm as dut
+
+        def no_id(src: Text) -> Text:
+            return re.sub(r'ID="[0-9]+"', 'ID="X"', src)
+
+        with open("sample.md") as f:
+            lines = f.readlines()
+        lines += ["title\n", "=====\n", "body\n", "### 3rd\n", "# 1st\n"]
+        for src in (lines, lines[-5:]):
+            exp = io.StringIO()
+            dut.FMXml.parse_lines(src).output_stream(exp)
+            fp = io.StringIO()
+            xml = dut.FMStream(fp)
+            xml.convert_lines(iter(src))
+            self.assertEqual(no_id(exp.getvalue()), no_id(fp.getvalue()))
+            self.assertEqual(1, len(xml.root.children))  # released
+        self.assertIn('TEXT="3rd"', fp.getvalue())
+
+    def test_md2fm_line_tokenizer(self) -> None:  # {{{1
+        import bench
+        import md2fm as dut
+        src = ["---", "title: a", "---", "# 1st", "text", "---", "",
+               "````md", "# code", "```", "## code", "````", "---",
+               "  ~~~", "=====", "~~~", "<!-- a -->", "---",
+               "<!--", "# cmt", "-->", "<div class='a'>", "# div", "",
+               "<Pre>", "# pre", "", "</pre>", "text", "<br/>", "### 3rd",
+               "<?php", "## pi ?>", "<![CDATA[", "#", "]]>", "###"]
+        exp = [0, 0, 0, 110, 0, 200] + [0] * 24 + [300] + [0] * 5 + [300]
+        self.assertEqual(exp, bench.classify_tokenizer(src))
+        seq = [n for n, line in dut.LineTokenizer().levels(
+               ["#a\r\n", "b\n", "===\n", "---\n", "  # c\n"])]
+        self.assertEqual([110, 0, 100, 200, 0], seq)
+        src = ["---\n", "# a\n", "b\n", "## c\n"]  # not a front matter
+        seq = [n for n, line in dut.LineTokenizer().levels(src)]
+        self.assertEqual([0, 110, 0, 210], seq)
+        front = ["---", "title: a", "tags:", "- x", "  - y", "", "..."]
+        seq = [n for n, line in dut.LineTokenizer().levels(front)]
+        self.assertEqual([0] * 7, seq)
+        seq = [n for n, line in dut.LineTokenizer().levels(  # setext
+               ["---", "# a", "text", "---"])]
+        self.assertEqual([0, 110, 0, 200], seq)
+
+        def counted(seq: List[Text]) -> Iterator[Text]:
+            for i, line in enumerate(seq):
+                n_read[0] = i + 1
+                yield line
+        n_max = dut.LineTokenizer.n_front_max
+        for doc in (["---", "text"] + ["line"] * 1000 + ["---"],
+                    ["---"] + ["k: v"] * 1000 + ["---"]):
+            n_read = [0]
+            it = dut.LineTokenizer().levels(counted(doc))
+            self.assertEqual(0, next(it)[0])
+            self.assertLessEqual(n_read[0], n_max + 2)  # read-ahead
+            self.assertEqual(200, list(it)[-1][0])  # not a front matter
+        self.assertIn(b'TEXT="c"', dut.convert("".join(src)))
+
+        with open("sample.md") as fp:
+            lines = fp.readlines()
+        a = bench.classify_legacy(lines)
+        b = bench.classify_tokenizer(lines)
+        self.assertEqual([300], [a[i] for i in range(len(a)) if a[i] != b[i]])
+
+    def test_fmmulti_markdown_deep(self) -> None:  # {{{1
+        import io
+        import sys
+        import fmmulti as dut
+        xml = dut.FMXml()
+        cur = xml.root
+        for i in range(sys.getrecursionlimit() + 100):
+            nod = dut.FMNode({"TEXT": "n{}".format(i)})
+            cur.children.append(nod)
+            cur = nod
+        fp = io.StringIO()
+        xml.output_markdown(fp, xml.root.children, 0)
+        self.assertTrue(fp.getvalue().startswith("\n n0\n\n# n1\n"))
+
+    def test_fmmulti_deep_map(self) -> None:  # {{{1
+        import io
+        import common as cmn
+        import fmmulti as dut
+        n = 10000
+        with tempfile.TemporaryDirectory() as dname:
+            fname = os.path.join(dname, "deep.mm")
+            with open(fname, "w") as fp:
+                fp.write('<map version="1.1.0">\n')
+                for i in range(n):
+                    fp.write('<node CREATED="1" ID="ID_{0}" MODIFIED="2" '
+                             'TEXT="n{0}">\n'.format(i))
+                fp.write('</node>\n' * n + '</map>\n')
+            with open(fname) as fp:
+                src = fp.read()
+            xml = dut.FMXml.parse(fname)
+        seq = xml.root.children
+        out = io.StringIO()
+        xml.output_stream(out, seq)
+        self.assertEqual(src.rstrip("\n"), out.getvalue())
+
+        texts = xml.markdown_chunks(seq, 0)
+        self.assertEqual(n - 1, sum(1 for i in texts if i.startswith("\n#")))
+
+        ret = xml.restruct(dut.runmode.test)
+        self.assertEqual(n, sum(1 for i in ret if i.name == "node") - 1)
+
+        cmn.HierBuilder().mark_backup(seq, "root")
+        nods = [i for i in seq if i.name == "node"]
+        while len(nods) > 0:
+            nod, nods = nods[-1], [i for i in nods[-1].children
+                                   if i.name == "node"]
+        self.assertEqual("-".join(["1"] * (n - 1)), nod.attr_get("backup", ""))
+
+    def test_bench_generator(self) -> None:  # {{{1
+        import io
+        import bench as dut
+        import fmmulti
+        gen = dut.Generator(depth=2, fanout=3, attrs=1.0, notes=0.5)
+        fp = io.StringIO()
+        gen.write(fp, 40)
+        src = fp.getvalue()
+        fp = io.StringIO()
+        gen.write(fp, 40)
+        self.assertEqual(src, fp.getvalue())
+        self.assertIn("&#x8981;&#x4ef6;", src)  # non-ascii in titles
+        xml = fmmulti.FMXml.parse_stream(io.BytesIO(src.encode("utf-8")))
+        seq = [i for i in xml.root.children if i.name == "node"]
+        self.assertEqual(1, len(seq))  # all nodes are under the root.
+        nods = [i for i in seq[0].children if i.name == "node"]
+        self.assertEqual(10, len(nods))  # root takes more than fanout.
+        self.assertEqual(40, src.count("<node "))
+        self.assertEqual(40, src.count('NAME="doc"'))
+        self.assertIn('VALUE="3-2"', src)
+        self.assertNotIn('VALUE="1-1-1"', src)  # depth
+        for seed in range(20):  # the root is not in 2 groups.
+            fp = io.StringIO()
+            dut.Generator(seed=seed).write(fp, 2)
+            self.assertIn('<attribute NAME="test" VALUE="root"/>',
+                          fp.getvalue())
+
+        with tempfile.TemporaryDirectory() as dname:
+            runner = dut.Runner("sample.mm", dname)
+            runner.run()
+        for i in ("parse", "restruct-doc", "output-test", "output-markdown",
+                  "md2fm-parse", "md2fm-output", "sort-incremental"):
+            self.assertIn(i, runner.times)
+
+    def test_bench_check(self) -> None:  # {{{1
+        import bench as dut
+        cur = {"1000": dict(a=0.1, b=0.1), "10000": dict(a=1.3, b=10.0)}
+        errs = dut.check_scaling(cur, 0.5)
+        self.assertEqual(1, len(errs))
+        self.assertTrue(errs[0].startswith("b: "))
+        base = dict(calibration=2.0, results={
+            "1000": dict(a=0.2, b=0.004), "10000": dict(a=2.0)})
+        self.assertEqual([], dut.check_regression(cur, 1.0, base, 0.3))
+        errs = dut.check_regression(cur, 0.5, base, 0.3)
+        self.assertEqual(2, len(errs))  # b at 1000 is under the floor.
+        self.assertTrue(errs[0].startswith("1000 nodes: a: "))
+
+        cur = {"1000": {"sort-full": 0.01, "sort-incremental": 0.02},
+               "10000": {"sort-full": 0.2, "sort-incremental": 0.05},
+               "100000": {"sort-full": 2.0, "sort-incremental": 2.5}}
+        errs = dut.check_incremental(cur)
+        self.assertEqual(1, len(errs))
+        self.assertTrue(errs[0].startswith("100000 nodes: "))
+
+
+class TestNode(TestCase):  # {{{1
+    def test_level_cache(self) -> None:  # {{{1
+        from fmmulti import FMNode, Node, runmode
+        dut = FMNode({})
+        self.assertEqual((100000 - 1, ), Node.level(dut, runmode.doc))
+        dut.attr_replace("doc", "1-2a")
+        self.assertEqual((1000, 2001), Node.level(dut, runmode.doc))
+        dut.attr_replace("doc", "root")
+        self.assertEqual((), Node.level(dut, runmode.doc))
+
+    def test_rtrim_enter(self) -> None:  # {{{1
+        from common import Chars, Node as Nod1
+        from fmmulti import Node
+        for src, exp in ((["a"], ["a", "\n"]),
+                         (["\n"], ["\n"]),
+                         (["a\n\n\n"], ["a\n"]),
+                         (["\n", "\n\n"], ["\n"]),
+                         (["a\n", "\n  \n"], ["a\n", "\n  \n"]),
+                         (["a\n", "\n\n"], ["a\n"])):
+            seq: List[Nod1] = [Chars(i) for i in src]
+            Node.rtrim_enter(seq)
+            self.assertEqual(exp, [getattr(i, "data") for i in seq])
+
 
 # end of file {{{1
 # vi: ft=python:et:ts=4:sw=4:tw=80:fdm=marker
@@ -10,6 +10,8 @@ You can obtain one at https://mozilla.org/MPL/2.0/.
 import logging
 import os
 import re
+import sys
+from typing import Any, Text
 from unittest import TestCase
 
 
@@ -102,6 +104,197 @@ class TestCommon(TestCase):  # {{{1
         exp = re.sub("\n +", " ", exp)  # strip indent
         self.assertEqual(exp, ans)
 
+    def test_quote_attr(self) -> None:  # {{{1
+        from common import quote_attr as dut, quote_attr_charwise as ref
+        for src in ("", "abc", 'a"b<c>&d\'e', "\n\t\r\x0b\x01\x7f",
+                    "\\n\\\\n\\x0b\\", "日本語のラベル\u00e9\U0001f600",
+                    compose_script_sample()):
+            self.assertEqual(ref(src), dut(src))
+            self.assertEqual(ref(src), dut(src))  # from cache
+
+    def test_node_leaf(self) -> None:  # {{{1
+        from common import Chars, Node
+        a, b = Chars("\n"), Node.leaf("attribute", dict(NAME="doc"))
+        self.assertIs(a.children, b.children)
+        self.assertFalse(hasattr(a, "__dict__"))
+        with self.assertRaises(AttributeError):
+            a.children.append(b)
+        self.assertEqual("", b.attr_get("doc", ""))
+
+    def test_node_attr_index(self) -> None:  # {{{1
+        from common import Chars, Node
+        dut = Node("node", {})
+        for k, v in (("doc", "1"), ("test", "2"), ("doc", "3")):
+            dut.append_child(Chars("\n"))
+            dut.append_child(Node("attribute", dict(NAME=k, VALUE=v)))
+        self.assertEqual("1", dut.attr_get("doc", ""))
+        self.assertEqual("", dut.attr_get("backup", ""))
+
+        dut.attr_replace("backup", "1-2")
+        names = [i.attr["NAME"] for i in dut.children
+                 if i.name == "attribute"]
+        self.assertEqual(["doc", "test", "backup", "doc"], names)
+        self.assertEqual("1-2", dut.attr_get("backup", ""))
+
+        dut.attr_change_name("doc", "req")
+        self.assertEqual("1", dut.attr_get("req", ""))
+        self.assertEqual("3", dut.attr_get("doc", ""))
+
+    def test_argsort_levels(self) -> None:  # {{{1
+        import random
+        import common as cmn
+        rnd = random.Random(1)
+        for n, N in ((5, 3), (1000, 8), (1000, 12)):
+            levels = [tuple(rnd.choice((0, 1, 1000, 2001, cmn.lvl_max))
+                            for j in range(rnd.randint(0, N)))
+                      for i in range(n)]
+            exp = sorted(range(n), key=lambda i: (
+                    levels[i] + (0, ) * (N - len(levels[i]))))
+            self.assertEqual(exp, cmn.argsort_levels(levels))
+            np, cmn.np = cmn.np, None  # pure python
+            try:
+                self.assertEqual(exp, cmn.argsort_levels(levels))
+            finally:
+                cmn.np = np
+        # 9th component and larger numbers than lvl_max are not ignored.
+        levels = [(1, ) * 8 + (2, ), (1, ) * 9, (2, 0), (1, cmn.lvl_max + 1)]
+        self.assertEqual([1, 0, 3, 2], cmn.argsort_levels(levels))
+
+    def test_external_sort(self) -> None:  # {{{1
+        import random
+        from common import ExternalSort
+        rnd = random.Random(1)
+        keys = [(rnd.randint(0, 50), i) for i in range(1000)]
+        dut = ExternalSort(1000)
+        dut.n_merge = 4
+        for key in keys:
+            dut.add(key, repr(key).encode())
+        self.assertLess(len(dut.runs), 4)
+        seq = list(dut.merged())
+        self.assertEqual(sorted(keys), [i[0] for i in seq])
+        self.assertEqual([repr(i).encode() for i in sorted(keys)],
+                         [i[1] for i in seq])
+
+    def test_walk(self) -> None:  # {{{1
+        from common import Node, walk
+        root = Node("a", {})
+        for name in ("b", "c"):
+            root.append_child(Node(name, {}))
+        root.children[0].append_child(Node("d", {}))
+        seq = ["{}{}".format("+" if f else "-", i.name)
+               for f, i in walk([root])]
+        self.assertEqual("+a +b +d -d -b +c -c -a".split(), seq)
+        seq = ["{}{}".format("+" if f else "-", i.name)
+               for f, i in walk([root], lambda x: x.children[1:])]
+        self.assertEqual("+a +c -c -a".split(), seq)
+
+    def test_hier_builder_deep(self) -> None:  # {{{1
+        from common import HierBuilder, Node, walk
+
+        class Sec(Node):
+            __slots__ = ("n", )
+
+            def __init__(self, n: int) -> None:
+                Node.__init__(self, "sec", {})
+                self.n = n
+
+            def level_flat(self) -> bool:
+                return False
+
+            def level_diff(self, b: Node, ctx: Any) -> int:
+                return self.n - (b.n if isinstance(b, Sec) else 0)
+
+        n = 10000
+        seq = [Sec(i) for i in range(1, n + 1)] + [Sec(2), Sec(1)]
+        dut = HierBuilder()
+        ret = dut.restruct(list(seq))
+        self.assertEqual([seq[0], seq[-1]], ret)
+        self.assertIs(seq[0], seq[-2].parent)
+        depth, n_max = 0, 0
+        for f, nod in walk(ret):
+            depth += 1 if f else -1
+            n_max = max(depth, n_max)
+        self.assertEqual(n, n_max)
+
+    def test_compose_script_server(self) -> None:  # {{{1
+        from common import compose_script_server as dut
+        ans = dut("test", 9999)
+        exp = os.path.join(os.path.dirname(__file__), "fmmulti.py")
+        exp = """cur = c.getMap()
+            fname = cur.getFile().getPath()
+            fnout = fname + "-test.mm"
+            req = [fname, "-m", "test", "--script-server", "9999"]
+            try {
+            sock = new Socket("127.0.0.1", 9999)
+            sock.setSoTimeout(60000)
+            sock.withStreams { inp, out ->
+            out.write((req.join("\\n") + "\\n\\n").getBytes("UTF-8"))
+            out.flush()
+            rd = new BufferedReader(new InputStreamReader(inp, "UTF-8"))
+            print(rd.readLine() + "\\n")
+            }
+            } catch (IOException ex) {
+            cmd = ["python3", "SCRIPT"] + req + ["-f", "-o", fnout]
+            print(cmd.join(" ") + "\\n")
+            proc = cmd.execute()
+            proc.waitForOrKill(5000)
+            }""".replace("SCRIPT", exp)
+        self.assertEqual([i.strip() for i in exp.splitlines()],
+                         ans.splitlines())
+        for line in ans.splitlines():  # groovy literals in a line.
+            self.assertEqual(0, line.count('"') % 2, line)
+
+    def test_splice_tag_end(self) -> None:  # {{{1
+        from common import Splice, SpliceScanner
+        data = b"<map><a x='>'/><a y='1'"
+        self.assertEqual(15, Splice.tag_end(data, 5))
+        with self.assertRaises(ValueError):
+            Splice.tag_end(data, 15)
+        scanner = SpliceScanner(data, ["a"])
+        self.assertEqual((5, 15), scanner.range("a"))
+        with self.assertRaises(ValueError):
+            scanner.range("a")
+
+    def test_serve_address(self) -> None:  # {{{1
+        from common import serve_address as dut, serve_port
+        self.assertEqual(("127.0.0.1", serve_port), dut(""))
+        self.assertEqual(("127.0.0.1", 1234), dut("1234"))
+        self.assertEqual(("0.0.0.0", 1234), dut("0.0.0.0:1234"))
+        self.assertEqual("/tmp/fmmulti.sock", dut("/tmp/fmmulti.sock"))
+        with self.assertRaises(ValueError):
+            dut("sock")
+
+
+def compose_script_sample() -> Text:  # {{{1
+    from common import compose_script
+    return compose_script("doc")
+
+
+def main_bench_quote_attr() -> None:  # {{{1
+    """compare quote_attr() with the charwise reference.
+    """
+    from timeit import timeit
+    import common as cmn
+    seq = ["要求仕様 {} の確認項目, see <node> & \"quote\"\\n".format(i) * 4
+           for i in range(1000)]
+
+    def fast() -> None:
+        cmn.quote_attr.cache_clear()
+        for i in seq:
+            cmn.quote_attr(i)
+
+    def cached() -> None:
+        for i in seq:
+            cmn.quote_attr(i)
+
+    def ref() -> None:
+        for i in seq:
+            cmn.quote_attr_charwise(i)
+
+    for name, fn in (("charwise", ref), ("table", fast), ("cached", cached)):
+        t = timeit(fn, number=10) / 10
+        print("{:10}: {:9.3f}ms / {} values".format(name, t * 1000, len(seq)))
+
 
 def main_section_num() -> None:  # {{{1
     dgt = [chr(i) for i in range(ord('a'), ord('z') + 1)]
@@ -131,5 +324,10 @@ def main_section_num() -> None:  # {{{1
         cur = new
         print("{:3d},{}".format(i, new))
 
+
+if __name__ == "__main__":  # {{{1
+    if sys.argv[1:] == ["bench"]:
+        main_bench_quote_attr()
+
 # end of file {{{1
 # vi: ft=python:et:ts=4:sw=4:tw=80:fdm=marker